@@ -8,9 +8,15 @@ import os
 os.system('tar -xzvf component_maps_408locked.tar.gz')
 print "Now loading component_maps_408locked.dat"
 GSMComponents = np.loadtxt("component_maps_408locked.dat")
-for NSIDE in 2**np.arange(0,10):
+NSIDEs = 2**np.arange(0,10)
+#All the maps go into one pyramid file, with the maps at each NSIDE starting at 4*(NSIDE**2 - 1) (see GlobalSkyModel.pyramidOffset)
+pyramid = np.lib.format.open_memmap("component_maps_408locked_pyramid.npy", mode='w+', dtype=np.float64, shape=(3, 4*(4*NSIDEs[-1]**2 - 1)))
+for NSIDE in NSIDEs:
     print "Working on " + str(NSIDE)
     for comp in range(3):
         GSMComponentDegraded = hp.pixelfunc.ud_grade(GSMComponents[:,comp],NSIDE)
         np.save("component_maps_408locked_NSIDE-" + str(NSIDE) + "_Comp-" + str(comp),GSMComponentDegraded)
-os.system('rm component_maps_408locked.dat')
\ No newline at end of file
+        pyramid[comp, 4*(NSIDE**2 - 1):4*(4*NSIDE**2 - 1)] = GSMComponentDegraded
+pyramid.flush()
+del pyramid
+os.system('rm component_maps_408locked.dat')
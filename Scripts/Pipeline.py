@@ -1,26 +1,85 @@
 import os
-from Mapmaker import Mapmaker
+import sys
+import time
+import numpy as np
+from MAPS21cm.Mapmaker import Mapmaker
 #from BruteForcePowerSpectrumEstimator import BruteForcePowerSpectrumEstimator
 from MAPS21cm.Specifications import Specifications
+from MAPS21cm.FrequencyIndependentInputs import FrequencyIndependentInputs
 import multiprocessing as mp
 
 #Pick out frequency list
 #Perform Mapmaking for Every Frequency
 #Perform PSE---this may want to farm out jobs
 
+#Inputs shared by all frequencies. These are loaded once, before any jobs are started, so that every forked job inherits them.
+sharedInputs = None
+
+def RunMapmakingJob(freq, logFilename):
+    """This function runs Mapmaker at a single frequency in its own process. Everything the job prints (including errors)
+    goes to its own log file, which is done at the file descriptor level so that the parent's stdout is never touched."""
+    log = open(logFilename, 'a')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+    Mapmaker(sharedInputs.s.mainDirectory, freq = freq, sharedInputs = sharedInputs)
+    sys.stdout.flush()
+
 #This function makes maps at all frequencies inside the specified range
-def MakeMapsAtAllFrequencies(configFile = "configuration.txt"):
-    s = Specifications(os.path.dirname(os.path.abspath(__file__)), "/" + configFile)
+def MakeMapsAtAllFrequencies(configFile = "configuration.txt", **kwargs):
+    """This function runs Mapmaker at every frequency in s.frequencyRange and returns the list of results folders for the
+    frequencies that succeeded.
+
+    Each frequency is run in its own (non-daemonic) process, so Mapmaker can still use process-based snapshot workers.
+    At most s.maxConcurrentFrequencies jobs run at once, fewer if s.pipelineMemoryInGB can't hold that many jobs' estimated
+    memory use. Failed jobs are retried up to s.frequencyJobRetries times. Logs go to [resultsFolder]/logs/."""
+    global sharedInputs
+    mainDirectory = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0] #Directory above this one
+    s = Specifications(mainDirectory, configFile)
+    s.OverrideSpecifications(kwargs)
     cubeFreqs = s.frequencyList[(s.frequencyList >= s.frequencyRange[0]) * (s.frequencyList <= s.frequencyRange[1])]
-    pool = mp.Pool()
-    results = [pool.apply_async(Mapmaker, (), {'freq': freq, 'useLogFile': True}) for freq in cubeFreqs]
-    return [p.get() for p in results]
+    sharedInputs = FrequencyIndependentInputs(mainDirectory, configFile, cubeFreqs, **kwargs)
+    s = sharedInputs.s
+
+    #Figure out how many jobs can run at once
+    maxJobs = s.maxConcurrentFrequencies if s.maxConcurrentFrequencies > 0 else mp.cpu_count()
+    memoryPerJob = sharedInputs.estimatedMapmakingMemoryInGB()
+    if memoryPerJob > s.pipelineMemoryInGB:
+        print "\nWARNING: Each frequency is estimated to need " + str(round(memoryPerJob,2)) + " GB, more than the " + str(s.pipelineMemoryInGB) + " GB available. Running one at a time.\n"
+    maxJobs = int(max(min(maxJobs, np.floor(s.pipelineMemoryInGB / memoryPerJob), len(cubeFreqs)), 1))
+    print "Mapping " + str(len(cubeFreqs)) + " frequencies, up to " + str(maxJobs) + " at a time (" + str(round(memoryPerJob,2)) + " GB each)."
+    logFolder = s.resultsFolderFormat + "logs/"
+    if not os.path.exists(logFolder): os.makedirs(logFolder)
+
+    #Start jobs as others finish, retrying those that fail
+    waitingFreqs = list(cubeFreqs)
+    attempts = dict([(freq, 0) for freq in cubeFreqs])
+    runningJobs = {}
+    failedFreqs = []
+    while len(waitingFreqs) > 0 or len(runningJobs) > 0:
+        while len(waitingFreqs) > 0 and len(runningJobs) < maxJobs:
+            freq = waitingFreqs.pop(0)
+            attempts[freq] += 1
+            runningJobs[freq] = mp.Process(target = RunMapmakingJob, args = (freq, logFolder + "{:.3f}".format(freq) + ".txt"))
+            runningJobs[freq].start()
+        time.sleep(.1)
+        for freq in [freq for freq in runningJobs.keys() if not runningJobs[freq].is_alive()]:
+            job = runningJobs.pop(freq)
+            job.join()
+            if job.exitcode == 0:
+                print "Finished mapmaking at " + str(freq) + " MHz."
+            elif attempts[freq] <= s.frequencyJobRetries:
+                print "Mapmaking at " + str(freq) + " MHz failed (exit code " + str(job.exitcode) + "). Retrying..."
+                waitingFreqs.append(freq)
+            else:
+                print "\nWARNING: Mapmaking at " + str(freq) + " MHz failed " + str(attempts[freq]) + " time(s). See " + logFolder + "{:.3f}".format(freq) + ".txt\n"
+                failedFreqs.append(freq)
+    return [s.resultsFolderFormat + "{:.3f}".format(freq) + "/" for freq in cubeFreqs if freq not in failedFreqs]
 
 def RunPipeline():
     MakeMapsAtAllFrequencies()
 #    PowerSpectrumEstimator()
 
-if __name__ == "__main__":    
-    RunPipeline()    
-    
-
+if __name__ == "__main__":
+    RunPipeline()
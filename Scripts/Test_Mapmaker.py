@@ -6,18 +6,23 @@ import matplotlib
 import matplotlib.pyplot as plt
 from MAPS21cm.Specifications import Specifications
 from MAPS21cm.PrimaryBeams import PrimaryBeams
-from MAPS21cm.VisibilitySimulator import VisibilitySimulator
+from MAPS21cm.VisibilitySimulator import VisibilitySimulator, simulateVisibilitiesOfPointLikeSky
+from MAPS21cm import MModeSimulator
 import ephem
 from MAPS21cm import Geometry
 from MAPS21cm.PointSourceCatalog import PointSourceCatalog
 from MAPS21cm import MatricesForMapmaking as MapMats
-from MAPS21cm.GlobalSkyModel import GlobalSkyModel
+from MAPS21cm.LoadVisibilities import LoadVisibilities, uvfitsPolarizationCodes
+from MAPS21cm.RedundantBaselines import RedundantBaselineGroups
+from MAPS21cm.GlobalSkyModel import GlobalSkyModel, mixedResolutionGSM
 import scipy.constants as const
 import cPickle as pickle
 import os
 from MAPS21cm.Mapmaker import Mapmaker
 from astropy import units as u
 from astropy.coordinates import SkyCoord
+from astropy.io import fits
+import tempfile
 
 plt.close("all")
 
@@ -35,14 +40,7 @@ mainDirectory = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0] #D
 def AdaptiveResolutionGSM(s, coords):
     """This function computes the GSM for the adaptive PSF where each pixel comes from a map at the appropriate resolution"""
     galCoords = SkyCoord(frame="icrs", ra=coords.PSFRAs*u.rad, dec=coords.PSFDecs*u.rad).transform_to("galactic")
-    NSIDE = s.adaptiveHEALPixMinNSIDE
-    interpoltedGSMRotated = np.zeros(coords.nPSFPixels)    
-    while NSIDE <= s.mapNSIDE:
-        thisGSM = GlobalSkyModel(s.freq, s.GSMlocation, NSIDE).hpMap
-        interpoltedGSMRotated[coords.newPSFNSIDEs==NSIDE] = hp.get_interp_val(thisGSM,-galCoords[coords.newPSFNSIDEs==NSIDE].b.radian+np.pi/2, galCoords[coords.newPSFNSIDEs==NSIDE].l.radian)
-        NSIDE *= 2
-
-    return interpoltedGSMRotated
+    return mixedResolutionGSM([s.freq], s.GSMlocation, coords.newPSFNSIDEs, -galCoords.b.radian+np.pi/2, np.asarray(galCoords.l.radian))[0]
     
 #Test 1: GSM Only    
 def TestGSMOnly():
@@ -63,8 +61,7 @@ def TestGSMOnly():
         interpoltedGSMRotated = AdaptiveResolutionGSM(s, coords)
     else:
         GSM = GlobalSkyModel(s.freq, s.GSMlocation, s.GSMNSIDE)
-        galCoords = SkyCoord(frame="icrs", ra=coords.PSFRAs*u.rad, dec=coords.PSFDecs*u.rad).transform_to("galactic")        
-        interpoltedGSMRotated = hp.get_interp_val(GSM.hpMap,-galCoords.b.radian+np.pi/2, galCoords.l.radian)
+        interpoltedGSMRotated = Geometry.galacticResamplingMatrix(s, s.GSMNSIDE, coords.PSFRAs, coords.PSFDecs).dot(GSM.hpMap)
     convolvedGSM = np.dot(PSF,interpoltedGSMRotated)
     
     plotFacet(s,coords,convolvedGSM,"Convolved GSM")
@@ -104,7 +101,7 @@ def TestErrorVsPSFext():
         coordsGSM = Geometry.Coordinates(s,useAnotherResolution = s.GSMNSIDE)
         coords = Geometry.Coordinates(s)        
         GSM = GlobalSkyModel(s.freq, s.GSMlocation, s.GSMNSIDE)
-        interpoltedGSMRotated = hp.get_interp_val(GSM.hpMap,-coordsGSM.galCoords.b.radian+np.pi/2, np.asarray(coordsGSM.galCoords.l.radian))
+        interpoltedGSMRotated = Geometry.galacticResamplingMatrix(s, s.GSMNSIDE, coordsGSM.pixelRAs, coordsGSM.pixelDecs).dot(GSM.hpMap)
         convolvedGSM = np.dot(PSF,interpoltedGSMRotated[coords.PSFIndices])
         PSFErrors.append(np.linalg.norm(coaddedMap - convolvedPointSources - convolvedGSM)/np.linalg.norm(convolvedPointSources + convolvedGSM))
     plt.figure()
@@ -133,6 +130,86 @@ def TestErrorVsIntegrations():
     plt.ylabel('Error Compared to 1 Integration Per Snapshot')
 
 
+#Test 5: Error of real arithmetic and single precision PSFs compared to double precision complex arithmetic
+def TestPSFPrecision():
+    print "\nNow running PSF/Mapmaking Comparison of Arithmetic and Precision..."
+    resultsDirectory = Mapmaker(mainDirectory, PSFarithmetic = "complex", PSFprecision = "double", simulateVisibilitiesWithGSM = True, simulateVisibilitiesWithPointSources = True)
+    s, times, ps, Dmatrix, truePSF, trueMap, truePointSourcePSF = MapMats.loadAllResults(resultsDirectory)
+    for arithmetic, precision in [("real","double"), ("complex","single"), ("real","single")]:
+        resultsDirectory = Mapmaker(mainDirectory, PSFarithmetic = arithmetic, PSFprecision = precision, simulateVisibilitiesWithGSM = True, simulateVisibilitiesWithPointSources = True)
+        s, times, ps, Dmatrix, PSF, coaddedMap, pointSourcePSF = MapMats.loadAllResults(resultsDirectory)
+        print arithmetic + " arithmetic in " + precision + " precision:"
+        print "    Map Error = " + str(np.linalg.norm(coaddedMap - trueMap)/np.linalg.norm(trueMap))
+        print "    PSF Error = " + str(np.linalg.norm(PSF - truePSF)/np.linalg.norm(truePSF))
+        if s.PSFforPointSources and ps.nSources > 0:
+            print "    Point Source PSF Error = " + str(np.linalg.norm(pointSourcePSF - truePointSourcePSF)/np.linalg.norm(truePointSourcePSF))
+
+
+#Test 6: m-mode visibility simulator compared to the direct sum over sky pixels
+#This uses a band-limited sky, so it only checks the harmonic machinery. On the real pixelized GSM, both simulators are off by as much as the GSMNSIDE pixelization allows.
+def TestMModeSimulator():
+    print "\nNow running m-mode vs. direct visibility simulation comparison..."
+    s = Specifications(mainDirectory, "configuration.txt", 150)
+    times = Geometry.Times(s)
+    times.CutOutUnusedLSTsAndGroupIntoSnapshots(s)
+    PBs = PrimaryBeams(s)
+    lmax = 3*s.GSMNSIDE - 1
+    transferNSIDE = 2*s.GSMNSIDE
+    GSM = GlobalSkyModel(s.freq, s.GSMlocation, s.GSMNSIDE)
+    skyAlms = hp.map2alm(GSM.hpMap, lmax=lmax) #any band-limited sky will do, so there's no need to rotate this one to equatorial coordinates
+    mModes = MModeSimulator.transferFunctionMModes(s, PBs, s.pointings[0], skyAlms, lmax, transferNSIDE)
+    mModeVisibilities = MModeSimulator.visibilitiesFromMModes(s, mModes, times.LSTs, times.integrationTime)
+    
+    #The direct sum needs a finer grid than the transfer functions to be as accurate
+    directNSIDE = 2*transferNSIDE
+    skyMap = hp.alm2map(skyAlms, directNSIDE, lmax=lmax, verbose=False)
+    thetas, phis = hp.pix2ang(directNSIDE, np.arange(len(skyMap)))
+    directVisibilities = simulateVisibilitiesOfPointLikeSky(s, PBs, times, phis, np.pi/2 - thetas, skyMap * 4*np.pi / len(skyMap))
+    print "Error = " + str(np.linalg.norm(mModeVisibilities - directVisibilities)/np.linalg.norm(directVisibilities))
+
+#Test 7: Visibilities written to small random groups uvfits files and read back by LoadVisibilities
+def TestUVFITSRoundTrip():
+    print "\nNow running uvfits round trip test..."
+    s = Specifications(mainDirectory, "configuration.txt", 150)
+    times = Geometry.Times(s)
+    times.CutOutUnusedLSTsAndGroupIntoSnapshots(s)
+    groups = RedundantBaselineGroups(s)
+    np.random.seed(0)
+    trueVisibilities = np.random.randn(len(times.LSTs), s.nBaselines) + 1j * np.random.randn(len(times.LSTs), s.nBaselines)
+
+    #Every antenna pair at every LST, in random order (so that about half are conjugated), with about 10% and all of baseline 0 flagged
+    LSTindices = np.repeat(np.arange(len(times.LSTs)), len(groups.pairs))
+    pairs = np.tile(groups.pairs, (len(times.LSTs), 1))
+    swapped = np.random.rand(len(pairs)) < .5
+    ant1, ant2 = np.where(swapped, pairs[:,1], pairs[:,0]), np.where(swapped, pairs[:,0], pairs[:,1])
+    baselineIndices, conjugate = groups.baselinesOfAntennas(ant1, ant2)
+    measuredVisibilities = np.where(conjugate, np.conj(trueVisibilities[LSTindices, baselineIndices]), trueVisibilities[LSTindices, baselineIndices])
+    flagged = (np.random.rand(len(pairs)) < .1) + (baselineIndices == 0)
+    trueInverseVariances = np.zeros((len(times.LSTs), s.nBaselines))
+    np.add.at(trueInverseVariances, (LSTindices[~flagged], baselineIndices[~flagged]), (s.noisePerAntenna[LSTindices, ant1] * s.noisePerAntenna[LSTindices, ant2])[~flagged]**(-2))
+
+    #Julian dates of the LSTs, split into whole and fractional days since float32 can't hold them
+    julianDates = 2451545.0 + (times.LSTs[LSTindices] - 18.697374558 - s.arrayLong/15.0 + 24*np.round((2457000.0 - 2451545.0) * 24.06570982441908 / 24)) / 24.06570982441908
+    data = np.zeros((len(pairs), 1, 1, 1, 1, 3))
+    data[:,0,0,0,0,0], data[:,0,0,0,0,1], data[:,0,0,0,0,2] = measuredVisibilities.real, measuredVisibilities.imag, np.where(flagged, -1.0, 1.0)
+    encodings = [("BASELINE (256*ant1 + ant2)", ['BASELINE'], [256*(ant1+1) + ant2+1]),
+                 ("BASELINE (2048*ant1 + ant2 + 65536)", ['BASELINE'], [2048*(ant1+1) + ant2+1 + 65536]),
+                 ("ANTENNA1 and ANTENNA2", ['ANTENNA1','ANTENNA2'], [ant1+1, ant2+1])]
+    for name, antennaParameters, antennaValues in encodings:
+        parameterData = [np.zeros(len(pairs))]*3 + antennaValues + [np.floor(julianDates), julianDates - np.floor(julianDates)]
+        hdu = fits.GroupsHDU(fits.GroupData(data, parnames=['UU','VV','WW'] + antennaParameters + ['DATE','DATE'], pardata=parameterData, bitpix=-32))
+        for axis, (axisName, value, increment) in enumerate([('COMPLEX',1,1), ('STOKES',uvfitsPolarizationCodes[s.uvfitsPolarization],-1), ('FREQ',s.freq*1e6,1e5), ('RA',0,1), ('DEC',0,1)]):
+            hdu.header['CTYPE' + str(axis+2)], hdu.header['CRVAL' + str(axis+2)], hdu.header['CDELT' + str(axis+2)], hdu.header['CRPIX' + str(axis+2)] = axisName, value, increment, 1.0
+        s.uvfitsFilename = os.path.join(tempfile.mkdtemp(), "roundTrip.uvfits")
+        hdu.writeto(s.uvfitsFilename)
+        visibilities, inverseVariances = LoadVisibilities(s, times)
+        measured = trueInverseVariances > 0
+        print name + ":"
+        print "    Visibility Error = " + str(np.max(np.abs(visibilities - trueVisibilities)[measured]))
+        print "    Inverse Variance Error = " + str(np.max(np.abs(inverseVariances - trueInverseVariances) / np.max(trueInverseVariances)))
+        os.remove(s.uvfitsFilename)
+        os.rmdir(os.path.dirname(s.uvfitsFilename))
+
 ###############################################################################################################################
 #   VARIOUS TESTS OF THE MAPMAKING ALGORITHM REPRODUCING DILLON ET AL. (2015) RESULTS
 ###############################################################################################################################
@@ -141,4 +218,7 @@ TestGSMOnly()
 #TestPointSourcesOnly()
 #TestErrorVsPSFext()
 #TestErrorVsIntegrations()
+#TestPSFPrecision()
+#TestMModeSimulator()
+#TestUVFITSRoundTrip()
 
@@ -0,0 +1,90 @@
+# SUPPORTING CLASS FOR JOINT MAPMAKING AND POWER SPECTRUM PIPELINE
+# by Josh Dillon
+
+import numpy as np
+import copy
+from Specifications import Specifications
+from PrimaryBeams import loadBeamStore
+from PointSourceCatalog import PointSourceCatalog
+from GlobalSkyModel import GlobalSkyModel
+import Geometry
+from VisibilitySimulator import VisibilityCubeSimulator
+
+class FrequencyIndependentInputs:
+    """Loads everything that Mapmaker needs that doesn't depend on frequency, so that it can be shared by Mapmaker runs at many frequencies.
+
+    This includes the parsed configuration and antenna files, the LSTs and snapshots, the facet and PSF coordinates, the
+    geometry of the PSF pixels and point sources at every snapshot (see Geometry.precomputeSnapshotGeometry), and the
+    beam cube, GSM components, and point source catalog needed at any of the frequencies. If visibilities are simulated with
+    the direct simulator, they are simulated at all frequencies at once (see VisibilitySimulator.VisibilityCubeSimulator). If this object is created
+    before forking, the forked processes all share it (and the loaded files) instead of loading them again.
+
+    Parameters
+    ---------------
+    mainDirectory: str
+        Directory containing the configuration file.
+    configFile: str
+        Name of the configuration file.
+    freqs: list of floats
+        Frequencies (in MHz) that Mapmaker will be run at.
+    kwargs:
+        Overrides to the specifications, as in Mapmaker.
+    """
+
+    def __init__(self, mainDirectory, configFile, freqs, **kwargs):
+        print "Now loading frequency-independent inputs for " + str(len(freqs)) + " frequencies..."
+        self.freqs = freqs
+        self.s = Specifications(mainDirectory, configFile, freqs[0])
+        self.s.OverrideSpecifications(kwargs)
+        self.times = Geometry.Times(self.s)
+        self.times.CutOutUnusedLSTsAndGroupIntoSnapshots(self.s)
+        self.coords = Geometry.Coordinates(self.s)
+        if self.s.useAdaptiveHEALPixForPSF: self.coords.convertToAdaptiveHEALPix(self.s, self.times)
+
+        #Load every file that any of the frequencies will need
+        loadBeamStore(self.s)
+        ps = PointSourceCatalog(self.s, self.times)
+        self.nSources = ps.nSources
+        Geometry.precomputeSnapshotGeometry(self.s, self.times, self.coords, ps)
+        if self.s.simulateVisibilitiesWithGSM:
+            GlobalSkyModel(freqs[0], self.s.GSMlocation, self.s.GSMNSIDE)
+        self.visibilityCube = None
+        if (self.s.simulateVisibilitiesWithGSM or self.s.simulateVisibilitiesWithPointSources) and self.s.visibilitySimulator == "direct":
+            self.visibilityCube = VisibilityCubeSimulator(self.s, freqs, self.times, ps)
+            self.simulatedPointSourceIndices = ps.catalogIndices
+
+    def specificationsAtFrequency(self, freq, overrides = {}):
+        """Returns a copy of the shared specifications at another frequency. Only the frequency-dependent quantities (like the noise) are recalculated."""
+        s = copy.copy(self.s)
+        s.freq = freq
+        s.resultsFolder = s.resultsFolderFormat + "{:.3f}".format(freq) + "/"
+        s.OverrideSpecifications(overrides)
+        s.noisePerAntenna = self.times.selectUsedLSTs(s.noisePerAntenna)
+        return s
+
+    def simulatedVisibilitiesAtFrequency(self, freq, ps):
+        """Returns a copy of the simulated [LST, baseline] visibilities at freq, or None if they weren't simulated ahead of time
+        or were simulated with point sources other than those in ps (e.g. because of an override at this frequency)."""
+        if self.visibilityCube is None or np.min(np.abs(np.asarray(self.freqs) - freq)) > 1e-9:
+            return None
+        if self.s.simulateVisibilitiesWithPointSources and not np.array_equal(self.simulatedPointSourceIndices, ps.catalogIndices):
+            return None
+        return np.array(self.visibilityCube[np.argmin(np.abs(np.asarray(self.freqs) - freq))])
+
+    def estimatedMapmakingMemoryInGB(self):
+        """Returns a rough estimate of the peak memory a single Mapmaker run needs, counting the visibilities, the beams and GSM,
+        the PSFs and their batches, and any snapshot workers."""
+        s = self.s
+        itemsize = 4 if s.PSFprecision == "single" else 8
+        columnsPerSnapshot = s.nBaselines * (2 if s.PSFarithmetic == "real" else 1)
+        if s.PSFarithmetic != "real": itemsize *= 2
+        nFacetPixels, nPSFPixels = self.coords.nFacetPixels, self.coords.nPSFPixels
+        PSFbytes = 8.0 * nFacetPixels * nPSFPixels
+        if s.useMemoryMappedPSF: PSFbytes = min(PSFbytes, s.PSFmemoryBudgetInGB * 1024.0**3)
+        accumulatorBytes = PSFbytes + 8.0 * nFacetPixels * (self.nSources + 1)
+        batchBytes = 1.0 * s.snapshotsPerPSFBatch * columnsPerSnapshot * (nPSFPixels + nFacetPixels + self.nSources) * itemsize
+        visibilityBytes = 3 * 16.0 * len(self.times.LSTs) * s.nBaselines #the visibilities and temporary copies while simulating and weighting them
+        beamBytes = 2 * 8.0 * 12 * s.beamNSIDE**2 * s.nPointings * len(s.antPolList) * len(s.skyPolList)
+        GSMbytes = 4 * 8.0 * 12 * s.GSMNSIDE**2 if s.simulateVisibilitiesWithGSM else 0
+        workerBytes = s.snapshotWorkers * s.snapshotWorkerMemoryInGB * 1024.0**3 if s.snapshotWorkers > 1 else 0
+        return (accumulatorBytes + batchBytes + visibilityBytes + beamBytes + GSMbytes + workerBytes) / 1024.0**3
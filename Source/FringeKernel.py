@@ -0,0 +1,61 @@
+# SUPPORTING MODULE FOR JOINT MAPMAKING AND POWER SPECTRUM PIPELINE
+# by Josh Dillon
+
+import numpy as np
+
+maximumFactorizationPhaseError = 1e-4 #radians, largest allowed |k|*|b - (x1 - x2)| for a baseline to be built from its antennas
+
+def baselineAntennaPairs(s):
+    """This function returns an [baseline, 2] array of antenna indices such that s.baselines[b] = s.antennaPositions[ant1] - s.antennaPositions[ant2].
+    For unique baselines, the lowest numbered antenna pair in s.antennaPairDict is used to represent each redundant group.
+    Returns None if the baselines cannot be reproduced from the antenna positions to within maximumFactorizationPhaseError."""
+    if s.useOnlyUniqueBaselines:
+        allPairs = np.asarray(sorted(s.antennaPairDict.keys()), dtype=int)
+        uniqueIndices = np.asarray([s.antennaPairDict[tuple(pair)] for pair in allPairs])
+        uniqueIndicesFound, firstOccurrences = np.unique(uniqueIndices, return_index=True)
+        if len(uniqueIndicesFound) != s.nBaselines or not np.array_equal(uniqueIndicesFound, np.arange(s.nBaselines)):
+            return None
+        antennaPairs = allPairs[firstOccurrences]
+    else:
+        antennaPairs = np.asarray(s.allBaselinePairs, dtype=int)
+        if len(antennaPairs) != s.nBaselines:
+            return None
+    if np.max(antennaPairs) >= s.nAntennas:
+        return None
+    deviations = s.antennaPositions[antennaPairs[:,0]] - s.antennaPositions[antennaPairs[:,1]] - s.baselines
+    if s.k * np.max(np.sum(deviations**2, axis=1)**.5) > maximumFactorizationPhaseError:
+        return None
+    return antennaPairs
+
+def antennaProjections(s, rHatVectors):
+    """This function returns rHat.x for every direction and antenna position as a [direction, antenna] array. These don't depend on frequency."""
+    return np.dot(np.atleast_2d(rHatVectors), np.transpose(s.antennaPositions))
+
+def antennaPhaseFactors(s, rHatVectors, sign = 1):
+    """This function returns e^(sign*i*|k|*rHat.x) for every direction and antenna position as a [direction, antenna] array."""
+    return np.exp(sign * 1j * s.k * antennaProjections(s, rHatVectors))
+
+def fringesFromAntennaProjections(s, antennaProjections, sign = 1, baselineIndices = slice(None)):
+    """This function returns e^(sign*i*|k|*rHat.b) for every direction and baseline (or just those in baselineIndices) as a [direction, baseline] array,
+    given the [direction, antenna] projections rHat.x from antennaProjections(). Requires s.baselineAntennaPairs."""
+    return fringesFromPhaseFactors(s, np.exp(sign * 1j * s.k * antennaProjections), baselineIndices)
+
+def fringesFromPhaseFactors(s, phaseFactors, baselineIndices = slice(None)):
+    """This function returns the fringes for every direction and baseline (or just those in baselineIndices) as a [direction, baseline] array,
+    given the [direction, antenna] phase factors from antennaPhaseFactors(). Requires s.baselineAntennaPairs."""
+    fringes = np.take(phaseFactors, s.baselineAntennaPairs[baselineIndices,0], axis=1)
+    conjugatedFactors = np.take(phaseFactors, s.baselineAntennaPairs[baselineIndices,1], axis=1)
+    np.conjugate(conjugatedFactors, out=conjugatedFactors)
+    fringes *= conjugatedFactors
+    return fringes
+
+def baselineFringes(s, rHatVectors, sign = 1, baselineIndices = slice(None)):
+    """This function returns e^(sign*i*|k|*rHat.b) for every direction and baseline (or just those in baselineIndices) as a [direction, baseline] array.
+
+    Since b = x1 - x2, each fringe is the product of one antenna's phase factor and the complex conjugate of another's,
+    so only nAntennas complex exponentials are evaluated per direction rather than nBaselines. If the baselines cannot
+    be built from the antenna positions (see baselineAntennaPairs), the exponentials are evaluated directly."""
+    rHatVectors = np.atleast_2d(rHatVectors)
+    if s.baselineAntennaPairs is None:
+        return np.exp(sign * 1j * s.k * np.dot(rHatVectors, np.transpose(s.baselines[baselineIndices])))
+    return fringesFromAntennaProjections(s, antennaProjections(s, rHatVectors), sign, baselineIndices)
@@ -4,11 +4,15 @@
 import numpy as np
 import healpy as hp
 import math
+import os
+import hashlib
+import scipy.sparse
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 import matplotlib.pyplot as plt
 from astropy.cosmology import Planck13 as cosmo
-from PrimaryBeams import PrimaryBeams
+from PrimaryBeams import PrimaryBeams, loadBeamStore
+import FringeKernel
 
 # Convert RAs and Decs in radians to altitudes and azimuths in radians, given an LST and array location in the specs object
 def convertEquatorialToHorizontal(s,RAs,decs,LST):
@@ -19,118 +23,254 @@ def convertEquatorialToHorizontal(s,RAs,decs,LST):
     return altitudes, azimuths
 
 
+def hourAngleHalfWidthsAboveAltitude(s, decs, minimumAltitude):
+    """ Returns, for each declination in radians, the largest |hour angle| in radians at which a direction is above minimumAltitude
+    (pi if it always is and -1 if it never is), so that directions below the horizon can be culled without computing their altitudes."""
+    cosHalfWidths = (np.sin(minimumAltitude) - np.sin(s.arrayLatInRad) * np.sin(decs)) / (np.cos(s.arrayLatInRad) * np.cos(decs))
+    halfWidths = np.arccos(np.clip(cosHalfWidths, -1, 1))
+    halfWidths[np.asarray(cosHalfWidths) >= 1] = -1
+    return halfWidths
+
+class HourAngleBeamTable:
+    """ Holds [freq, pixel] beams (HEALPix maps in horizontal coordinates) tabulated on a regular grid in hour angle and declination.
+    Since the array doesn't move, a direction's beam only depends on these, so the table is good for every LST and looking up a beam
+    is just a bilinear interpolation, with no coordinate conversion or HEALPix interpolation. The grid is s.beamTableOversampling times
+    finer than the beam pixels and only covers declinations that come within two beam pixels of the horizon. Other directions get no beam."""
+    def __init__(self, s, beams):
+        beams = np.atleast_2d(beams)
+        horizonMargin = 2 * hp.nside2resol(s.beamNSIDE)
+        spacing = hp.nside2resol(s.beamNSIDE) / s.beamTableOversampling
+        self.nHourAngles = int(np.ceil(2*np.pi / spacing))
+        self.hourAngleSpacing = 2*np.pi / self.nHourAngles
+        self.minimumDec = max(s.arrayLatInRad - np.pi/2 - horizonMargin, -np.pi/2)
+        maximumDec = min(s.arrayLatInRad + np.pi/2 + horizonMargin, np.pi/2)
+        self.nDecs = int(np.ceil((maximumDec - self.minimumDec) / spacing)) + 1
+        self.decSpacing = (maximumDec - self.minimumDec) / (self.nDecs - 1)
+        gridHourAngles, gridDecs = np.meshgrid(np.arange(self.nHourAngles) * self.hourAngleSpacing, self.minimumDec + np.arange(self.nDecs) * self.decSpacing)
+        gridAlts, gridAzs = convertEquatorialToHorizontal(s, -gridHourAngles.ravel(), gridDecs.ravel(), 0.0)
+        pixels, pixelWeights = hp.get_interp_weights(s.beamNSIDE, np.pi/2 - gridAlts, gridAzs)
+        self.tables = np.empty((len(beams), self.nDecs * self.nHourAngles), dtype=beams.dtype) #[freq, dec index * nHourAngles + hour angle index]
+        for f in range(len(beams)):
+            self.tables[f] = np.sum(beams[f][pixels] * pixelWeights, axis=0)
+
+    def interpolationWeights(self, hourAngles, decs):
+        """ Returns the [4, direction] table indices and bilinear interpolation weights for the given hour angles and declinations in radians."""
+        x = np.mod(hourAngles, 2*np.pi) / self.hourAngleSpacing
+        y = (np.asarray(decs) - self.minimumDec) / self.decSpacing
+        inTable = (y >= 0) * (y <= self.nDecs - 1)
+        x0 = np.floor(x).astype(int)
+        fx = x - x0
+        x0 %= self.nHourAngles #the hour angles wrap around
+        x1 = (x0 + 1) % self.nHourAngles
+        y0 = np.clip(np.floor(y).astype(int), 0, self.nDecs - 2)
+        fy = np.clip(y - y0, 0, 1)
+        indices = np.asarray([y0*self.nHourAngles + x0, y0*self.nHourAngles + x1, (y0+1)*self.nHourAngles + x0, (y0+1)*self.nHourAngles + x1])
+        weights = np.asarray([(1-fx)*(1-fy), fx*(1-fy), (1-fx)*fy, fx*fy]) * inTable
+        return indices, weights
+
+    def beamsAt(self, hourAngles, decs):
+        """ Returns the [freq, direction] beams of the given hour angles and declinations in radians."""
+        indices, weights = self.interpolationWeights(hourAngles, decs)
+        return np.sum(self.tables[:,indices] * weights, axis=1)
+
+def beamSquaredTable(s, PBs, pointing):
+    """ Returns the HourAngleBeamTable of PBs's XX beam squared at the given pointing, only making it once per frequency (see PrimaryBeams)."""
+    if pointing not in PBs.beamTables:
+        PBs.beamTables[pointing] = HourAngleBeamTable(s, PBs.beamSquared("X","x",pointing))
+    return PBs.beamTables[pointing]
+
+def beamSquaredOfDirections(s, PBs, pointing, LST, RAs, decs, alts = None, azs = None):
+    """ Returns the XX beam squared of the given directions (RAs and decs in radians) at the given LST and pointing. This is looked up
+    in the hour angle and declination table if s.beamTableOversampling > 0, and otherwise interpolated from the HEALPix beam at the
+    directions' altitudes and azimuths (which are computed if they aren't given)."""
+    if s.beamTableOversampling > 0:
+        return beamSquaredTable(s, PBs, pointing).beamsAt(np.pi/12.0*LST - np.asarray(RAs), decs)[0]
+    if alts is None or azs is None:
+        alts, azs = convertEquatorialToHorizontal(s, RAs, decs, LST)
+    return hp.get_interp_val(PBs.beamSquared("X","x",pointing), np.pi/2-alts, azs)
+
 def convertAltAzToCartesian(alts, azs):
     """ Convert list of altitudes and azimuths to cartesian coordinates."""        
     return np.transpose(np.asarray([np.sin(azs)*np.cos(alts), np.cos(azs)*np.cos(alts), np.sin(alts)]))
 
-class Coordinates:
-    """This class figures out the RA, Dec, and Galactic Coordinates of every pixel in the map where the facet center is rotated to lie on the horizon. Detaults to the map resolution, but can also be done for the GSM resolution used."""
+def rotatePixelsToFacet(facetRAinRad, facetDecinRad, NSIDE, pixelIndices):
+    """ Returns the RAs and Decs (in radians) of the given pixels in the map where the facet center is rotated to lie on the horizon at (theta, phi) = (pi/2, 0)."""
+    thetas, phis = hp.pix2ang(NSIDE, pixelIndices)
+    originalPixelDecs = -thetas + np.pi/2
+    originalPixelVectors = np.asarray([np.cos(originalPixelDecs) * np.cos(phis), np.cos(originalPixelDecs) * np.sin(phis), np.sin(originalPixelDecs)])
+    rotateToPrimeMeridian = np.array([[np.cos(facetRAinRad), -np.sin(facetRAinRad), 0], [np.sin(facetRAinRad), np.cos(facetRAinRad), 0],[0, 0, 1]])
+    rotateToEquator = np.array([[np.cos(-facetDecinRad), 0, np.sin(-facetDecinRad)], [0, 1, 0], [-np.sin(-facetDecinRad), 0, np.cos(-facetDecinRad)]])
+    rotatedVectors = np.dot(rotateToPrimeMeridian, np.dot(rotateToEquator, originalPixelVectors))
+    pixelDecs = np.arcsin(rotatedVectors[2])
+    pixelRAs = np.arctan2(rotatedVectors[1], rotatedVectors[0])
+    pixelRAs[pixelRAs < 0] = pixelRAs[pixelRAs < 0] + 2*np.pi
+    return pixelRAs, pixelDecs
+
+def loadCachedArrays(filename):
+    """ Returns a dictionary of the arrays saved by saveCachedArrays(), or None if there aren't any."""
+    if filename is None or not os.path.exists(filename):
+        return None
+    cachedArrays = np.load(filename)
+    return dict([(key, cachedArrays[key]) for key in cachedArrays.files])
+
+def saveCachedArrays(filename, **arrays):
+    """ Saves arrays to filename for loadCachedArrays(). They are written to a temporary file first, so that simultaneous runs never see a partial file."""
+    if filename is None:
+        return
+    if not os.path.exists(os.path.dirname(filename)):
+        try: os.makedirs(os.path.dirname(filename))
+        except OSError: pass #another run just made it
+    tempFilename = filename + "." + str(os.getpid()) + ".temp.npz"
+    np.savez(tempFilename, **arrays)
+    os.rename(tempFilename, filename)
+
+#Sparse galactic resampling matrices that have already been made, by (source NSIDE, hash of the directions).
+loadedResamplingMatrices = {}
+
+def galacticResamplingMatrix(s, sourceNSIDE, RAs, decs):
+    """ Returns a sparse [direction, pixel] matrix that interpolates (like hp.get_interp_val) a HEALPix map in galactic coordinates at sourceNSIDE
+    to the given RAs and Decs in radians, so that resampling any sky model at any frequency is a single sparse matrix-vector product.
+    The galactic coordinates and interpolation weights are only computed once per process for each sourceNSIDE and set of directions.
+    If s.cacheFolder is set, they are saved there and reused by later runs."""
+    RAs, decs = np.ascontiguousarray(RAs, dtype=float), np.ascontiguousarray(decs, dtype=float)
+    key = (sourceNSIDE, hashlib.md5(RAs.tostring() + decs.tostring()).hexdigest())
+    if key not in loadedResamplingMatrices:
+        cacheFilename = s.cacheFolder + "GalacticResampling_NSIDE-" + str(sourceNSIDE) + "_" + key[1] + ".npz" if s.cacheFolder else None
+        interpolation = loadCachedArrays(cacheFilename)
+        if interpolation is None:
+            galCoords = SkyCoord(frame="icrs", ra=RAs*u.rad, dec=decs*u.rad).transform_to("galactic")
+            pixels, weights = hp.get_interp_weights(sourceNSIDE, -galCoords.b.radian+np.pi/2, np.asarray(galCoords.l.radian))
+            interpolation = {'pixels': pixels, 'weights': weights}
+            saveCachedArrays(cacheFilename, **interpolation)
+        nDirections = len(RAs)
+        loadedResamplingMatrices[key] = scipy.sparse.csr_matrix((np.transpose(interpolation['weights']).ravel(), np.transpose(interpolation['pixels']).ravel(), 
+            np.arange(0, 4*nDirections + 1, 4)), shape=(nDirections, 12*sourceNSIDE**2))
+    return loadedResamplingMatrices[key]
+
+class Coordinates(object):
+    """This class figures out the RA, Dec, and Galactic Coordinates of every pixel in the map where the facet center is rotated to lie on the horizon. Detaults to the map resolution, but can also be done for the GSM resolution used.
+
+    Only the pixels in the facet and PSF are rotated when the object is made. The RAs and Decs of all pixels (pixelRAs, pixelDecs)
+    and their galactic coordinates (galCoords) are only computed if they are used. If s.cacheFolder is set, all of these are saved
+    there, keyed by NSIDE and the facet center, size, shape, and PSF extension factor, and reused by later runs."""
     def __init__(self, s, useAnotherResolution = None):
         if useAnotherResolution is not None:
             self.NSIDE = useAnotherResolution
         else:
             self.NSIDE = s.mapNSIDE
         self.mapPixels = 12 * self.NSIDE**2
-
-        healpixCoords = np.transpose(np.asarray(hp.pix2ang(self.NSIDE,np.arange(self.mapPixels))))                
-        originalPixelRAs = healpixCoords[:,1]
-        originalPixelDecs = -healpixCoords[:,0] + np.pi/2
-        #originalGalCoords = SkyCoord(frame="icrs", ra=originalPixelRAs*u.rad, dec=originalPixelDecs*u.rad).transform_to("galactic")                
-        originalPixelVectors = [ np.array([np.cos(originalPixelDecs[n]) * np.cos(originalPixelRAs[n]), np.cos(originalPixelDecs[n]) * np.sin(originalPixelRAs[n]), np.sin(originalPixelDecs[n])]) for n in range(self.mapPixels)]
-        
-        rotateToPrimeMeridian = np.array([[np.cos(s.facetRAinRad), -np.sin(s.facetRAinRad), 0], [np.sin(s.facetRAinRad), np.cos(s.facetRAinRad), 0],[0, 0, 1]])
-        rotateToEquator = np.array([[np.cos(-s.facetDecinRad), 0, np.sin(-s.facetDecinRad)], [0, 1, 0], [-np.sin(-s.facetDecinRad), 0, np.cos(-s.facetDecinRad)]])
-        rotatedVectors = [np.dot(rotateToPrimeMeridian, np.dot(rotateToEquator,originalPixelVectors[n])) for n in range(self.mapPixels)]
-        
-        self.pixelDecs = np.asarray([np.arcsin(rotatedVectors[n][2]) for n in range(self.mapPixels)])
-        self.pixelRAs = np.asarray([np.arctan2(rotatedVectors[n][1],rotatedVectors[n][0]) for n in range(self.mapPixels)])
-        self.pixelRAs[self.pixelRAs < 0] = self.pixelRAs[self.pixelRAs < 0] + 2*np.pi
-        self.galCoords = SkyCoord(frame="icrs", ra=self.pixelRAs*u.rad, dec=self.pixelDecs*u.rad).transform_to("galactic")                
-        
-        if s.SquareFacetInRADec:
-            deltaDecs = np.abs(self.pixelDecs - s.facetDecinRad)     
-            deltaRAs = np.minimum(np.minimum(np.abs(self.pixelRAs - s.facetRAinRad), np.abs(self.pixelRAs - s.facetRAinRad + 2*np.pi)), np.abs(self.pixelRAs - s.facetRAinRad - 2*np.pi))
-            self.facetIndices = np.flatnonzero((deltaDecs <= s.facetSize * 2*np.pi/360.0/2.0) * (deltaRAs <= s.facetSize * 2*np.pi/360.0/2.0/np.cos(s.facetDecinRad)))
-            PSFIndices = np.nonzero((deltaDecs <= s.PSFextensionBeyondFacetFactor*s.facetSize * 2*np.pi/360.0/2.0) * (deltaRAs <= s.PSFextensionBeyondFacetFactor*s.facetSize * 2*np.pi/360.0/2.0/np.cos(s.facetDecinRad)))[0]
+        self.facetRAinRad, self.facetDecinRad = s.facetRAinRad, s.facetDecinRad
+        self._pixelRAs, self._pixelDecs, self._galCoords = None, None, None
+        if s.cacheFolder:
+            self.cachePrefix = s.cacheFolder + "Coordinates_NSIDE-" + str(self.NSIDE) + "_RA-" + "{:.6f}".format(s.facetRA) + "_Dec-" + "{:.6f}".format(s.facetDec)
+            regionCacheFilename = self.cachePrefix + "_size-" + "{:.6f}".format(s.facetSize) + "_ext-" + "{:.6f}".format(s.PSFextensionBeyondFacetFactor) + ("_square" if s.SquareFacetInRADec else "_disc") + ".npz"
         else:
-            self.facetIndices = hp.query_disc(self.NSIDE, hp.ang2vec(np.pi/2, 0), s.facetSize * 2*np.pi/360.0)
-            PSFIndices = hp.query_disc(self.NSIDE, hp.ang2vec(np.pi/2, 0), s.facetSize * 2*np.pi/360.0 * s.PSFextensionBeyondFacetFactor)        
+            self.cachePrefix, regionCacheFilename = None, None
+        
+        region = loadCachedArrays(regionCacheFilename)
+        if region is None:
+            region = self.findFacetAndPSFPixels(s)
+            saveCachedArrays(regionCacheFilename, **region)
+        self.facetIndices = region['facetIndices']
+        PSFIndices = region['PSFIndices']
         self.nFacetPixels = len(self.facetIndices)
         self.nPSFPixels = len(PSFIndices)
         
-        self.facetRAs = self.pixelRAs[self.facetIndices]
-        self.PSFRAs = self.pixelRAs[PSFIndices]
-        self.facetDecs = self.pixelDecs[self.facetIndices]
-        self.PSFDecs = self.pixelDecs[PSFIndices]        
+        regionLocations = np.searchsorted(region['regionIndices'], self.facetIndices)
+        self.facetRAs = region['regionRAs'][regionLocations]
+        self.facetDecs = region['regionDecs'][regionLocations]
+        regionLocations = np.searchsorted(region['regionIndices'], PSFIndices)
+        self.PSFRAs = region['regionRAs'][regionLocations]
+        self.PSFDecs = region['regionDecs'][regionLocations]
         
         PSFIndexDict = dict([ (PSFIndices[i], i) for i in range(self.nPSFPixels) ])
         self.facetIndexLocationsInPSFIndexList = np.asarray([PSFIndexDict[mapIndex] for mapIndex in self.facetIndices])
         self.facetIndexOfFacetCenter = np.dot(self.facetIndices ==  hp.ang2pix(self.NSIDE,np.pi/2,0.0),np.arange(len(self.facetIndices)))
         self.PSFIndexOfFacetCenter = np.dot(PSFIndices ==  hp.ang2pix(self.NSIDE,np.pi/2,0.0),np.arange(len(PSFIndices)))
-        
     
-    def convertToAdaptiveHEALPix(self, s, times):
-        #figure out the primary beam weights for all pixels in the full-resolution map        
-        middleLSTindex = int(math.floor(len(times.LSTs)/2.0))
-        pixelAlts, pixelAzs = convertEquatorialToHorizontal(s, self.pixelRAs, self.pixelDecs, times.LSTs[middleLSTindex])
-        PBs = PrimaryBeams(s, freq=s.adaptiveHEALPixReferenceFreq)        
-        primaryBeamWeightsAtReferenceFreq = hp.get_interp_val(PBs.beamSquared("X","x",s.pointings[middleLSTindex]), np.pi/2-pixelAlts, pixelAzs)
+    def findFacetAndPSFPixels(self, s):
+        """ Returns the map indices of the facet and PSF pixels and the RAs and Decs of all the pixels in either one, rotating only the pixels near the facet."""
+        facetCenterVector = hp.ang2vec(np.pi/2, 0)
+        if s.SquareFacetInRADec:
+            #Every pixel in the square is within halfWidth in Dec and halfWidth/cos(facetDec) in RA of the facet center, which bounds its angular distance
+            halfWidth = max(s.PSFextensionBeyondFacetFactor, 1) * s.facetSize * 2*np.pi/360.0/2.0
+            candidateIndices = np.sort(hp.query_disc(self.NSIDE, facetCenterVector, min(np.pi, halfWidth * (1 + 1/np.abs(np.cos(s.facetDecinRad)))), inclusive=True))
+            candidateRAs, candidateDecs = rotatePixelsToFacet(s.facetRAinRad, s.facetDecinRad, self.NSIDE, candidateIndices)
+            deltaDecs = np.abs(candidateDecs - s.facetDecinRad)     
+            deltaRAs = np.minimum(np.minimum(np.abs(candidateRAs - s.facetRAinRad), np.abs(candidateRAs - s.facetRAinRad + 2*np.pi)), np.abs(candidateRAs - s.facetRAinRad - 2*np.pi))
+            facetIndices = candidateIndices[(deltaDecs <= s.facetSize * 2*np.pi/360.0/2.0) * (deltaRAs <= s.facetSize * 2*np.pi/360.0/2.0/np.cos(s.facetDecinRad))]
+            PSFIndices = candidateIndices[(deltaDecs <= s.PSFextensionBeyondFacetFactor*s.facetSize * 2*np.pi/360.0/2.0) * (deltaRAs <= s.PSFextensionBeyondFacetFactor*s.facetSize * 2*np.pi/360.0/2.0/np.cos(s.facetDecinRad))]
+        else:
+            facetIndices = hp.query_disc(self.NSIDE, facetCenterVector, s.facetSize * 2*np.pi/360.0)
+            PSFIndices = hp.query_disc(self.NSIDE, facetCenterVector, s.facetSize * 2*np.pi/360.0 * s.PSFextensionBeyondFacetFactor)        
+        regionIndices = np.union1d(facetIndices, PSFIndices)
+        regionRAs, regionDecs = rotatePixelsToFacet(s.facetRAinRad, s.facetDecinRad, self.NSIDE, regionIndices)
+        return {'facetIndices': facetIndices, 'PSFIndices': PSFIndices, 'regionIndices': regionIndices, 'regionRAs': regionRAs, 'regionDecs': regionDecs}
+    
+    def loadOrComputeAllPixelCoordinates(self):
+        """ Computes (or loads from the cache) the RAs and Decs of every pixel in the map."""
+        cacheFilename = self.cachePrefix + "_allPixels.npz" if self.cachePrefix is not None else None
+        allPixels = loadCachedArrays(cacheFilename)
+        if allPixels is None:
+            pixelRAs, pixelDecs = rotatePixelsToFacet(self.facetRAinRad, self.facetDecinRad, self.NSIDE, np.arange(self.mapPixels))
+            allPixels = {'pixelRAs': pixelRAs, 'pixelDecs': pixelDecs}
+            saveCachedArrays(cacheFilename, **allPixels)
+        if self._pixelRAs is None: self._pixelRAs = allPixels['pixelRAs']
+        if self._pixelDecs is None: self._pixelDecs = allPixels['pixelDecs']
+    
+    @property
+    def pixelRAs(self):
+        if self._pixelRAs is None: self.loadOrComputeAllPixelCoordinates()
+        return self._pixelRAs
 
-        averageBeamInFacet = np.min(primaryBeamWeightsAtReferenceFreq[self.facetIndices])
-        idealNSIDEs = s.mapNSIDE * ((primaryBeamWeightsAtReferenceFreq / averageBeamInFacet)**.5)**s.adaptiveHEALPixBeamPowerScaling
-         
-        #Determine the goal resolution for every pixel in the full-resolution sky 
-        self.finalNSIDEs = hp.reorder(idealNSIDEs, r2n=True)
-        thisRes = s.adaptiveHEALPixMinNSIDE
-        resAlreadySet = np.zeros(len(self.finalNSIDEs), dtype=bool)
-        self.newPSFRAs = []
-        self.newPSFDecs = []
-        self.newPSFNSIDEs = []
-        self.newPSFIndices = -100 * np.ones(len(self.finalNSIDEs), dtype=int) #this quatity is a full-res map that tells which adaptive pixel index covers it. One to one but not onto.
-        while thisRes < s.mapNSIDE:
-            reshapedNSIDEs = np.reshape(self.finalNSIDEs, (12*thisRes**2, -1))
-            reshapedResAlreadySet = np.reshape(resAlreadySet, (12*thisRes**2, -1))
-            reshapedNewPSFIndices = np.reshape(self.newPSFIndices, (12*thisRes**2, -1))
-            thisResCoords = Coordinates(s, useAnotherResolution = thisRes)
-            thisResCoords.pixelRAs = hp.reorder(thisResCoords.pixelRAs, r2n=True) 
-            thisResCoords.pixelDecs = hp.reorder(thisResCoords.pixelDecs, r2n =True)
-            for thisPix in range(12*thisRes**2):
-                if np.all(reshapedNSIDEs[thisPix,:] < thisRes) and not np.all(reshapedResAlreadySet[thisPix,:]):
-                    reshapedNSIDEs[thisPix,:].fill(thisRes)
-                    reshapedResAlreadySet[thisPix,:].fill(True)
-                    #adds new pixel RAs and Decs when the correct resolution has been found
-                    self.newPSFRAs.append(thisResCoords.pixelRAs[thisPix]) 
-                    self.newPSFDecs.append(thisResCoords.pixelDecs[thisPix])
-                    self.newPSFNSIDEs.append(thisRes)
-                    reshapedNewPSFIndices[thisPix,:].fill(len(self.newPSFRAs)-1)
-            #update changed sections
-            self.finalNSIDES = reshapedNSIDEs.flatten()
-            self.resAlreadySet = reshapedResAlreadySet.flatten()
-            self.newPSFIndices = reshapedNewPSFIndices.flatten()
-            thisRes *= 2
-        
-        self.finalNSIDEs[np.logical_not(resAlreadySet)] = s.mapNSIDE #all other pixels get mapNSIDE
-        self.finalNSIDEs = hp.reorder(self.finalNSIDEs, n2r=True)
-        self.newPSFIndices = hp.reorder(self.newPSFIndices, n2r=True)
-        self.finalNSIDEs[self.facetIndices] = -1 #flag to make sure facet is at the right resolution
-        
- 
-        #Combine the unmodified PSF coordinates and the new ones, the facet pixels always come first and in order
-        self.PSFRAs = np.append(self.pixelRAs[self.facetIndices], np.append(self.pixelRAs[self.finalNSIDEs == s.mapNSIDE], np.asarray(self.newPSFRAs)))
-        self.PSFDecs = np.append(self.pixelDecs[self.facetIndices], np.append(self.pixelDecs[self.finalNSIDEs == s.mapNSIDE], np.asarray(self.newPSFDecs)))
-        self.newPSFNSIDEs = np.append(s.mapNSIDE * np.ones(self.nFacetPixels + np.sum(self.finalNSIDEs == s.mapNSIDE)), np.asarray(self.newPSFNSIDEs))
-      
-        self.newPSFIndices += len(self.pixelRAs[self.finalNSIDEs == s.mapNSIDE])
-        self.newPSFIndices[self.finalNSIDEs == s.mapNSIDE] = np.arange(len(self.pixelRAs[self.finalNSIDEs == s.mapNSIDE]))
-        self.newPSFIndices += len(self.pixelRAs[self.facetIndices])
-        self.newPSFIndices[self.facetIndices] = np.arange(len(self.pixelRAs[self.facetIndices]))
-        
-        self.finalNSIDEs[self.facetIndices] = s.mapNSIDE #remove flags               
-        #newPSFNSIDEs has len(PSF) when finalNSIDEs has len(mapPixels)  
-        
+    @pixelRAs.setter
+    def pixelRAs(self, pixelRAs):
+        self._pixelRAs = pixelRAs
+    
+    @property
+    def pixelDecs(self):
+        if self._pixelDecs is None: self.loadOrComputeAllPixelCoordinates()
+        return self._pixelDecs
 
+    @pixelDecs.setter
+    def pixelDecs(self, pixelDecs):
+        self._pixelDecs = pixelDecs
+    
+    @property
+    def galCoords(self):
+        """ Galactic coordinates of every pixel in the map, as an astropy SkyCoord."""
+        if self._galCoords is None:
+            cacheFilename = self.cachePrefix + "_galactic.npz" if self.cachePrefix is not None else None
+            galactic = loadCachedArrays(cacheFilename)
+            if galactic is None:
+                galCoords = SkyCoord(frame="icrs", ra=self.pixelRAs*u.rad, dec=self.pixelDecs*u.rad).transform_to("galactic")
+                galactic = {'l': galCoords.l.radian, 'b': galCoords.b.radian}
+                saveCachedArrays(cacheFilename, **galactic)
+            self._galCoords = SkyCoord(frame="galactic", l=galactic['l']*u.rad, b=galactic['b']*u.rad)
+        return self._galCoords
         
-        
+    
+    def convertToAdaptiveHEALPix(self, s, times):
+        """Replaces the PSF pixels with an adaptive HEALPix pixelization, where pixels far from the facet (where the primary beam at
+        s.adaptiveHEALPixReferenceFreq is small) are merged into coarser pixels. If s.cacheFolder is set, the pixelization is saved there,
+        keyed by the facet, the reference frequency and beam power scaling, the LST and pointing that the beam is evaluated at, the array location,
+        and the beam files (by their BeamStore key)."""
+        middleLSTindex = int(math.floor(len(times.LSTs)/2.0))
+        if self.cachePrefix is not None:
+            cacheFilename = self.cachePrefix + "_size-" + "{:.6f}".format(s.facetSize) + ("_square" if s.SquareFacetInRADec else "_disc") + "_adaptive_minNSIDE-" + str(s.adaptiveHEALPixMinNSIDE) + "_refFreq-" + "{:.6f}".format(s.adaptiveHEALPixReferenceFreq) + "_scaling-" + "{:.6f}".format(s.adaptiveHEALPixBeamPowerScaling) + "_LST-" + "{:.6f}".format(times.LSTs[middleLSTindex]) + "_pointing-" + str(s.pointings[middleLSTindex]) + "_lat-" + "{:.6f}".format(s.arrayLat) + "_long-" + "{:.6f}".format(s.arrayLong) + "_beams-" + loadBeamStore(s).key + ".npz"
+        else:
+            cacheFilename = None
+        pixelization = loadCachedArrays(cacheFilename)
+        if pixelization is None:
+            pixelization = self.buildAdaptiveHEALPix(s, times.LSTs[middleLSTindex], s.pointings[middleLSTindex])
+            saveCachedArrays(cacheFilename, **pixelization)
+        self.finalNSIDEs = pixelization['finalNSIDEs']
+        self.newPSFIndices = pixelization['newPSFIndices']
+        self.newPSFRAs = pixelization['newPSFRAs']
+        self.newPSFDecs = pixelization['newPSFDecs']
+        self.newPSFNSIDEs = pixelization['newPSFNSIDEs']
+        self.PSFRAs = pixelization['PSFRAs']
+        self.PSFDecs = pixelization['PSFDecs']
         
         #Update other class items:
         self.nPSFPixels = len(self.PSFRAs)
@@ -144,6 +284,54 @@ class Coordinates:
             self.facetIndexLocationsInPSFIndexList = np.arange(self.nFacetPixels)
             self.facetIndices = []
 
+    def buildAdaptiveHEALPix(self, s, LST, pointing):
+        """Returns the adaptive HEALPix pixelization as a dictionary of arrays. The facet pixels always come first and in order,
+        followed by the other full-resolution pixels and then the coarser pixels from coarsest to finest.
+        
+        In nested ordering, each pixel at a coarser resolution covers a contiguous block of full-resolution pixels. Going from
+        adaptiveHEALPixMinNSIDE up to mapNSIDE, every block where all the pixels want a lower resolution (and that isn't already
+        covered by a coarser pixel) becomes a single PSF pixel."""
+        #figure out the primary beam weights for all pixels in the full-resolution map        
+        pixelAlts, pixelAzs = convertEquatorialToHorizontal(s, self.pixelRAs, self.pixelDecs, LST)
+        PBs = PrimaryBeams(s, freq=s.adaptiveHEALPixReferenceFreq)        
+        primaryBeamWeightsAtReferenceFreq = hp.get_interp_val(PBs.beamSquared("X","x",pointing), np.pi/2-pixelAlts, pixelAzs)
+        averageBeamInFacet = np.min(primaryBeamWeightsAtReferenceFreq[self.facetIndices])
+        idealNSIDEs = hp.reorder(s.mapNSIDE * ((primaryBeamWeightsAtReferenceFreq / averageBeamInFacet)**.5)**s.adaptiveHEALPixBeamPowerScaling, r2n=True)
+         
+        #Determine the goal resolution for every pixel in the full-resolution sky (in nested ordering)
+        finalNSIDEs = s.mapNSIDE * np.ones(self.mapPixels) #all pixels not covered by coarser pixels get mapNSIDE
+        resAlreadySet = np.zeros(self.mapPixels, dtype=bool)
+        newPSFIndices = -100 * np.ones(self.mapPixels, dtype=int) #this quatity is a full-res map that tells which adaptive pixel index covers it. One to one but not onto.
+        newPSFRAs, newPSFDecs, newPSFNSIDEs = [], [], []
+        thisRes = s.adaptiveHEALPixMinNSIDE
+        while thisRes < s.mapNSIDE:
+            nBlocks = 12*thisRes**2
+            newPixels = np.flatnonzero(np.all(np.reshape(idealNSIDEs, (nBlocks, -1)) < thisRes, axis=1) * np.logical_not(np.all(np.reshape(resAlreadySet, (nBlocks, -1)), axis=1)))
+            np.reshape(finalNSIDEs, (nBlocks, -1))[newPixels,:] = thisRes
+            np.reshape(resAlreadySet, (nBlocks, -1))[newPixels,:] = True
+            np.reshape(newPSFIndices, (nBlocks, -1))[newPixels,:] = (len(newPSFNSIDEs) + np.arange(len(newPixels)))[:,np.newaxis]
+            thisResRAs, thisResDecs = rotatePixelsToFacet(self.facetRAinRad, self.facetDecinRad, thisRes, hp.nest2ring(thisRes, newPixels))
+            newPSFRAs = np.append(newPSFRAs, thisResRAs)
+            newPSFDecs = np.append(newPSFDecs, thisResDecs)
+            newPSFNSIDEs = np.append(newPSFNSIDEs, thisRes * np.ones(len(newPixels)))
+            thisRes *= 2
+        finalNSIDEs = hp.reorder(finalNSIDEs, n2r=True)
+        newPSFIndices = hp.reorder(newPSFIndices, n2r=True)
+        
+        #Combine the unmodified PSF coordinates and the new ones, the facet pixels always come first and in order
+        finalNSIDEs[self.facetIndices] = -1 #flag to make sure facet is at the right resolution
+        fullResolutionPixels = np.flatnonzero(finalNSIDEs == s.mapNSIDE)
+        PSFRAs = np.append(self.pixelRAs[self.facetIndices], np.append(self.pixelRAs[fullResolutionPixels], newPSFRAs))
+        PSFDecs = np.append(self.pixelDecs[self.facetIndices], np.append(self.pixelDecs[fullResolutionPixels], newPSFDecs))
+        newPSFNSIDEs = np.append(s.mapNSIDE * np.ones(self.nFacetPixels + len(fullResolutionPixels)), newPSFNSIDEs)
+        newPSFIndices += len(fullResolutionPixels)
+        newPSFIndices[fullResolutionPixels] = np.arange(len(fullResolutionPixels))
+        newPSFIndices += len(self.facetIndices)
+        newPSFIndices[self.facetIndices] = np.arange(len(self.facetIndices))
+        finalNSIDEs[self.facetIndices] = s.mapNSIDE #remove flags               
+        #newPSFNSIDEs has len(PSF) when finalNSIDEs has len(mapPixels)  
+        return {'finalNSIDEs': finalNSIDEs, 'newPSFIndices': newPSFIndices, 'newPSFRAs': newPSFRAs, 'newPSFDecs': newPSFDecs, 'newPSFNSIDEs': newPSFNSIDEs, 'PSFRAs': PSFRAs, 'PSFDecs': PSFDecs}
+
         
     def computeCubeCoordinates(self,s,freqs):
         """ Given a range of frequencies, this function calculates the coordinates of each voxel in cMpc as a function of [freq,pixelIndex] and other useful quantities."""
@@ -165,15 +353,74 @@ class Snapshot:
         self.LSTs = times.LSTs[LSTindices]
         self.centralLSTIndex = LSTindices[int(round(len(self.LSTindices)/2.0 - .5))]
         self.centralLST = times.LSTs[self.centralLSTIndex]
+        self.PSFGeometry = None #set by precomputeSnapshotGeometry()
+        self.pointSourceGeometry = None
+
+    def __getstate__(self):
+        """Precomputed geometry is left out when pickling, since it can be large and is easy to recompute."""
+        state = self.__dict__.copy()
+        state['PSFGeometry'] = None
+        state['pointSourceGeometry'] = None
+        return state
+
+class SnapshotGeometry:
+    """ This class has the frequency-independent geometry of a set of directions (e.g. PSF pixels) at a snapshot's central LST:
+    their altitudes and azimuths and their projections onto the antenna positions. Only the |k| scaling and the beam change with frequency.
+    The directions are kept too (by reference, so snapshots sharing them don't copy them), so that it's only reused for the same ones."""
+    def __init__(self, s, snapshot, RAs, decs):
+        self.RAs, self.decs = RAs, decs
+        self.alts, self.azs = convertEquatorialToHorizontal(s, RAs, decs, snapshot.centralLST)
+        self.rHatVectors = convertAltAzToCartesian(self.alts, self.azs)
+        self.antennaProjections = FringeKernel.antennaProjections(s, self.rHatVectors)
+
+    def isFor(self, RAs, decs):
+        """Returns True if this geometry was computed for the given directions."""
+        return (self.RAs is RAs and self.decs is decs) or (np.array_equal(self.RAs, RAs) and np.array_equal(self.decs, decs))
+
+    def baselineFringes(self, s, sign = 1, directionIndices = slice(None)):
+        """Returns e^(sign*i*|k|*rHat.b) at s.freq for every direction (or just those in directionIndices) and baseline, as in FringeKernel.baselineFringes()."""
+        if s.baselineAntennaPairs is None:
+            return FringeKernel.baselineFringes(s, self.rHatVectors[directionIndices], sign)
+        return FringeKernel.fringesFromAntennaProjections(s, self.antennaProjections[directionIndices], sign)
+
+def PSFGeometry(s, snapshot, coords):
+    """Returns the snapshot's geometry for the PSF pixels, using the precomputed one if there is one for the same pixels."""
+    geometry = getattr(snapshot, 'PSFGeometry', None)
+    if geometry is not None and geometry.isFor(coords.PSFRAs, coords.PSFDecs):
+        return geometry
+    return SnapshotGeometry(s, snapshot, coords.PSFRAs, coords.PSFDecs)
+
+def pointSourceGeometry(s, snapshot, ps):
+    """Returns the snapshot's geometry for the point sources, using the precomputed one if there is one for the same sources."""
+    geometry = getattr(snapshot, 'pointSourceGeometry', None)
+    if geometry is not None and geometry.isFor(ps.RAs, ps.decs):
+        return geometry
+    return SnapshotGeometry(s, snapshot, ps.RAs, ps.decs)
+
+def precomputeSnapshotGeometry(s, times, coords, ps):
+    """This function computes the geometry of the PSF pixels and point sources for every snapshot once, so that runs at many
+    frequencies can share it. Returns False (without doing anything) if it would take more than s.snapshotGeometryMemoryInGB."""
+    nDirections = coords.nPSFPixels + ps.nSources
+    bytesNeeded = 8.0 * len(times.snapshots) * nDirections * (2 + 3 + s.nAntennas)
+    if bytesNeeded > s.snapshotGeometryMemoryInGB * 1024.0**3:
+        print "\nWARNING: Precomputing the snapshot geometry would take " + str(round(bytesNeeded / 1024.0**3,2)) + " GB. It will be computed separately at each frequency.\n"
+        return False
+    for snapshot in times.snapshots:
+        snapshot.PSFGeometry = SnapshotGeometry(s, snapshot, coords.PSFRAs, coords.PSFDecs)
+        if ps.nSources > 0:
+            snapshot.pointSourceGeometry = SnapshotGeometry(s, snapshot, ps.RAs, ps.decs)
+    return True
 
 class Times:
     """ This class contains information about the integration and snapshot LSTs. """
     def __init__(self, s):   
         self.LSTs = np.loadtxt(s.LSTsFilename)
+        self.originalLSTIndices = np.arange(len(self.LSTs)) #where each LST came from in the LST file, so that other data by LST can be selected the same way
         self.integrationTime = np.median(self.LSTs[1:] - self.LSTs[0:len(self.LSTs)-1]) * 60 * 60
         LSTrange = self.LSTs[-1]*360.0/24 - self.LSTs[0]*360.0/24
         if np.abs(s.facetRA - self.LSTs[0]*360.0/24) < LSTrange/4 or np.abs(s.facetRA - self.LSTs[-1]*360.0/24) < LSTrange/4: #this fixes the problem when the facet center is near RA=0
             self.LSTs = np.fft.fftshift(self.LSTs)
+            self.originalLSTIndices = np.fft.fftshift(self.originalLSTIndices)
             s.pointings = np.fft.fftshift(s.pointings, axes=0) #only shifts along the LST axis, not the antenna axis
             s.noisePerAntenna = np.fft.fftshift(s.noisePerAntenna, axes=0) #only shifts along the LST axis, not the antenna axis
         self.useThisLST = np.ones(len(self.LSTs))
@@ -200,6 +447,7 @@ class Times:
         self.useThisLST = np.zeros(len(self.LSTs))
         self.useThisLST[LSTindicesToUse] = True
         self.LSTs = self.LSTs[self.useThisLST == True]
+        self.originalLSTIndices = self.originalLSTIndices[self.useThisLST == True]
         s.pointings = s.pointings[self.useThisLST == True]
         s.noisePerAntenna = s.noisePerAntenna[self.useThisLST == True]
             
@@ -208,17 +456,20 @@ class Times:
         self.snapshots = [Snapshot(self, LSTgroup) for LSTgroup in LSTindicesGrouped]        
         print "Observations of " + str(closeEnoughLSTs) + " LSTs are within " + str(s.MaximumAllowedAngleFromFacetCenterToPointingCenter) + " degrees of the facet center."
         print "They are broken up into " + str(len(self.snapshots)) + " snapshots of exactly " + str(s.integrationsPerSnapshot * self.integrationTime) + " seconds.\n" + str(closeEnoughLSTs - len(self.LSTs)) + " integration(s) were discarded in snapshotting."
+
+    def selectUsedLSTs(self, dataByLST):
+        """Reorders and cuts an array indexed by LST (in the order of the LST file) along its first axis the same way the LSTs were, e.g. the noise at another frequency."""
+        return dataByLST[self.originalLSTIndices]
     
-def rephaseVisibilitiesToSnapshotCenter(s,visibilities,times):
-    """This function steps through the snapshots and rephases all the visibilities to the facet center of central LST of the snapshot."""
-    for snapshot in times.snapshots:
-        centralLSTAlt, centralLSTaz = convertEquatorialToHorizontal(s,s.facetRAinRad,s.facetDecinRad,snapshot.centralLST)
-        centralSnapshotFacetCenterVector = convertAltAzToCartesian(centralLSTAlt, centralLSTaz)        
-        for t in range(len(snapshot.LSTs)):
-            thisLSTAlt, thisLSTaz = convertEquatorialToHorizontal(s,s.facetRAinRad,s.facetDecinRad,snapshot.LSTs[t])
-            deltaTheta = centralSnapshotFacetCenterVector - convertAltAzToCartesian(thisLSTAlt, thisLSTaz)
-            rephaseFactors = np.exp(-1j * s.k * s.baselines.dot(deltaTheta))
-            visibilities[snapshot.LSTindices[t],:] = visibilities[snapshot.LSTindices[t],:] * rephaseFactors
+def rephasingFringes(s, times, snapshots):
+    """This function returns the [LST, baseline] fringes that rephase the visibilities at all the LSTs of the given snapshots (in order) to the
+    facet center at the central LST of their snapshot. The facet center is found at every LST at once, rather than snapshot by snapshot."""
+    LSTindices = np.concatenate([snapshot.LSTindices for snapshot in snapshots])
+    snapshotOfLSTs = np.repeat(np.arange(len(snapshots)), [len(snapshot.LSTindices) for snapshot in snapshots])
+    centralLSTAlts, centralLSTazs = convertEquatorialToHorizontal(s,s.facetRAinRad,s.facetDecinRad,np.asarray([snapshot.centralLST for snapshot in snapshots]))
+    theseLSTAlts, theseLSTazs = convertEquatorialToHorizontal(s,s.facetRAinRad,s.facetDecinRad,times.LSTs[LSTindices])
+    deltaThetas = convertAltAzToCartesian(centralLSTAlts, centralLSTazs)[snapshotOfLSTs] - convertAltAzToCartesian(theseLSTAlts, theseLSTazs)
+    return FringeKernel.baselineFringes(s, deltaThetas, -1)
 
 
 #if __name__ == "__main__":
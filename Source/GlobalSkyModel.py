@@ -3,14 +3,24 @@
 
 import numpy as np
 import healpy as hp
+import os
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
 
+#GSM component maps that have already been loaded, by (GSMlocation, GSMNSIDE). Loading them before forking lets many processes share them.
+loadedComponents = {}
+
+#Cubic spline fits to components.dat that have already been made, by GSMlocation.
+loadedSplines = {}
+
+#GSM pyramids that have already been loaded, by GSMlocation.
+loadedPyramids = {}
+
 class GlobalSkyModel:
-    """Computes GSM from 3 principal components appropriately weighted. 
+    """Computes GSM from 3 principal components appropriately weighted.
 
     Takes the frequency (in MHz), the location of the HEALPIX .fits files (which are in my github under ObservationData/GSM), and the HealPIX NSIDE desired.
-    
+
     Parameters
     ---------------
     freq: float
@@ -18,19 +28,134 @@ class GlobalSkyModel:
     GSMlocation: str
         Path to GSM .fits and components.dat files.
     GSMNSIDE: int
-        Power of 2 between 8 and 512.
-        
+        Power of 2. If there are no component maps at this NSIDE, they are regraded from the nearest finer ones.
+
     Class Members
     ----------
     hpMap: numpy array
         Healpix map of the GSM in galactic coordinates
     """
-    
+
     def __init__(self,freq,GSMlocation,GSMNSIDE):
         self.freq = freq
-        self.NSIDE = GSMNSIDE        
-        GSMComponentsDegraded = np.asarray([np.load(GSMlocation + "component_maps_408locked_NSIDE-" + str(GSMNSIDE) + "_Comp-" + str(comp) + ".npy") for comp in range(3)])
+        self.NSIDE = GSMNSIDE
+        self.hpMap = GSMCube([freq], GSMlocation, GSMNSIDE)[0]
+
+def componentFilename(GSMlocation, GSMNSIDE, comp):
+    """This function returns the name of the .npy file (made by GSM_Degrader.py) with the given component map at the given NSIDE."""
+    return GSMlocation + "component_maps_408locked_NSIDE-" + str(GSMNSIDE) + "_Comp-" + str(comp) + ".npy"
+
+def pyramidFilename(GSMlocation):
+    """This function returns the name of the .npy file (made by GSM_Degrader.py or buildGSMPyramid) with the component maps at every NSIDE."""
+    return GSMlocation + "component_maps_408locked_pyramid.npy"
+
+def pyramidOffset(NSIDE):
+    """This function returns where the maps at the given NSIDE start in a GSM pyramid, which holds the [component, pixel] RING-ordered
+    maps at NSIDE = 1, 2, 4, ... one after another. Since the maps before it have 12 + 48 + ... + 12 (NSIDE/2)^2 pixels, this is 4 (NSIDE^2 - 1)."""
+    return 4 * (NSIDE**2 - 1)
+
+def pyramidMaximumNSIDE(pyramid):
+    """This function returns the largest NSIDE in a GSM pyramid, which has 4 (4 NSIDE^2 - 1) pixels in all."""
+    return int(round(((pyramid.shape[1] / 4.0 + 1) / 4.0)**.5))
+
+def buildGSMPyramid(GSMlocation):
+    """This function puts the separate component map files at NSIDE = 1, 2, 4, ... (as many as there are in a row) into a GSM pyramid file
+    and returns it, memory-mapped. It is only run by hand, for GSM folders made before GSM_Degrader.py wrote pyramids. The file is written under a temporary name and then renamed, so that simultaneous runs never see a partial one."""
+    NSIDEs = []
+    while os.path.exists(componentFilename(GSMlocation, 2**len(NSIDEs), 0)):
+        NSIDEs.append(2**len(NSIDEs))
+    if len(NSIDEs) == 0:
+        raise IOError("No GSM component maps found in " + GSMlocation)
+    print "Now building a GSM pyramid from the component maps at NSIDE = 1 through " + str(NSIDEs[-1]) + "..."
+    tempFilename = pyramidFilename(GSMlocation) + "." + str(os.getpid()) + ".temp.npy"
+    pyramid = np.lib.format.open_memmap(tempFilename, mode='w+', dtype=np.float64, shape=(3, pyramidOffset(2*NSIDEs[-1])))
+    for NSIDE in NSIDEs:
+        for comp in range(3):
+            pyramid[comp, pyramidOffset(NSIDE):pyramidOffset(2*NSIDE)] = np.load(componentFilename(GSMlocation, NSIDE, comp))
+    pyramid.flush()
+    del pyramid
+    os.rename(tempFilename, pyramidFilename(GSMlocation))
+    return np.load(pyramidFilename(GSMlocation), mmap_mode='r')
+
+def loadGSMPyramid(GSMlocation):
+    """This function returns the memory-mapped GSM pyramid in GSMlocation, only opening it once. If there isn't one (it is made by GSM_Degrader.py,
+    or from existing component map files by calling buildGSMPyramid), it returns None and the separate component map files are used instead.
+    Nothing is ever written to GSMlocation here."""
+    if GSMlocation not in loadedPyramids:
+        if os.path.exists(pyramidFilename(GSMlocation)):
+            loadedPyramids[GSMlocation] = np.load(pyramidFilename(GSMlocation), mmap_mode='r')
+        else:
+            loadedPyramids[GSMlocation] = None
+    return loadedPyramids[GSMlocation]
+
+def loadGSMComponents(GSMlocation, GSMNSIDE):
+    """This function returns a list of the 3 read-only GSM component maps at the given NSIDE and the table in components.dat, loading them only once.
+
+    The maps are views of the memory-mapped GSM pyramid (or, without one, the separate memory-mapped component files). If there aren't any
+    at this NSIDE, the finest ones there are (preferably finer than GSMNSIDE) are regraded to it once and kept in memory."""
+    if (GSMlocation, GSMNSIDE) not in loadedComponents:
+        pyramid = loadGSMPyramid(GSMlocation)
+        if pyramid is not None:
+            availableNSIDEs = [2**power for power in range(0, int(np.log2(pyramidMaximumNSIDE(pyramid))) + 1)]
+        else:
+            availableNSIDEs = [2**power for power in range(0,14) if os.path.exists(componentFilename(GSMlocation, 2**power, 0))]
+        if len(availableNSIDEs) == 0:
+            raise IOError("No GSM component maps found in " + GSMlocation)
+        if GSMNSIDE in availableNSIDEs and pyramid is not None:
+            componentMaps = [pyramid[comp, pyramidOffset(GSMNSIDE):pyramidOffset(2*GSMNSIDE)] for comp in range(3)]
+        elif GSMNSIDE in availableNSIDEs:
+            componentMaps = [np.load(componentFilename(GSMlocation, GSMNSIDE, comp), mmap_mode='r') for comp in range(3)]
+        else:
+            finerNSIDEs = [NSIDE for NSIDE in availableNSIDEs if NSIDE > GSMNSIDE]
+            sourceNSIDE = min(finerNSIDEs) if len(finerNSIDEs) > 0 else max(availableNSIDEs)
+            componentMaps = [hp.ud_grade(componentMap, GSMNSIDE) for componentMap in loadGSMComponents(GSMlocation, sourceNSIDE)[0]]
+            for componentMap in componentMaps:
+                componentMap.setflags(write=False)
+        loadedComponents[(GSMlocation, GSMNSIDE)] = (componentMaps, np.loadtxt(GSMlocation + "components.dat"))
+    return loadedComponents[(GSMlocation, GSMNSIDE)]
+
+def GSMSplines(GSMlocation):
+    """This function returns the cubic splines in log(f) of log(T) and of the 3 component weights from components.dat, only fitting them once."""
+    if GSMlocation not in loadedSplines:
         components = np.loadtxt(GSMlocation + "components.dat")
-        temperature = np.exp(interp1d(np.log(components[:,0]), np.log(components[:,1]), kind='cubic')(np.log(freq))) #cubic spline interpolation in log(f), log(T)
-        weights = np.asarray([interp1d(np.log(components[:,0]), components[:,i+2], kind='cubic')(np.log(freq)) for i in range(3)]) #cubic spline interpolation for log(f), weights
-        self.hpMap = temperature*np.dot(weights,GSMComponentsDegraded)
\ No newline at end of file
+        temperatureSpline = interp1d(np.log(components[:,0]), np.log(components[:,1]), kind='cubic')
+        weightSplines = [interp1d(np.log(components[:,0]), components[:,i+2], kind='cubic') for i in range(3)]
+        loadedSplines[GSMlocation] = (temperatureSpline, weightSplines)
+    return loadedSplines[GSMlocation]
+
+def GSMComponentWeights(freqs, GSMlocation):
+    """This function returns the [freq, component] weights (including the overall temperature) that the component maps are multiplied by to get the GSM at each frequency (in MHz)."""
+    logFreqs = np.log(np.asarray(freqs, dtype=float))
+    temperatureSpline, weightSplines = GSMSplines(GSMlocation)
+    temperatures = np.exp(temperatureSpline(logFreqs)) #cubic spline interpolation in log(f), log(T)
+    weights = np.asarray([weightSpline(logFreqs) for weightSpline in weightSplines]).T #cubic spline interpolation for log(f), weights
+    return temperatures[:,None] * weights
+
+def GSMCube(freqs, GSMlocation, GSMNSIDE):
+    """This function returns the [freq, pixel] GSM (a HEALPix map in galactic coordinates at GSMNSIDE) at all the given frequencies (in MHz) at once."""
+    componentMaps = loadGSMComponents(GSMlocation, GSMNSIDE)[0]
+    weights = GSMComponentWeights(freqs, GSMlocation)
+    cube = np.zeros((len(weights), len(componentMaps[0])))
+    for comp in range(3):
+        cube += weights[:,comp,None] * componentMaps[comp]
+    return cube
+
+def mixedResolutionGSMComponents(GSMlocation, NSIDEs, thetas, phis):
+    """This function returns the [component, pixel] GSM components interpolated (as in hp.get_interp_val) to the given galactic thetas and phis,
+    each from the map at its own NSIDE (e.g. the resolutions of adaptive HEALPix pixels), with a single lookup in the GSM pyramid."""
+    pyramid = loadGSMPyramid(GSMlocation)
+    NSIDEs = np.asarray(NSIDEs, dtype=int)
+    if pyramid is None or np.max(NSIDEs) > pyramidMaximumNSIDE(pyramid):
+        componentValues = np.zeros((3, len(NSIDEs)))
+        for NSIDE in np.unique(NSIDEs):
+            componentValues[:,NSIDEs == NSIDE] = [hp.get_interp_val(componentMap, thetas[NSIDEs == NSIDE], phis[NSIDEs == NSIDE]) for componentMap in loadGSMComponents(GSMlocation, NSIDE)[0]]
+        return componentValues
+    pyramidIndices, pixelWeights = np.zeros((4, len(NSIDEs)), dtype=int), np.zeros((4, len(NSIDEs)))
+    for NSIDE in np.unique(NSIDEs):
+        pixels, pixelWeights[:,NSIDEs == NSIDE] = hp.get_interp_weights(NSIDE, thetas[NSIDEs == NSIDE], phis[NSIDEs == NSIDE])
+        pyramidIndices[:,NSIDEs == NSIDE] = pixels + pyramidOffset(NSIDE)
+    return np.sum(pyramid[:,pyramidIndices] * pixelWeights, axis=1)
+
+def mixedResolutionGSM(freqs, GSMlocation, NSIDEs, thetas, phis):
+    """This function returns the [freq, pixel] GSM at the given frequencies (in MHz) and galactic thetas and phis, each interpolated from the map at its own NSIDE."""
+    return np.dot(GSMComponentWeights(freqs, GSMlocation), mixedResolutionGSMComponents(GSMlocation, NSIDEs, thetas, phis))
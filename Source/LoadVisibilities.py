@@ -2,10 +2,210 @@
 # by Josh Dillon
 
 import numpy as np
+import copy
+from astropy.io import fits
 import Specifications
 import Geometry
+import VisibilityStore
+from RedundantBaselines import RedundantBaselineGroups
+
+#AIPS polarization codes used on the STOKES axis of uvfits files
+uvfitsPolarizationCodes = {'I': 1, 'Q': 2, 'U': 3, 'V': 4, 'rr': -1, 'll': -2, 'rl': -3, 'lr': -4, 'xx': -5, 'yy': -6, 'xy': -7, 'yx': -8}
 
 def LoadVisibilities(s,times):
-    """For now, this just returns a matrix of zeros of the correct size."""
-    print "Visibility loading functions are not done. All visibilities set to 0."    
-    return np.zeros((len(times.LSTs), s.nBaselines), dtype=np.complex128)
+    """This function returns the [LST, baseline] visibilities (in Jy) at s.freq for the LSTs in times, read from the visibility store in
+    s.visibilityStoreFolder or, if there isn't one, from s.uvfitsFilename. If there's neither, the visibilities are a matrix of zeros of the correct size.
+    It also returns the [LST, baseline] inverse noise variances of the visibilities, which are 0 wherever there's no unflagged data so that missing
+    data get no weight in N^-1, or None if they just come from s.noisePerAntenna."""
+    if s.visibilityStoreFolder:
+        return loadStoredVisibilities(s, times, VisibilityStore.loadVisibilityStore(s.visibilityStoreFolder))
+    if not s.uvfitsFilename:
+        print "No uvfits file given. All visibilities set to 0."
+        return np.zeros((len(times.LSTs), s.nBaselines), dtype=np.complex128), None
+    return loadUVFITSVisibilities(s, times, UVFITSFile(s.uvfitsFilename))
+
+class UVFITSFile:
+    """Reads the header of a uvfits (random groups) file and memory-maps its groups as a [group, value] array of raw numbers, each row holding
+    the group's PCOUNT parameters followed by its data array. Nothing else is read until it's asked for, so only the parameters and the
+    few numbers needed from each group's data (e.g. one channel and polarization) ever come off the disk."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        hdulist = fits.open(filename, memmap=True)
+        header = hdulist[0].header
+        dataLocation = hdulist.fileinfo(0)['datLoc']
+        hdulist.close()
+        if not header.get('GROUPS', False):
+            raise ValueError(filename + " is not a random groups uvfits file.")
+        if header['BITPIX'] not in [-32, -64]:
+            raise ValueError("Only floating point uvfits files can be read, but " + filename + " has BITPIX = " + str(header['BITPIX']) + ".")
+        self.nGroups, self.nParameters = header['GCOUNT'], header['PCOUNT']
+        self.parameterNames = [header['PTYPE' + str(p+1)].strip().upper() for p in range(self.nParameters)]
+        self.parameterScales = np.asarray([header.get('PSCAL' + str(p+1), 1.0) for p in range(self.nParameters)])
+        self.parameterZeros = np.asarray([header.get('PZERO' + str(p+1), 0.0) for p in range(self.nParameters)])
+
+        #Data axes 2 through NAXIS, with axis 2 (COMPLEX: real, imaginary, weight) varying fastest
+        self.axisNames = [header['CTYPE' + str(axis)].strip().upper() for axis in range(2, header['NAXIS'] + 1)]
+        self.axisLengths = [header['NAXIS' + str(axis)] for axis in range(2, header['NAXIS'] + 1)]
+        self.axisValues = [header.get('CRVAL' + str(axis), 0.0) + (np.arange(header['NAXIS' + str(axis)]) + 1 - header.get('CRPIX' + str(axis), 1.0)) * header.get('CDELT' + str(axis), 1.0) for axis in range(2, header['NAXIS'] + 1)]
+        self.groupLength = self.nParameters + int(np.prod(self.axisLengths))
+        self.groups = np.memmap(filename, dtype=('>f4' if header['BITPIX'] == -32 else '>f8'), mode='r', offset=dataLocation, shape=(self.nGroups, self.groupLength))
+
+    def parameters(self, name, groupIndices):
+        """Returns the given (scaled) random parameter of the given groups as float64. Parameters that appear more than once (like DATE) are summed."""
+        columns = [p for p in range(self.nParameters) if self.parameterNames[p] == name]
+        if len(columns) == 0:
+            raise ValueError("There is no " + name + " random parameter in " + self.filename + ".")
+        values = self.groups[groupIndices, columns[0]].astype(np.float64) * self.parameterScales[columns[0]] + self.parameterZeros[columns[0]]
+        for p in columns[1:]:
+            values += self.groups[groupIndices, p].astype(np.float64) * self.parameterScales[p] + self.parameterZeros[p]
+        return values
+
+    def antennaIndices(self, groupIndices):
+        """Returns the 0-indexed antenna numbers of the given groups, from either the ANTENNA1 and ANTENNA2 parameters or the encoded BASELINE parameter
+        (256*ant1 + ant2, or 2048*ant1 + ant2 + 65536 for arrays with more than 255 antennas)."""
+        if 'ANTENNA1' in self.parameterNames:
+            return np.round(self.parameters('ANTENNA1', groupIndices)).astype(int) - 1, np.round(self.parameters('ANTENNA2', groupIndices)).astype(int) - 1
+        baselineIDs = np.round(self.parameters('BASELINE', groupIndices)).astype(int)
+        largeArray = baselineIDs > 65536
+        ant1 = np.where(largeArray, (baselineIDs - 65536) // 2048, baselineIDs // 256)
+        ant2 = np.where(largeArray, (baselineIDs - 65536) % 2048, baselineIDs % 256)
+        return ant1 - 1, ant2 - 1
+
+    def dataColumns(self, freq, polarization):
+        """Returns the columns (in the rows of self.groups) of the real part, imaginary part, and weight of the channel closest to freq (in MHz)
+        and the given polarization, taking the first entry along any other axes (e.g. RA and DEC)."""
+        index = [0] * len(self.axisNames)
+        if 'FREQ' in self.axisNames:
+            freqAxis = self.axisNames.index('FREQ')
+            index[freqAxis] = np.argmin(np.abs(self.axisValues[freqAxis] - freq*1e6))
+            if len(self.axisValues[freqAxis]) > 1 and np.abs(self.axisValues[freqAxis][index[freqAxis]] - freq*1e6) > np.abs(self.axisValues[freqAxis][1] - self.axisValues[freqAxis][0]) / 2:
+                print "\nWARNING: The closest channel in " + self.filename + " to " + str(freq) + " MHz is at " + str(self.axisValues[freqAxis][index[freqAxis]] / 1e6) + " MHz.\n"
+        if 'STOKES' in self.axisNames:
+            stokesAxis = self.axisNames.index('STOKES')
+            matches = np.flatnonzero(np.round(self.axisValues[stokesAxis]) == uvfitsPolarizationCodes[polarization])
+            if len(matches) == 0:
+                raise ValueError("Polarization " + polarization + " is not in " + self.filename + ".")
+            index[stokesAxis] = matches[0]
+        firstColumn = self.nParameters + int(np.dot(index, np.cumprod([1] + self.axisLengths[0:-1])))
+        return np.arange(firstColumn, firstColumn + 3)
+
+def julianDatesToLSTs(s, julianDates):
+    """This function returns the local sidereal times (in hours) at the array's longitude of the given Julian dates, using the IAU 1982 Greenwich mean sidereal time."""
+    return np.mod(18.697374558 + 24.06570982441908 * (np.asarray(julianDates) - 2451545.0) + s.arrayLong / 15.0, 24.0)
+
+def nearestLSTIndices(times, LSTs):
+    """This function returns the index in times.LSTs closest to each of the given LSTs (in hours, wrapping around at 24), or -1 where that's more than half an integration away."""
+    order = np.argsort(times.LSTs)
+    sortedLSTs = times.LSTs[order]
+    above = np.searchsorted(sortedLSTs, LSTs) % len(sortedLSTs)
+    below = (above - 1) % len(sortedLSTs)
+    distanceAbove = np.abs(np.mod(sortedLSTs[above] - LSTs + 12, 24) - 12)
+    distanceBelow = np.abs(np.mod(sortedLSTs[below] - LSTs + 12, 24) - 12)
+    nearest = np.where(distanceAbove < distanceBelow, above, below)
+    return np.where(np.minimum(distanceAbove, distanceBelow) <= times.integrationTime / 60.0 / 60.0 / 2, order[nearest], -1)
+
+def loadUVFITSVisibilities(s, times, uvfits):
+    """This function returns the [LST, baseline] visibilities at s.freq and s.uvfitsPolarization for the LSTs in times, streamed from an open UVFITSFile,
+    and their inverse noise variances. Redundant measurements (e.g. of the same unique baseline, or at the same LST on different nights) are
+    averaged with inverse variance weights 1/(n1*n2)^2, from the noise of each antenna at that LST (see accumulateUVFITSVisibilities), so the
+    inverse variance of each average only counts the measurements that went into it."""
+    print "Now loading visibilities from " + uvfits.filename + "..."
+    weightedSums = np.zeros(len(times.LSTs) * s.nBaselines, dtype=complex)
+    weightSums = np.zeros(len(times.LSTs) * s.nBaselines)
+    nGroupsUsed = accumulateUVFITSVisibilities(s, times, uvfits, RedundantBaselineGroups(s), weightedSums, weightSums, s.noisePerAntenna)
+    print str(nGroupsUsed) + " of " + str(uvfits.nGroups) + " groups used."
+    return averageVisibilities(s, times, weightedSums, weightSums)
+
+def accumulateUVFITSVisibilities(s, times, uvfits, groups, weightedSums, weightSums, noisePerAntenna):
+    """This function adds the visibilities at s.freq and s.uvfitsPolarization in an open UVFITSFile to the raveled [LST, baseline] inverse variance
+    weighted sums of visibilities and of weights (see RedundantBaselineGroups.accumulate), given the [LST, antenna] noise for the LSTs in times.
+
+    The groups are read in chunks of at most s.visibilityLoadingMemoryInGB. For each chunk, the times and antenna pairs are decoded from the
+    random parameters all at once, and only the groups that fall within half an integration of a used LST, measure a used baseline, and
+    aren't flagged have their one channel and polarization read. Returns the number of groups used."""
+    dataColumns = uvfits.dataColumns(s.freq, s.uvfitsPolarization)
+    groupsPerChunk = int(max(s.visibilityLoadingMemoryInGB * 1024.0**3 / 8 / (uvfits.nParameters + 16), 1))
+    nGroupsUsed = 0
+    for firstGroup in range(0, uvfits.nGroups, groupsPerChunk):
+        chunk = slice(firstGroup, min(firstGroup + groupsPerChunk, uvfits.nGroups))
+        LSTindices = nearestLSTIndices(times, julianDatesToLSTs(s, uvfits.parameters('DATE', chunk)))
+        ant1, ant2 = uvfits.antennaIndices(chunk)
+        used = np.flatnonzero((LSTindices >= 0) * (groups.baselinesOfAntennas(ant1, ant2)[0] >= 0))
+        if len(used) == 0:
+            continue
+        data = uvfits.groups[np.ix_(firstGroup + used, dataColumns)].astype(np.float64) #only these few numbers of each group are read
+        used, data = used[data[:,2] > 0], data[data[:,2] > 0]
+        nGroupsUsed += groups.accumulate(weightedSums, weightSums, LSTindices[used], ant1[used], ant2[used], data[:,0] + 1j * data[:,1], noisePerAntenna)
+    return nGroupsUsed
+
+def averageVisibilities(s, times, weightedSums, weightSums):
+    """This function returns the [LST, baseline] inverse variance weighted average visibilities from raveled sums of weighted visibilities and of weights,
+    and their inverse variances (the sums of weights). Combinations without any data are set to 0 with an inverse variance of 0."""
+    visibilities = np.zeros((len(times.LSTs), s.nBaselines), dtype=np.complex128)
+    measured = weightSums > 0
+    visibilities.ravel()[measured] = weightedSums[measured] / weightSums[measured]
+    print str(np.sum(np.logical_not(measured))) + " of " + str(len(measured)) + " LST and baseline combinations have no data and get no weight."
+    return visibilities, weightSums.reshape(visibilities.shape)
+
+def binNightsOntoLSTs(s, times):
+    """This function combines the uvfits files in s.nightlyUvfitsFilenames, which observed the same LSTs on different nights, onto the LSTs in times
+    at s.freq. It returns the [LST, baseline] visibilities of the combination and their inverse noise variances.
+
+    The nights are streamed one at a time into the same inverse variance weighted sums, each measurement weighted by 1/(n1*n2)^2 from that night's
+    antenna noise (from s.nightlyNoisePerAntennaPath, or s.noisePerAntennaPath every night if that's blank), so the memory needed doesn't depend on
+    the number of nights. The inverse variance of each combined visibility is the sum of the weights of the measurements that went into it, so
+    it's 0 for LSTs and baselines that were never measured, whatever their antennas measured on other baselines or nights."""
+    groups = RedundantBaselineGroups(s)
+    weightedSums = np.zeros(len(times.LSTs) * s.nBaselines, dtype=complex)
+    weightSums = np.zeros(len(times.LSTs) * s.nBaselines)
+    for night, uvfitsFilename in enumerate(s.nightlyUvfitsFilenames):
+        uvfits = UVFITSFile(uvfitsFilename)
+        print "Now binning night " + str(night) + " from " + uvfitsFilename + " onto " + str(len(times.LSTs)) + " LSTs..."
+        noisePath = s.nightlyNoisePerAntennaPath.replace('[night]', str(night)) if s.nightlyNoisePerAntennaPath else s.noisePerAntennaPath
+        noisePerAntenna = times.selectUsedLSTs(np.load(noisePath.replace('[freq]',"{:.3f}".format(s.freq))))
+        nGroupsUsed = accumulateUVFITSVisibilities(s, times, uvfits, groups, weightedSums, weightSums, noisePerAntenna)
+        print str(nGroupsUsed) + " of " + str(uvfits.nGroups) + " groups used."
+        del uvfits
+    return averageVisibilities(s, times, weightedSums, weightSums)
+
+def loadStoredVisibilities(s, times, store):
+    """This function returns the [LST, baseline] visibilities at s.freq for the LSTs in times (which have been cut and reordered
+    from the LST file, see Times.originalLSTIndices) and their inverse noise variances from a VisibilityStore, only reading the blocks of LSTs that are used."""
+    if len(store.LSTs) <= np.max(times.originalLSTIndices) or not np.allclose(store.LSTs[times.originalLSTIndices], times.LSTs):
+        raise ValueError("The LSTs of the visibility store in " + store.folder + " do not match " + s.LSTsFilename + ".")
+    if store.visibilities.shape[2] != s.nBaselines:
+        raise ValueError("The visibility store in " + store.folder + " has " + str(store.visibilities.shape[2]) + " baselines, not " + str(s.nBaselines) + ".")
+    print "Now loading visibilities from " + str(store.blocksRead(times.originalLSTIndices)) + " of the " + str(store.nBlocks) + " blocks of LSTs in the visibility store..."
+    return store.readLSTs(store.visibilities, s.freq, times.originalLSTIndices), store.readLSTs(store.inverseVariances, s.freq, times.originalLSTIndices)
+
+def buildVisibilityStore(s, freqs, folder = None):
+    """This function writes the visibilities, their inverse noise variances, and the antenna noise of the whole observation at the given frequencies
+    (in MHz) to a visibility store in folder (by default, s.visibilityStoreFolder) and returns it, in the LST order of the LST file.
+
+    If there are s.nightlyUvfitsFilenames, they are binned onto the LSTs in the LST file (see binNightsOntoLSTs), so that mapmaking with
+    the store only depends on the number of LSTs and not on the number of nights. Otherwise, the visibilities come from s.uvfitsFilename.
+    The inverse variances are those of the loaded data, and so 0 for LSTs and baselines without any. If there's no uvfits file at all, the
+    visibilities are 0 and the inverse variances come from the antenna noise. The antenna noise always comes from the AntennaNoise file.
+    The uvfits files are read once per frequency."""
+    folder = folder or s.visibilityStoreFolder
+    uvfits = UVFITSFile(s.uvfitsFilename) if s.uvfitsFilename and not s.nightlyUvfitsFilenames else None
+    allLSTs = np.loadtxt(s.LSTsFilename)
+
+    def dataAtFrequency(freq):
+        sAtFreq = copy.copy(s)
+        sAtFreq.freq = freq
+        noisePerAntenna = np.load(s.noisePerAntennaPath.replace('[freq]',"{:.3f}".format(freq)))
+        visibilities = np.zeros((len(allLSTs), s.nBaselines), dtype=np.complex128)
+        if not s.nightlyUvfitsFilenames and uvfits is None:
+            return visibilities, noisePerAntenna, RedundantBaselineGroups(s).inverseVariancePerBaseline(noisePerAntenna)
+        inverseVariances = np.zeros((len(allLSTs), s.nBaselines))
+        sAtFreq.noisePerAntenna = noisePerAntenna
+        times = Geometry.Times(sAtFreq) #this may reorder the LSTs (and sAtFreq.noisePerAntenna) to keep the facet away from the edges
+        if s.nightlyUvfitsFilenames:
+            visibilities[times.originalLSTIndices], inverseVariances[times.originalLSTIndices] = binNightsOntoLSTs(sAtFreq, times)
+        else:
+            visibilities[times.originalLSTIndices], inverseVariances[times.originalLSTIndices] = loadUVFITSVisibilities(sAtFreq, times, uvfits)
+        return visibilities, noisePerAntenna, inverseVariances
+
+    return VisibilityStore.writeVisibilityStore(folder, freqs, allLSTs, s.visibilityStoreLSTsPerBlock, s.nBaselines, s.nAntennas, dataAtFrequency)
@@ -0,0 +1,103 @@
+# SUPPORTING MODULE FOR JOINT MAPMAKING AND POWER SPECTRUM PIPELINE
+# by Josh Dillon
+
+import numpy as np
+import healpy as hp
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+import Geometry
+import FringeKernel
+from GlobalSkyModel import GlobalSkyModel
+from VisibilitySimulator import simulateVisibilitiesOfPointLikeSky
+
+def MModeVisibilitySimulator(s,PBs,ps,times,coords):
+    """This function simulates the same visibilities as VisibilitySimulator.VisibilitySimulator, but does the GSM part in
+    spherical harmonic space, which is much faster when there are many LSTs.
+
+    For a drift scan, the sky rotates past a beam that is fixed to the ground, so each visibility is V_b(phi) = sum_m exp(-i m phi) c_bm,
+    where phi is the LST in radians and c_bm sums the spherical harmonic coefficients of the sky times those of the baseline's
+    transfer function (beam times fringe) at LST = 0 over l. The transfer functions are evaluated at the smallest NSIDE (at least
+    GSMNSIDE) that resolves the fringes of the longest baseline and only have to be transformed once per pointing, after which all
+    the LSTs come from a single FFT (if they lie on a uniform grid that evenly divides a sidereal day) or a direct sum over m.
+    Harmonics up to l = s.mmodeLmax are kept (or 3*GSMNSIDE-1, if that's 0 or larger, since the GSM map can't constrain higher l).
+    Point sources are still simulated directly, since there are few of them."""
+    print "Now simulating visibilities with m-modes (assuming XX beams only)..."
+    if s.GSMNSIDE < s.mapNSIDE:
+        s.GSMNSIDE = s.mapNSIDE
+    visibilities = np.zeros([len(times.LSTs),len(s.baselines)],dtype=complex)
+
+    #TODO: this ignores polarization and differing primary beams
+    if s.simulateVisibilitiesWithGSM:
+        lmax = s.mmodeLmax if s.mmodeLmax > 0 else 3*s.GSMNSIDE - 1
+        if lmax > 3*s.GSMNSIDE - 1:
+            print "\nWARNING: mmodeLmax = " + str(lmax) + " is more than the GSM at NSIDE " + str(s.GSMNSIDE) + " can constrain. Using l <= " + str(3*s.GSMNSIDE - 1) + " instead.\n"
+            lmax = 3*s.GSMNSIDE - 1
+        thetas, phis = hp.pix2ang(s.GSMNSIDE, np.arange(12*s.GSMNSIDE**2))
+        RAs, decs = phis, np.pi/2 - thetas #HEALPix grid in equatorial coordinates
+        GSM = GlobalSkyModel(s.freq, s.GSMlocation, s.GSMNSIDE)
+        interpolatedGSM = Geometry.galacticResamplingMatrix(s, s.GSMNSIDE, RAs, decs).dot(GSM.hpMap)
+        skyAlms = hp.map2alm(interpolatedGSM, lmax=lmax) / s.convertJyToKFactor
+        transferNSIDE = s.GSMNSIDE
+        while 3*transferNSIDE - 1 < max(lmax, s.k * np.max(np.linalg.norm(s.baselines, axis=1))):
+            transferNSIDE *= 2 #the fringes of long baselines have to be resolved so they don't alias into the harmonics we keep
+        pointings = np.asarray(s.pointings)[0:len(times.LSTs)]
+        for pointing in np.unique(pointings):
+            mModes = transferFunctionMModes(s, PBs, pointing, skyAlms, lmax, transferNSIDE)
+            visibilities[pointings == pointing,:] += visibilitiesFromMModes(s, mModes, times.LSTs[pointings == pointing], times.integrationTime)
+
+    if s.simulateVisibilitiesWithPointSources and ps.nSources > 0:
+        visibilities += simulateVisibilitiesOfPointLikeSky(s, PBs, times, ps.RAs, ps.decs, ps.scaledFluxes)
+
+    return visibilities
+
+def transferFunctionMModes(s, PBs, pointing, skyAlms, lmax, NSIDE):
+    """This function returns the [m, baseline] m-modes c_bm of the sky seen by every baseline at the given pointing, for m = -lmax...lmax
+    (in FFT order, so negative m come last). The beam-weighted fringes at LST = 0 are evaluated on an equatorial HEALPix grid at the given NSIDE
+    and their real and imaginary parts are transformed separately, in groups of baselines sized by s.simulationMemoryInGB.
+    As in the direct simulator, directions more than a beam pixel below the horizon are left out."""
+    thetas, phis = hp.pix2ang(NSIDE, np.arange(12*NSIDE**2))
+    RAs, decs = phis, np.pi/2 - thetas
+    alts, azs = Geometry.convertEquatorialToHorizontal(s, RAs, decs, 0.0)
+    nearSky = np.flatnonzero(alts > -2 * hp.nside2resol(s.beamNSIDE))
+    primaryBeam = hp.get_interp_val(PBs.beamSquared("X","x",pointing), np.pi/2-alts[nearSky], azs[nearSky])
+    rHatVectors = Geometry.convertAltAzToCartesian(alts[nearSky], azs[nearSky])
+    ms = hp.Alm.getlm(lmax)[1]
+    firstIndexOfEachM = hp.Alm.getidx(lmax, np.arange(lmax+1), np.arange(lmax+1)) #alms are ordered by m, then l
+    mModes = np.zeros((2*lmax+1, s.nBaselines), dtype=complex)
+    baselinesPerGroup = int(max(min(s.simulationMemoryInGB * 1024.0**3 / 16 / 3 / len(RAs), s.nBaselines), 1))
+    for firstBaseline in range(0, s.nBaselines, baselinesPerGroup):
+        baselineIndices = np.arange(firstBaseline, min(firstBaseline + baselinesPerGroup, s.nBaselines))
+        transferFunctions = np.zeros((len(RAs), 2*len(baselineIndices)))
+        beamWeightedFringes = primaryBeam[:,None] * FringeKernel.baselineFringes(s, rHatVectors, -1, baselineIndices)
+        transferFunctions[nearSky,0::2], transferFunctions[nearSky,1::2] = beamWeightedFringes.real, beamWeightedFringes.imag
+        transferAlms = np.asarray(hp.map2alm(transferFunctions.T, lmax=lmax, pol=False)).reshape(len(baselineIndices), 2, len(ms))
+        realAlms, imagAlms = transferAlms[:,0,:], transferAlms[:,1,:]
+
+        #For real maps f, f_l(-m) = (-1)^m conj(f_lm), so the negative m come from the same coefficients
+        mModes[0:lmax+1, baselineIndices] = np.add.reduceat((realAlms + 1j*imagAlms) * np.conj(skyAlms), firstIndexOfEachM, axis=1).T
+        mModes[:lmax:-1, baselineIndices] = np.add.reduceat((np.conj(realAlms) + 1j*np.conj(imagAlms)) * skyAlms, firstIndexOfEachM, axis=1)[:,1:].T
+    return mModes
+
+def visibilitiesFromMModes(s, mModes, LSTs, integrationTime):
+    """This function returns the [LST, baseline] visibilities sum_m exp(-i m phi) c_bm at the given LSTs (in hours).
+
+    If the LSTs all lie on a grid spaced by the integration time that evenly divides a sidereal day, and an FFT over that
+    grid is cheaper than summing over m at every LST, the visibilities are read off of one FFT. Otherwise the sum is done
+    directly in blocks of LSTs sized by s.simulationMemoryInGB."""
+    if len(LSTs) == 0:
+        return np.zeros((0, mModes.shape[1]), dtype=complex)
+    lmax = (len(mModes) - 1) / 2
+    ms = np.append(np.arange(lmax+1), np.arange(-lmax, 0)) #matches the order of mModes
+    gridSpacing = integrationTime / 60.0 / 60.0
+    nGrid = int(round(24.0 / gridSpacing))
+    gridIndices = (LSTs - LSTs[0]) / gridSpacing
+    if nGrid >= len(mModes) and np.abs(24.0 / gridSpacing - nGrid) < 1e-6 and np.all(np.abs(gridIndices - np.round(gridIndices)) < 1e-6) and nGrid * np.log2(nGrid) < len(LSTs) * len(mModes):
+        spectrum = np.zeros((nGrid, mModes.shape[1]), dtype=complex)
+        spectrum[ms % nGrid,:] = mModes * np.exp(-1j * ms * np.pi/12.0 * LSTs[0])[:,None]
+        return np.fft.fft(spectrum, axis=0)[np.round(gridIndices).astype(int) % nGrid,:]
+    visibilities = np.zeros((len(LSTs), mModes.shape[1]), dtype=complex)
+    LSTsPerBlock = int(max(s.simulationMemoryInGB * 1024.0**3 / 16 / len(ms), 1))
+    for firstLST in range(0, len(LSTs), LSTsPerBlock):
+        block = slice(firstLST, min(firstLST + LSTsPerBlock, len(LSTs)))
+        visibilities[block,:] = np.dot(np.exp(-1j * np.outer(np.pi/12.0 * LSTs[block], ms)), mModes)
+    return visibilities
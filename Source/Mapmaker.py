@@ -8,74 +8,131 @@ import matplotlib.pyplot as plt
 from Specifications import Specifications
 from PrimaryBeams import PrimaryBeams
 from VisibilitySimulator import VisibilitySimulator
+from MModeSimulator import MModeVisibilitySimulator
 import Geometry
-from PointSourceCatalog import PointSourceCatalog
+from PointSourceCatalog import PointSourceCatalog, mergePointSourceCatalogs
 import MatricesForMapmaking as MapMats
+from PSFAccumulator import PSFAccumulator, AccumulatorLayout, checkpointExists
+import SnapshotExecutor
 from LoadVisibilities import LoadVisibilities
 import scipy.constants as const
 from GlobalSkyModel import GlobalSkyModel
 plt.close('all')
 
 
-def Mapmaker(mainDirectory, freq = 150, useLogFile = False, configFile = "configuration.txt",  **kwargs):
+def Mapmaker(mainDirectory, freq = 150, useLogFile = False, configFile = "configuration.txt", sharedInputs = None, **kwargs):
     """This function makes maps from visibilities and also calculates the associated map statistics. 
     
-    Saves the results to binary (as pickles or numpy arryas) and returns the folder where they are located"""        
+    Saves the results to binary (as pickles or numpy arryas) and returns the folder where they are located.
+    If s.checkpointEverySnapshots > 0, the un-normalized accumulators are periodically saved to the checkpoint folder inside
+    the results folder. If s.resumeFromCheckpoint is true and a checkpoint exists, the run picks up where it left off.
+    If sharedInputs (a FrequencyIndependentInputs object) is given, its specifications, LSTs, and coordinates are used
+    instead of being loaded again, and kwargs are applied on top of its specifications."""        
     
     #Load in everything we need, figure out which LSTs to work with
     print "Now working on mapmaking at " + str(freq) + " MHz..."             
-    s = Specifications(mainDirectory, configFile,freq)
-    s.OverrideSpecifications(kwargs)
-    os.system("rm -rf " + s.resultsFolder)
-    os.system("mkdir " + s.resultsFolder)
-    if useLogFile: sys.stdout = open(s.resultsFolder + 'log.txt', 'w')    
+    if sharedInputs is None:
+        s = Specifications(mainDirectory, configFile,freq)
+        s.OverrideSpecifications(kwargs)
+    else:
+        s = sharedInputs.specificationsAtFrequency(freq, kwargs)
+    checkpointFolder = s.resultsFolder + "checkpoint/"
+    resumingFromCheckpoint = s.resumeFromCheckpoint and checkpointExists(checkpointFolder)
+    if not resumingFromCheckpoint:
+        os.system("rm -rf " + s.resultsFolder)
+        os.system("mkdir " + s.resultsFolder)
+    originalStdout = sys.stdout
+    if useLogFile: sys.stdout = open(s.resultsFolder + 'log.txt', 'a' if resumingFromCheckpoint else 'w')    
     
     #Info related to time, geometry, primary beams, and point sources
-    times = Geometry.Times(s)
-    times.CutOutUnusedLSTsAndGroupIntoSnapshots(s)
-    coords = Geometry.Coordinates(s)
+    if sharedInputs is None:
+        times = Geometry.Times(s)
+        times.CutOutUnusedLSTsAndGroupIntoSnapshots(s)
+        coords = Geometry.Coordinates(s)
+    else:
+        times, coords = sharedInputs.times, sharedInputs.coords
     PBs = PrimaryBeams(s)
     ps = PointSourceCatalog(s,times)
-    if s.useAdaptiveHEALPixForPSF: coords.convertToAdaptiveHEALPix(s, times)
+    if s.useAdaptiveHEALPixForPSF and sharedInputs is None: coords.convertToAdaptiveHEALPix(s, times)
     
     #Simulate or load visibilities
-    if s.simulateVisibilitiesWithGSM or s.simulateVisibilitiesWithPointSources:
+    inverseVariances = None
+    visibilities = sharedInputs.simulatedVisibilitiesAtFrequency(freq, ps) if sharedInputs is not None else None
+    if visibilities is not None:
+        print "Using the visibilities simulated at all frequencies at once..."
+    elif (s.simulateVisibilitiesWithGSM or s.simulateVisibilitiesWithPointSources) and s.visibilitySimulator == "mmode":
+        visibilities = MModeVisibilitySimulator(s,PBs,ps,times,coords)
+    elif s.simulateVisibilitiesWithGSM or s.simulateVisibilitiesWithPointSources:
         visibilities = VisibilitySimulator(s,PBs,ps,times,coords)
     else:
-        visibilities = LoadVisibilities(s,times)
-    visibilities *= s.convertJyToKFactor
+        visibilities, inverseVariances = LoadVisibilities(s,times)
     
-    #Prepare visibilities
-    visibilities /= s.convertJyToKFactor #converts to temperature units
-    Geometry.rephaseVisibilitiesToSnapshotCenter(s,visibilities,times)
-    MapMats.inverseCovarianceWeightVisibilities(s,visibilities)
+    #Rephase, weight, and sum the visibilities in each snapshot
+    snapshotVisibilities = MapMats.SnapshotVisibilities(s,times,visibilities,inverseVariances)
     
     #Perform mapmaking and calculate PSFs
     print "Now calculating map and map statistics..."    
-    coaddedMap = np.zeros(coords.nFacetPixels)
-    PSF = np.zeros((coords.nFacetPixels,coords.nPSFPixels))
-    pointSourcePSF = np.zeros((coords.nFacetPixels, ps.nSources))
-    for snapshot in times.snapshots:    
-        print "Working on snapshot at LST = " + str(round(snapshot.centralLST,4)) + "..."
-        NinvTimesy = MapMats.calculateNinvTimesy(visibilities, snapshot)
-        Ninv = MapMats.calculateNInv(s,snapshot)
-        KAtranspose = MapMats.calculateKAtranspose(s,snapshot,coords,PBs)    
-        coaddedMap += 2 * np.real(np.dot(KAtranspose[coords.facetIndexLocationsInPSFIndexList,:], NinvTimesy))
-        PSF += 2 * np.real(np.dot(KAtranspose[coords.facetIndexLocationsInPSFIndexList,:], np.dot(np.diag(Ninv), KAtranspose.conj().transpose())))    
-        if s.PSFforPointSources and ps.nSources > 0:
-            pointSourceAmatrix = MapMats.calculatePSAmatrix(s,snapshot,ps,PBs)
-            pointSourcePSF += 2 * np.real(np.dot(KAtranspose[coords.facetIndexLocationsInPSFIndexList,:], np.dot(np.diag(Ninv), pointSourceAmatrix)))
+    accumulator = PSFAccumulator(s, AccumulatorLayout(coords, ps))
+    if resumingFromCheckpoint: accumulator.loadCheckpoint(checkpointFolder)
+    SnapshotExecutor.accumulateSnapshots(s, times, snapshotVisibilities, coords, PBs, ps, accumulator, checkpointFolder)
+    coaddedMap, PSF, pointSourcePSF = accumulator.finalize()
             
     #Renormalize maps and PSFs and save results
-    #Dmatrix = np.diag(np.diag(PSF[:,coords.facetIndexLocationsInPSFIndexList])**(-1)) #This is the version I used in Dillon et al. 2015. I think the D ~ I is more logical.
-    Dmatrix = np.diag(np.ones((coords.nFacetPixels)) / PSF[coords.facetIndexOfFacetCenter,coords.PSFIndexOfFacetCenter])
-    PSF = np.dot(Dmatrix,PSF)
-    coaddedMap = np.dot(Dmatrix,coaddedMap)
-    mapNoiseCovariance = np.dot(PSF[:,coords.facetIndexLocationsInPSFIndexList],np.transpose(Dmatrix))
-    if s.PSFforPointSources and ps.nSources > 0: pointSourcePSF = np.dot(Dmatrix,pointSourcePSF)
+    Dmatrix = accumulator.normalize()
+    
+    MapMats.saveAllResults(s,times,ps,Dmatrix,PSF,coaddedMap,pointSourcePSF,accumulator.layout)
+    os.system("rm -rf " + checkpointFolder)
+    if useLogFile: 
+        sys.stdout.close()
+        sys.stdout = originalStdout
+    return s.resultsFolder
+
+
+def MergeMapmakingResults(resultsFolders, outputFolder):
+    """This function combines the results of several Mapmaker runs of the same facet and frequency, e.g. different nights or LST ranges.
+    
+    The saved maps and PSFs are turned back into un-normalized accumulators by dividing out each run's D, added together,
+    and then normalized again. The merged results are saved to outputFolder (in the same format as Mapmaker results, so
+    they can be merged again with later runs), and outputFolder is returned.
+
+    The runs have to have the same facet and PSF pixels. Since the adaptive PSF pixelization depends on the LSTs of the run,
+    runs over different LSTs can only be merged if they were made with useAdaptiveHEALPixForPSF = false. Each run may have selected
+    different point sources from the same catalog file. They are matched up by their index in it, and each run only adds to the
+    point source PSF columns of the sources it selected."""
+    print "Now merging mapmaking results from " + str(len(resultsFolders)) + " runs into " + outputFolder
+    outputPath = os.path.realpath(outputFolder)
+    for resultsFolder in resultsFolders:
+        resultsPath = os.path.realpath(resultsFolder)
+        if resultsPath == outputPath or resultsPath.startswith(outputPath + os.sep):
+            raise ValueError("Cannot merge into " + outputFolder + " because it is (or contains) " + resultsFolder + ", which would be deleted before being read.")
+    s, times, ps, Dmatrix, PSF, coaddedMap, pointSourcePSF = MapMats.loadAllResults(resultsFolders[0], mmapMode='r')
+    layout = MapMats.loadAccumulatorLayout(resultsFolders[0])
+    catalogs = []
+    for resultsFolder in resultsFolders:
+        if not layout.matchesPixels(MapMats.loadAccumulatorLayout(resultsFolder)):
+            raise ValueError("The facet or PSF pixels in " + resultsFolder + " do not match the ones in " + resultsFolders[0] + ". Runs over different LSTs only have the same PSF pixels if useAdaptiveHEALPixForPSF is false.")
+        thisS, thisPs = MapMats.loadSpecificationsAndPointSourceCatalog(resultsFolder)
+        if thisS.pointSourceCatalogFilename != s.pointSourceCatalogFilename:
+            raise ValueError("The point sources in " + resultsFolder + " come from a different catalog than the ones in " + resultsFolders[0] + ".")
+        catalogs.append(thisPs)
+    ps = mergePointSourceCatalogs(s, catalogs)
+    layout = layout.withPointSources(ps)
+    s.resultsFolder = outputFolder
+    os.system("rm -rf " + s.resultsFolder)
+    os.system("mkdir " + s.resultsFolder)
+    
+    accumulator = PSFAccumulator(s, layout)
+    for resultsFolder in resultsFolders:
+        thisS, thisTimes, thisPs, Dmatrix, PSF, coaddedMap, pointSourcePSF = MapMats.loadAllResults(resultsFolder, mmapMode='r')
+        accumulator.addAccumulators(coaddedMap, PSF, pointSourcePSF, rowWeights = 1.0 / Dmatrix, processedSnapshotLSTs = [snapshot.centralLST for snapshot in thisTimes.snapshots],
+                                    pointSourceColumns = np.searchsorted(ps.catalogIndices, thisPs.catalogIndices))
+        if resultsFolder != resultsFolders[0]:
+            times.snapshots += thisTimes.snapshots
+            times.LSTs = np.append(times.LSTs, thisTimes.LSTs)
+    coaddedMap, PSF, pointSourcePSF = accumulator.finalize()
+    Dmatrix = accumulator.normalize()
     
-    MapMats.saveAllResults(s,times,ps,Dmatrix,PSF,coaddedMap,pointSourcePSF)
-    if useLogFile: sys.stdout = sys.__stdout__
+    MapMats.saveAllResults(s,times,ps,Dmatrix,PSF,coaddedMap,pointSourcePSF,layout)
     return s.resultsFolder
         
 
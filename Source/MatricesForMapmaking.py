@@ -7,74 +7,136 @@ import math
 import Geometry
 import cPickle as pickle
 import os
+import scipy.sparse
+from RedundantBaselines import RedundantBaselineGroups
 
-def computeNoisePerUniqueBaseline(s):
-    s.noisePerUniqueBaseline = np.zeros((len(s.noisePerAntenna),len(s.baselines)))
-    for antennaPair in s.antennaPairDict.keys():
-        s.noisePerUniqueBaseline[:,s.antennaPairDict[antennaPair]] += 1.0 / (s.noisePerAntenna[:,antennaPair[0]] * s.noisePerAntenna[:,antennaPair[1]])**2
-    s.noisePerUniqueBaseline = 1.0 / s.noisePerUniqueBaseline ** .5
+class SnapshotVisibilities:
+    """Reduces the visibilities at every LST to what each snapshot needs for mapmaking: the inverse noise variance weighted sum N^-1 * y of its
+    visibilities, rephased to the facet center at its central LST, and the diagonal of N^-1 (off-diagonal terms are 0) for each baseline.
+    The averaging (rather than summing) happens when the normalization is applied.
 
-def inverseCovarianceWeightVisibilities(s,visibilities):
-    """This function weights the visibilities (which have not been combined into snapshots yet) by the inverse of the noise variance."""
-    if s.useOnlyUniqueBaselines:
-        computeNoisePerUniqueBaseline(s)
-        visibilities /= (s.noisePerUniqueBaseline**2)
-    else:
-        print "WARNING: this has not been tested."        
-        for b in range(len(s.baselines)):
-            visibilities[:,b] /= (s.noisePerAntenna[:,s.allBaselinePairs[b,0]] * s.noisePerAntenna[:,s.allBaselinePairs[b,1]])
+    The rephasing, weighting, and summing are done together, a block of snapshots at a time. Each block of visibilities is only read once
+    and the visibilities are never changed, so they can be memory-mapped (e.g. from a VisibilityStore) and only the [snapshot, baseline] sums
+    are kept in memory, which is also all that snapshot workers need. The snapshots of a block are summed with a sparse [snapshot, LST] operator.
 
-def calculateNinvTimesy(visibilities, snapshot):
-    """This function computes the inverse varianced weighted sum of rephased visibilities in a snapshot. The averaging (rather than summing) happens when the normalizaiton is applied."""
-    return np.sum(visibilities[snapshot.LSTindices,:], axis=0)
-    
-def calculateNInv(s, snapshot):
-    """This function computes the diagonal of the inverse noise covariance (off-diagonal terms are 0) for each baseline during this snapshot."""
-    if s.useOnlyUniqueBaselines:
-        return np.sum(s.noisePerUniqueBaseline[snapshot.LSTindices,:]**(-2), axis=0)
-    else:
-        print "WARNING: this has not been tested."
-        return np.asarray([np.sum((s.noisePerAntenna[:,s.allBaselinePairs[b,0]] * s.noisePerAntenna[:,s.allBaselinePairs[b,1]])**(-1), axis=0) for b in range(len(s.baselines))])
+    Parameters
+    ---------------
+    s: Specifications
+        With the [LST, antenna] noise for the LSTs in times.
+    times: Times
+        With the snapshots.
+    visibilities: numpy array
+        [LST, baseline] visibilities (in Jy).
+    inverseVariances: numpy array
+        [LST, baseline] inverse noise variances of the visibilities (e.g. 0 where they are missing or flagged), as returned by LoadVisibilities.
+        If None, they are computed from the antenna noise in s.
+    """
 
-def calculateKAtranspose(s,snapshot,coords,PBs):
-    """This function computes K_PSF * A^t, which maps baselines at the given snapshot central index to the PSF pixels.
-    It is worth nothing that the Fourier convention is based on A having e^ib.k, so A^t has e^-ib.k = e^i|k|b.theta_hat, as we see here."""
+    LSTsPerBlock = 256 #number of LSTs whose visibilities are rephased and weighted at once
+
+    def __init__(self, s, times, visibilities, inverseVariances = None):
+        groups = RedundantBaselineGroups(s)
+        self.rowOfSnapshots = dict([(snapshot.centralLSTIndex, row) for row, snapshot in enumerate(times.snapshots)])
+        self.NinvTimesy = np.zeros((len(times.snapshots), s.nBaselines), dtype=complex)
+        self.Ninv = np.zeros((len(times.snapshots), s.nBaselines))
+        snapshotsPerBlock = max(self.LSTsPerBlock / s.integrationsPerSnapshot, 1)
+        for firstSnapshot in range(0, len(times.snapshots), snapshotsPerBlock):
+            snapshots = times.snapshots[firstSnapshot : firstSnapshot + snapshotsPerBlock]
+            LSTindices = np.concatenate([snapshot.LSTindices for snapshot in snapshots])
+            snapshotOfLSTs = np.repeat(np.arange(len(snapshots)), [len(snapshot.LSTindices) for snapshot in snapshots])
+            summingOperator = scipy.sparse.csr_matrix((np.ones(len(LSTindices)), (snapshotOfLSTs, np.arange(len(LSTindices)))), shape=(len(snapshots), len(LSTindices)))
+            if inverseVariances is None:
+                blockInverseVariances = groups.inverseVariancePerBaseline(s.noisePerAntenna[LSTindices])
+            else:
+                blockInverseVariances = np.asarray(inverseVariances[LSTindices])
+            rows = slice(firstSnapshot, firstSnapshot + len(snapshots))
+            self.NinvTimesy[rows] = summingOperator.dot(visibilities[LSTindices] * Geometry.rephasingFringes(s, times, snapshots) * blockInverseVariances)
+            self.Ninv[rows] = summingOperator.dot(blockInverseVariances)
+
+    def snapshotSums(self, snapshot):
+        """Returns the snapshot's N^-1 * y and N^-1 diagonal, each for every baseline."""
+        row = self.rowOfSnapshots[snapshot.centralLSTIndex]
+        return self.NinvTimesy[row], self.Ninv[row]
+
+def calculateKAtransposeWeightsAndFringes(s,snapshot,coords,PBs):
+    """This function computes the real-space diagonal part of K_PSF * A^t (pixel areas times the primary beam) and the fringes e^i|k|b.theta_hat for every PSF pixel and baseline."""
     if s.useAdaptiveHEALPixForPSF:    
         realSpaceDiagonalPart = np.ones(coords.nPSFPixels) * 4*np.pi / 12.0 / coords.newPSFNSIDEs**2 / s.convertJyToKFactor
     else:
         realSpaceDiagonalPart = np.ones(coords.nPSFPixels) * 4*np.pi / 12.0 / s.mapNSIDE**2 / s.convertJyToKFactor
-    PSFAlts, PSFAzs = Geometry.convertEquatorialToHorizontal(s, coords.PSFRAs, coords.PSFDecs, snapshot.centralLST)
-    PSFCartVecs = Geometry.convertAltAzToCartesian(PSFAlts, PSFAzs)
-    realSpaceDiagonalPart *= hp.get_interp_val(PBs.beamSquared("X","x",s.pointings[snapshot.centralLSTIndex]), np.pi/2-PSFAlts, PSFAzs)
-    KAtranspose = np.dot(np.diag(realSpaceDiagonalPart), np.exp(1j * s.k * np.dot(PSFCartVecs,np.transpose(s.baselines))))
-    return KAtranspose
+    geometry = Geometry.PSFGeometry(s, snapshot, coords)
+    realSpaceDiagonalPart *= Geometry.beamSquaredOfDirections(s, PBs, s.pointings[snapshot.centralLSTIndex], snapshot.centralLST, coords.PSFRAs, coords.PSFDecs, geometry.alts, geometry.azs)
+    return realSpaceDiagonalPart, geometry.baselineFringes(s, 1)
+
+def calculateKAtranspose(s,snapshot,coords,PBs):
+    """This function computes K_PSF * A^t, which maps baselines at the given snapshot central index to the PSF pixels.
+    It is worth nothing that the Fourier convention is based on A having e^ib.k, so A^t has e^-ib.k = e^i|k|b.theta_hat, as we see here."""
+    realSpaceDiagonalPart, fringes = calculateKAtransposeWeightsAndFringes(s,snapshot,coords,PBs)
+    return realSpaceDiagonalPart[:,np.newaxis] * fringes
+
+def calculateKAtransposeRealBlocks(s,snapshot,coords,PBs,dtype=np.float64):
+    """This function computes the real and imaginary parts of K_PSF * A^t side by side as a [PSF pixel, 2*baseline] real matrix.
+    Since the map and the PSF only depend on the real parts of products with K_PSF * A^t, this avoids forming imaginary parts that get thrown away."""
+    realSpaceDiagonalPart, fringes = calculateKAtransposeWeightsAndFringes(s,snapshot,coords,PBs)
+    KAtransposeRealBlocks = np.empty((coords.nPSFPixels, 2*s.nBaselines), dtype=dtype)
+    KAtransposeRealBlocks[:,0:s.nBaselines] = fringes.real
+    KAtransposeRealBlocks[:,s.nBaselines:] = fringes.imag
+    KAtransposeRealBlocks *= realSpaceDiagonalPart[:,np.newaxis].astype(dtype)
+    return KAtransposeRealBlocks
+
+def calculatePSAmatrixBeamAndFringes(s,snapshot,ps,PBs):
+    """This function computes the primary beam at each point source and the fringes e^-i|k|b.theta_hat for every baseline and point source.
+    Fringes are only evaluated for the point sources that the beam can see (e.g. those above the horizon). The rest are left as zeros, since
+    they would be multiplied by a zero beam anyway."""
+    geometry = Geometry.pointSourceGeometry(s, snapshot, ps)
+    realSpaceDiagonalPart = Geometry.beamSquaredOfDirections(s, PBs, s.pointings[snapshot.centralLSTIndex], snapshot.centralLST, ps.RAs, ps.decs, geometry.alts, geometry.azs)
+    visibleSources = np.flatnonzero(realSpaceDiagonalPart != 0)
+    if len(visibleSources) == ps.nSources:
+        return realSpaceDiagonalPart, np.transpose(geometry.baselineFringes(s, -1))
+    fringes = np.zeros((s.nBaselines, ps.nSources), dtype=complex)
+    fringes[:,visibleSources] = np.transpose(geometry.baselineFringes(s, -1, visibleSources))
+    return realSpaceDiagonalPart, fringes
     
 def calculatePSAmatrix(s,snapshot,ps,PBs):
     """This function computes A mappings to the locations of the point source at the snapshot central index to the baselines."""
-    psAlts, psAzs = Geometry.convertEquatorialToHorizontal(s, ps.RAs, ps.decs, snapshot.centralLST)
-    psCartVecs = Geometry.convertAltAzToCartesian(psAlts, psAzs)
-    realSpaceDiagonalPart = hp.get_interp_val(PBs.beamSquared("X","x",s.pointings[snapshot.centralLSTIndex]), np.pi/2-psAlts, psAzs)
-    pointSourceAmatrix = np.dot(np.exp(-1j * s.k * s.baselines.dot(np.transpose(psCartVecs))), np.diag(realSpaceDiagonalPart))
-    return pointSourceAmatrix
+    realSpaceDiagonalPart, fringes = calculatePSAmatrixBeamAndFringes(s,snapshot,ps,PBs)
+    return fringes * realSpaceDiagonalPart
+
+def calculatePSAmatrixRealBlocks(s,snapshot,ps,PBs,dtype=np.float64):
+    """This function computes the point source A matrix as a [2*baseline, point source] real matrix, with the real part stacked on top of minus the imaginary part.
+    This matches the layout of calculateKAtransposeRealBlocks, so that Re(K_PSF * A^t * A) is a product of the two real matrices."""
+    realSpaceDiagonalPart, fringes = calculatePSAmatrixBeamAndFringes(s,snapshot,ps,PBs)
+    pointSourceAmatrixRealBlocks = np.empty((2*s.nBaselines, ps.nSources), dtype=dtype)
+    pointSourceAmatrixRealBlocks[0:s.nBaselines,:] = fringes.real
+    pointSourceAmatrixRealBlocks[s.nBaselines:,:] = -fringes.imag
+    pointSourceAmatrixRealBlocks *= realSpaceDiagonalPart.astype(dtype)
+    return pointSourceAmatrixRealBlocks
     
-def saveAllResults(s,times,ps,Dmatrix,PSF,coaddedMap,pointSourcePSF):
-    """This function saves all the input classes, vectors, and matrices to s.resultsFolder."""
+def saveAllResults(s,times,ps,Dmatrix,PSF,coaddedMap,pointSourcePSF,layout=None):
+    """This function saves all the input classes, vectors, and matrices to s.resultsFolder. Dmatrix is the diagonal of the (diagonal) normalization matrix.
+    If the accumulator layout is given, it is saved too so that these results can later be merged with others."""
     print "Now writing results to " + s.resultsFolder
     pickle.dump(s, open(s.resultsFolder + "specifications.p","wb"))
     pickle.dump(times, open(s.resultsFolder + "times.p","wb"))
     pickle.dump(ps, open(s.resultsFolder + "pointSourceCatalog.p","wb"))
-    np.save(s.resultsFolder + "Dmatrix",np.diag(Dmatrix))
-    np.save(s.resultsFolder + "PSF",PSF)
+    if layout is not None:
+        pickle.dump(layout, open(s.resultsFolder + "accumulatorLayout.p","wb"))
+    np.save(s.resultsFolder + "Dmatrix",Dmatrix)
+    if isinstance(PSF, np.memmap) and os.path.abspath(PSF.filename) == os.path.abspath(s.resultsFolder + "PSF.npy"):
+        PSF.flush() #the PSF was accumulated directly in the results folder
+    else:
+        np.save(s.resultsFolder + "PSF",PSF)
     np.save(s.resultsFolder + "coaddedMap",coaddedMap)
     if s.PSFforPointSources and ps.nSources > 0:
         np.save(s.resultsFolder + "pointSourcePSF",pointSourcePSF)
 
-def loadAllResults(resultsFolder):
+def loadAllResults(resultsFolder, mmapMode=None):
+    """This function loads the results saved by saveAllResults. If mmapMode is given (e.g. 'r'), the PSF is memory-mapped rather than read into memory."""
     s = pickle.load(open(resultsFolder + "specifications.p","rb"))
     times = pickle.load( open(resultsFolder + "times.p","rb"))
     ps = pickle.load(open(resultsFolder + "pointSourceCatalog.p","rb"))
     Dmatrix = np.load(resultsFolder + "Dmatrix.npy")
-    PSF = np.load(resultsFolder + "PSF.npy")
+    PSF = np.load(resultsFolder + "PSF.npy", mmap_mode=mmapMode)
     coaddedMap = np.load(resultsFolder + "coaddedMap.npy")
     if s.PSFforPointSources and ps.nSources>0:
         pointSourcePSF = np.load(resultsFolder + "pointSourcePSF.npy")
@@ -82,3 +144,10 @@ def loadAllResults(resultsFolder):
     else:
         return s, times, ps, Dmatrix, PSF, coaddedMap, []
 
+def loadSpecificationsAndPointSourceCatalog(resultsFolder):
+    """This function loads just the specifications and point source catalog saved by saveAllResults, without the maps and PSFs."""
+    return pickle.load(open(resultsFolder + "specifications.p","rb")), pickle.load(open(resultsFolder + "pointSourceCatalog.p","rb"))
+
+def loadAccumulatorLayout(resultsFolder):
+    """This function loads the accumulator layout saved by saveAllResults, which describes the facet, PSF pixels, and point sources."""
+    return pickle.load(open(resultsFolder + "accumulatorLayout.p","rb"))
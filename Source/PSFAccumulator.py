@@ -0,0 +1,261 @@
+# SUPPORTING CLASS FOR JOINT MAPMAKING AND POWER SPECTRUM PIPELINE
+# by Josh Dillon
+
+import numpy as np
+import copy
+from scipy.linalg import blas
+import cPickle as pickle
+import shutil
+import os
+
+class AccumulatorLayout:
+    """This class holds the parts of the coordinates and point source catalog that determine the shapes of the accumulators.
+    It is saved along with checkpoints and results so that accumulators can be reloaded and combined without rebuilding the coordinates."""
+    def __init__(self, coords, ps):
+        self.nFacetPixels = coords.nFacetPixels
+        self.nPSFPixels = coords.nPSFPixels
+        self.nSources = ps.nSources
+        self.pointSourceCatalogIndices = np.asarray(ps.catalogIndices)
+        self.facetIndexLocationsInPSFIndexList = np.asarray(coords.facetIndexLocationsInPSFIndexList)
+        self.facetIndexOfFacetCenter = coords.facetIndexOfFacetCenter
+        self.PSFIndexOfFacetCenter = coords.PSFIndexOfFacetCenter
+        self.PSFRAs = np.asarray(coords.PSFRAs)
+        self.PSFDecs = np.asarray(coords.PSFDecs)
+
+    def matchesPixels(self, other):
+        """Returns True if the other layout has the same facet and PSF pixels."""
+        return (self.nFacetPixels == other.nFacetPixels and self.nPSFPixels == other.nPSFPixels
+                and np.array_equal(self.facetIndexLocationsInPSFIndexList, other.facetIndexLocationsInPSFIndexList)
+                and np.allclose(self.PSFRAs, other.PSFRAs) and np.allclose(self.PSFDecs, other.PSFDecs))
+
+    def matches(self, other):
+        """Returns True if the other layout has the same facet, PSF pixels, and point sources."""
+        return self.matchesPixels(other) and np.array_equal(self.pointSourceCatalogIndices, other.pointSourceCatalogIndices)
+
+    def withPointSources(self, ps):
+        """Returns a copy of this layout with the point sources of the given catalog instead."""
+        layout = copy.copy(self)
+        layout.nSources = ps.nSources
+        layout.pointSourceCatalogIndices = np.asarray(ps.catalogIndices)
+        return layout
+
+def checkpointExists(checkpointFolder):
+    """Returns True if a complete checkpoint (or the previous one, if a new one was being swapped in) is saved in checkpointFolder."""
+    return os.path.exists(checkpointFolder + "checkpointInfo.p") or os.path.exists(checkpointFolder.rstrip('/') + "_old/checkpointInfo.p")
+
+def snapshotLSTKey(LST):
+    """This function rounds a snapshot's central LST (in hours) to the nearest 1e-9 hours, so that the same snapshot is recognized in another run or a checkpoint."""
+    return int(round(LST * 1e9))
+
+class PSFAccumulator:
+    """This class accumulates the coadded map, the PSF, and the point source PSF over snapshots.
+
+    Rather than adding each snapshot's contribution with its own matrix products, snapshots are queued up and added
+    s.snapshotsPerPSFBatch at a time. The baselines of all snapshots in a batch are stacked into one long list, so
+    the PSF update becomes a single weighted rank-k update. N^-1 is diagonal, so it is applied by broadcasting.
+    When the facet and the PSF are the same set of pixels, the PSF is symmetric and is accumulated with a Hermitian
+    rank-k update (zherk) that only computes the upper triangle until finalize() is called.
+
+    If s.PSFarithmetic is "real", snapshots are passed in as the real blocks from calculateKAtransposeRealBlocks and
+    calculatePSAmatrixRealBlocks, so all products are real (and the symmetric update uses dsyrk). If s.PSFprecision is
+    "single", the products for each batch are computed in single precision and then added to double precision accumulators.
+
+    If s.useMemoryMappedPSF is true, the PSF is kept in PSF.npy in the results folder as a memory-mapped array and is
+    updated one block of PSF columns at a time. The batch size and block size are chosen so that the queued snapshots
+    and the block being updated fit (approximately) in s.PSFmemoryBudgetInGB.
+
+    The central LSTs of all snapshots that have been added are kept in processedSnapshotLSTs. saveCheckpoint() and
+    loadCheckpoint() save and restore the un-normalized accumulators, so an interrupted run can skip those snapshots."""
+
+    def __init__(self, s, layout):
+        self.layout = layout
+        self.nFacetPixels = layout.nFacetPixels
+        self.nPSFPixels = layout.nPSFPixels
+        self.nSources = layout.nSources
+        self.facetIndexLocationsInPSFIndexList = layout.facetIndexLocationsInPSFIndexList
+        self.facetIsPSF = np.array_equal(layout.facetIndexLocationsInPSFIndexList, np.arange(layout.nPSFPixels))
+        self.includePointSources = s.PSFforPointSources and layout.nSources > 0
+        self.useRealArithmetic = (s.PSFarithmetic == "real")
+        self.realDtype = {"single": np.float32, "double": np.float64}[s.PSFprecision]
+        if self.useRealArithmetic:
+            self.dtype = self.realDtype
+            self.columnsPerSnapshot = 2 * s.nBaselines
+        else:
+            self.dtype = {"single": np.complex64, "double": np.complex128}[s.PSFprecision]
+            self.columnsPerSnapshot = s.nBaselines
+        self.snapshotsPerBatch = max(s.snapshotsPerPSFBatch, 1)
+
+        self.useMemoryMappedPSF = s.useMemoryMappedPSF
+        if self.useMemoryMappedPSF:
+            memoryBudget = s.PSFmemoryBudgetInGB * 1024.0**3
+            bytesPerSnapshot = self.nPSFPixels * self.columnsPerSnapshot * np.dtype(self.dtype).itemsize
+            self.snapshotsPerBatch = int(max(min(self.snapshotsPerBatch, memoryBudget / 2 / bytesPerSnapshot), 1))
+            bytesPerPSFColumn = 2 * self.nFacetPixels * 8 + 2 * self.snapshotsPerBatch * self.columnsPerSnapshot * np.dtype(self.dtype).itemsize
+            self.PSFcolumnsPerBlock = int(max(min(self.nPSFPixels, memoryBudget / 2 / bytesPerPSFColumn), 1))
+            self.PSFrowsPerBlock = int(max(min(self.nFacetPixels, memoryBudget / 2 / (self.nPSFPixels * 8)), 1))
+            self.PSF = np.lib.format.open_memmap(s.resultsFolder + "PSF.npy", mode='w+', dtype=np.float64, shape=(self.nFacetPixels, self.nPSFPixels))
+            print "The PSF is memory-mapped to " + s.resultsFolder + "PSF.npy and is updated " + str(self.PSFcolumnsPerBlock) + " columns at a time, with " + str(self.snapshotsPerBatch) + " snapshots per batch."
+        else:
+            self.PSFcolumnsPerBlock = self.nPSFPixels
+            self.PSFrowsPerBlock = self.nFacetPixels
+            self.PSF = np.zeros((self.nFacetPixels, self.nPSFPixels))
+        self.coaddedMap = np.zeros(self.nFacetPixels)
+        self.pointSourcePSF = np.zeros((self.nFacetPixels, self.nSources))
+        self.PSFisUpperTriangleOnly = False
+        self.nSnapshotsInBatch = 0
+        self.KAtransposeBatch = None
+        self.batchSnapshotLSTs = []
+        self.processedSnapshotLSTs = []
+        self.queuedOrProcessedLSTKeys = set() #central LSTs of every snapshot in processedSnapshotLSTs or batchSnapshotLSTs, rounded by snapshotLSTKey
+        self.nSnapshotsSinceCheckpoint = 0
+
+    def hasProcessed(self, snapshot):
+        """Returns True if the snapshot has already been added (for example, before a checkpoint that this run was resumed from)."""
+        return snapshotLSTKey(snapshot.centralLST) in self.queuedOrProcessedLSTKeys
+
+    def addSnapshot(self, snapshot, KAtranspose, Ninv, NinvTimesy, pointSourceAmatrix = None):
+        """Queues up a snapshot's K_PSF * A^t, N^-1 diagonal, and N^-1 * y. The batch is added to the accumulators once it is full.
+        In real arithmetic mode, KAtranspose and pointSourceAmatrix should be real blocks, while Ninv and NinvTimesy are the same as in complex mode."""
+        if self.useRealArithmetic:
+            Ninv = np.append(Ninv, Ninv)
+            NinvTimesy = np.append(np.real(NinvTimesy), -np.imag(NinvTimesy))
+        if self.KAtransposeBatch is None:
+            self.KAtransposeBatch = np.empty((self.nPSFPixels, self.snapshotsPerBatch * self.columnsPerSnapshot), dtype=self.dtype) #[PSF pixel, snapshot baseline]
+            self.NinvBatch = np.empty(self.snapshotsPerBatch * self.columnsPerSnapshot, dtype=self.realDtype)
+            self.NinvTimesyBatch = np.empty(self.snapshotsPerBatch * self.columnsPerSnapshot, dtype=self.dtype)
+            if self.includePointSources:
+                self.pointSourceAmatrixBatch = np.empty((self.snapshotsPerBatch * self.columnsPerSnapshot, self.nSources), dtype=self.dtype) #[snapshot baseline, point source]
+        columns = slice(self.nSnapshotsInBatch * self.columnsPerSnapshot, (self.nSnapshotsInBatch + 1) * self.columnsPerSnapshot)
+        self.KAtransposeBatch[:,columns] = KAtranspose
+        self.NinvBatch[columns] = Ninv
+        self.NinvTimesyBatch[columns] = NinvTimesy
+        if self.includePointSources:
+            self.pointSourceAmatrixBatch[columns,:] = pointSourceAmatrix
+        self.nSnapshotsInBatch += 1
+        self.batchSnapshotLSTs.append(snapshot.centralLST)
+        self.queuedOrProcessedLSTKeys.add(snapshotLSTKey(snapshot.centralLST))
+        self.nSnapshotsSinceCheckpoint += 1
+        if self.nSnapshotsInBatch >= self.snapshotsPerBatch:
+            self.flush()
+
+    def flush(self):
+        """Adds all queued snapshots to the coadded map, PSF, and point source PSF."""
+        if self.nSnapshotsInBatch == 0:
+            return
+        nColumns = self.nSnapshotsInBatch * self.columnsPerSnapshot
+        KAtranspose = self.KAtransposeBatch[:,0:nColumns]
+        Ninv = self.NinvBatch[0:nColumns]
+        if self.facetIsPSF:
+            facetKAtranspose = KAtranspose
+        else:
+            facetKAtranspose = KAtranspose[self.facetIndexLocationsInPSFIndexList,:]
+
+        self.coaddedMap += 2 * np.real(np.dot(facetKAtranspose, self.NinvTimesyBatch[0:nColumns]))
+        if self.facetIsPSF and not self.useMemoryMappedPSF:
+            #herk computes A^H * A of the transposed (and therefore Fortran-ordered) matrix, which is the complex conjugate of the PSF update we want. The real part is the same.
+            if self.useRealArithmetic:
+                rankKUpdate = blas.get_blas_funcs('syrk', (KAtranspose,))
+                self.PSF += rankKUpdate(2.0, (KAtranspose * Ninv**.5).T, trans=1)
+            else:
+                rankKUpdate = blas.get_blas_funcs('herk', (KAtranspose,))
+                self.PSF += rankKUpdate(2.0, (KAtranspose * Ninv**.5).T, trans=2).real
+            self.PSFisUpperTriangleOnly = True
+        else:
+            for firstColumn in range(0, self.nPSFPixels, self.PSFcolumnsPerBlock):
+                PSFcolumns = slice(firstColumn, min(firstColumn + self.PSFcolumnsPerBlock, self.nPSFPixels))
+                #When the PSF is symmetric, only the rows on or above the diagonal are needed
+                PSFrows = slice(0, PSFcolumns.stop if self.facetIsPSF else self.nFacetPixels)
+                self.PSF[PSFrows,PSFcolumns] += 2 * np.real(np.dot(facetKAtranspose[PSFrows,:], (KAtranspose[PSFcolumns,:] * Ninv).conj().T))
+            self.PSFisUpperTriangleOnly = self.facetIsPSF
+        if self.includePointSources:
+            self.pointSourcePSF += 2 * np.real(np.dot(facetKAtranspose, Ninv[:,np.newaxis] * self.pointSourceAmatrixBatch[0:nColumns,:]))
+        self.nSnapshotsInBatch = 0
+        self.processedSnapshotLSTs += self.batchSnapshotLSTs
+        self.batchSnapshotLSTs = []
+
+    def finalize(self):
+        """Adds any remaining snapshots and fills in the lower triangle of the PSF if only the upper triangle was accumulated.
+        The lower triangle is filled in place, one block of columns at a time."""
+        self.flush()
+        self.KAtransposeBatch = None
+        if self.PSFisUpperTriangleOnly:
+            for firstColumn in range(0, self.nPSFPixels, self.PSFcolumnsPerBlock):
+                PSFcolumns = slice(firstColumn, min(firstColumn + self.PSFcolumnsPerBlock, self.nPSFPixels))
+                diagonalBlock = self.PSF[PSFcolumns,PSFcolumns]
+                self.PSF[PSFcolumns,PSFcolumns] = np.triu(diagonalBlock) + np.triu(diagonalBlock, 1).T
+                self.PSF[PSFcolumns.stop:,PSFcolumns] = self.PSF[PSFcolumns,PSFcolumns.stop:].T
+            self.PSFisUpperTriangleOnly = False
+        return self.coaddedMap, self.PSF, self.pointSourcePSF
+
+    def addAccumulators(self, coaddedMap, PSF, pointSourcePSF, PSFisUpperTriangleOnly = False, rowWeights = None, processedSnapshotLSTs = [], pointSourceColumns = None):
+        """Adds un-normalized accumulators from elsewhere (a checkpoint or another run) to these ones, one block of PSF rows at a time.
+        PSF can be a read-only memory-mapped array. If rowWeights is given, every row is multiplied by it before being added.
+        If pointSourceColumns is given, the columns of pointSourcePSF are added to those columns of this point source PSF (e.g. when another
+        run selected a different set of point sources), and if it's empty, pointSourcePSF is ignored.
+        The snapshots in processedSnapshotLSTs are marked as processed."""
+        if rowWeights is None:
+            rowWeights = np.ones(self.nFacetPixels)
+        self.coaddedMap += rowWeights * coaddedMap
+        for firstRow in range(0, self.nFacetPixels, self.PSFrowsPerBlock):
+            PSFrows = slice(firstRow, min(firstRow + self.PSFrowsPerBlock, self.nFacetPixels))
+            self.PSF[PSFrows,:] += rowWeights[PSFrows,np.newaxis] * PSF[PSFrows,:]
+        if self.includePointSources and pointSourceColumns is None:
+            self.pointSourcePSF += rowWeights[:,np.newaxis] * pointSourcePSF
+        elif self.includePointSources and len(pointSourceColumns) > 0:
+            self.pointSourcePSF[:,pointSourceColumns] += rowWeights[:,np.newaxis] * pointSourcePSF
+        #If either PSF only has its upper triangle filled in, the sum is only correct in the upper triangle
+        self.PSFisUpperTriangleOnly = self.PSFisUpperTriangleOnly or PSFisUpperTriangleOnly
+        self.processedSnapshotLSTs += list(processedSnapshotLSTs)
+        self.queuedOrProcessedLSTKeys.update(map(snapshotLSTKey, processedSnapshotLSTs))
+        self.nSnapshotsSinceCheckpoint += len(processedSnapshotLSTs)
+
+    def saveCheckpoint(self, checkpointFolder):
+        """Adds any queued snapshots and saves the un-normalized accumulators and the list of processed snapshots to checkpointFolder.
+        The checkpoint is written to a temporary folder first and then swapped in, so an interruption never leaves a partial checkpoint."""
+        self.flush()
+        print "Saving a checkpoint after " + str(len(self.processedSnapshotLSTs)) + " snapshots to " + checkpointFolder
+        tempFolder = checkpointFolder.rstrip('/') + "_temp/"
+        oldFolder = checkpointFolder.rstrip('/') + "_old/"
+        os.system("rm -rf " + tempFolder)
+        os.mkdir(tempFolder)
+        np.save(tempFolder + "coaddedMap", self.coaddedMap)
+        if isinstance(self.PSF, np.memmap):
+            self.PSF.flush()
+            shutil.copyfile(self.PSF.filename, tempFolder + "PSF.npy")
+        else:
+            np.save(tempFolder + "PSF", self.PSF)
+        np.save(tempFolder + "pointSourcePSF", self.pointSourcePSF)
+        checkpointInfo = {'layout': self.layout, 'PSFisUpperTriangleOnly': self.PSFisUpperTriangleOnly, 'processedSnapshotLSTs': self.processedSnapshotLSTs}
+        pickle.dump(checkpointInfo, open(tempFolder + "checkpointInfo.p","wb"))
+        if os.path.exists(checkpointFolder):
+            os.rename(checkpointFolder.rstrip('/'), oldFolder.rstrip('/'))
+        os.rename(tempFolder.rstrip('/'), checkpointFolder.rstrip('/'))
+        os.system("rm -rf " + oldFolder)
+        self.nSnapshotsSinceCheckpoint = 0
+
+    def loadCheckpoint(self, checkpointFolder):
+        """Adds the accumulators saved by saveCheckpoint() and marks their snapshots as processed. Returns False if there is no usable checkpoint."""
+        if not os.path.exists(checkpointFolder + "checkpointInfo.p"):
+            checkpointFolder = checkpointFolder.rstrip('/') + "_old/"
+            if not os.path.exists(checkpointFolder + "checkpointInfo.p"):
+                return False
+        checkpointInfo = pickle.load(open(checkpointFolder + "checkpointInfo.p","rb"))
+        if not self.layout.matches(checkpointInfo['layout']):
+            print "\nWARNING: The checkpoint in " + checkpointFolder + " has a different facet, PSF, or point source catalog. Starting over.\n"
+            return False
+        self.addAccumulators(np.load(checkpointFolder + "coaddedMap.npy"), np.load(checkpointFolder + "PSF.npy", mmap_mode='r'), np.load(checkpointFolder + "pointSourcePSF.npy"), checkpointInfo['PSFisUpperTriangleOnly'], processedSnapshotLSTs = checkpointInfo['processedSnapshotLSTs'])
+        self.nSnapshotsSinceCheckpoint = 0
+        print "Resuming from a checkpoint with " + str(len(checkpointInfo['processedSnapshotLSTs'])) + " snapshots already processed."
+        return True
+
+    def normalize(self):
+        """Normalizes the map and the PSFs by D, which is chosen so that the PSF is 1 at the facet center. Returns the diagonal of D.
+        This happens in place, one block of PSF rows at a time."""
+        Dmatrix = np.ones(self.nFacetPixels) / self.PSF[self.layout.facetIndexOfFacetCenter,self.layout.PSFIndexOfFacetCenter]
+        #Dmatrix = np.diag(self.PSF[:,coords.facetIndexLocationsInPSFIndexList])**(-1) #This is the version I used in Dillon et al. 2015. I think the D ~ I is more logical.
+        for firstRow in range(0, self.nFacetPixels, self.PSFrowsPerBlock):
+            PSFrows = slice(firstRow, min(firstRow + self.PSFrowsPerBlock, self.nFacetPixels))
+            self.PSF[PSFrows,:] *= Dmatrix[PSFrows,np.newaxis]
+        self.coaddedMap *= Dmatrix
+        self.pointSourcePSF *= Dmatrix[:,np.newaxis]
+        return Dmatrix
@@ -4,34 +4,128 @@
 import numpy as np
 import healpy as hp
 import math
+import os
+import copy
 import Geometry
 import time
 from PrimaryBeams import PrimaryBeams
 
+#Point source catalogs that have already been loaded, by filename. Loading them before forking lets many processes share them.
+loadedCatalogs = {}
+
+catalogIndexNSIDE = 32 #resolution of the HEALPix pixels (in equatorial coordinates) that the sources are sorted and indexed by
+
 class PointSourceCatalog:
+    """Picks out the point sources that are bright enough to model explicitly and scales their fluxes to s.freq.
+
+    A source is kept if its beam-weighted flux at s.pointSourceReferenceFreq is above s.pointSourceBeamWeightedFluxLimitAtReferenceFreq
+    at the central LST of any snapshot (with that snapshot's pointing). The sources are kept in the order of the catalog file, and catalogIndices
+    holds where each one is in it, so that the sources of runs over different LSTs can be matched up (see mergePointSourceCatalogs)."""
+
     def __init__(self,s,times):
-        #Compute GSM from 3 principal components appropriately weighted        
-        try: 
-            PBs = PrimaryBeams(s, freq=s.pointSourceReferenceFreq)            
-            self.freq = s.freq
-            self.catalog = np.loadtxt(s.pointSourceCatalogFilename)
-            self.catalog = self.catalog[self.catalog[:,2] > .5*s.pointSourceBeamWeightedFluxLimitAtReferenceFreq, :] #assumes that the beam has a max value of 1, with an extra factor of 2 buffer
-            
-            # Determines if the beam-weighted flux of each point source is above the limit and deletes it from the catalog if it isn't
-            middleLSTindex = int(math.floor(len(times.LSTs)/2.0))
-            psAlts, psAzs = Geometry.convertEquatorialToHorizontal(s, self.catalog[:,0] * 2*np.pi/360, self.catalog[:,1] * 2*np.pi/360, times.LSTs[middleLSTindex])
-            primaryBeamWeightsAtReferenceFreq = hp.get_interp_val(PBs.beamSquared("X","x",s.pointings[middleLSTindex]), np.pi/2-psAlts, psAzs)
-            beamWeightedFluxesAtReferenceFreq = primaryBeamWeightsAtReferenceFreq * self.catalog[:,2]
-            self.catalog = self.catalog[beamWeightedFluxesAtReferenceFreq > s.pointSourceBeamWeightedFluxLimitAtReferenceFreq, :]
-            
-            #Convert into a more useful format        
-            self.RAs = self.catalog[:,0] * 2*np.pi/360
-            self.decs = self.catalog[:,1] * 2*np.pi/360
-            self.fluxes = self.catalog[:,2] 
-            self.spectralIndices = self.catalog[:,3]    
-            self.scaledFluxes = self.fluxes * (s.freq / s.pointSourceReferenceFreq)**(-self.spectralIndices)
-            self.nSources = len(self.fluxes)
-        except:
-            self.nSources = 0
-        
-        print str(len(self.catalog)) + " point sources identified for specific modeling."
\ No newline at end of file
+        PBs = PrimaryBeams(s, freq=s.pointSourceReferenceFreq)
+        self.freq = s.freq
+        try:
+            if s.pointSourceCatalogFilename not in loadedCatalogs:
+                loadedCatalogs[s.pointSourceCatalogFilename] = PointSourceStore(s)
+            store = loadedCatalogs[s.pointSourceCatalogFilename]
+        except (IOError, OSError, IndexError): #the catalog file is missing or empty
+            store = None
+
+        if store is None:
+            self.catalogIndices, self.catalog = np.zeros(0, dtype=int), np.zeros((0,4))
+        else:
+            # Determines if the beam-weighted flux of each point source is above the limit in any snapshot and deletes it from the catalog if it isn't
+            fluxLimit = s.pointSourceBeamWeightedFluxLimitAtReferenceFreq
+            searchRadii = dict([(pointing, store.searchRadius(s, PBs.beamSquared("X","x",pointing), pointing, fluxLimit)) for pointing in np.unique(s.pointings[0:len(times.LSTs)])])
+            selectedSources = []
+            for snapshot in times.snapshots:
+                pointing = s.pointings[snapshot.centralLSTIndex]
+                selectedSources.append(store.sourcesAboveBeamWeightedFlux(s, PBs, snapshot.centralLST, pointing, fluxLimit, searchRadii[pointing]))
+            self.catalogIndices = reduce(np.union1d, selectedSources, np.zeros(0, dtype=int))
+            self.catalog = store.catalogRows(self.catalogIndices)
+        self.convertCatalog(s)
+
+        print str(len(self.catalog)) + " point sources identified for specific modeling."
+
+    def convertCatalog(self, s):
+        """Converts the [source, column] catalog entries into a more useful format."""
+        self.RAs = self.catalog[:,0] * 2*np.pi/360
+        self.decs = self.catalog[:,1] * 2*np.pi/360
+        self.fluxes = self.catalog[:,2]
+        self.spectralIndices = self.catalog[:,3]
+        self.scaledFluxes = self.scaledFluxesAtFrequencies(s, [s.freq])[0]
+        self.nSources = len(self.fluxes)
+
+    def scaledFluxesAtFrequencies(self, s, freqs):
+        """Returns the [freq, source] fluxes of every point source at the given frequencies (in MHz), scaled from the reference frequency by their spectral indices."""
+        return self.fluxes * (np.asarray(freqs, dtype=float)[:,None] / s.pointSourceReferenceFreq)**(-self.spectralIndices)
+
+def mergePointSourceCatalogs(s, catalogs):
+    """This function returns a PointSourceCatalog with every source in any of the given ones (e.g. selected by runs over different LSTs
+    from the same catalog file), in the order of the catalog file."""
+    merged = copy.copy(catalogs[0])
+    merged.catalogIndices, firstRows = np.unique(np.concatenate([ps.catalogIndices for ps in catalogs]), return_index=True)
+    merged.catalog = np.concatenate([ps.catalog for ps in catalogs])[firstRows]
+    merged.convertCatalog(s)
+    return merged
+
+class PointSourceStore:
+    """Holds a whole point source catalog in binary, columnar form, sorted by the HEALPix pixel (at catalogIndexNSIDE) that each source is in,
+    so that the sources in any part of the sky can be found without looking at the rest.
+
+    The ASCII catalog (RA and Dec in degrees, flux at the reference frequency, spectral index) is only parsed the first time it is used.
+    If s.cacheFolder is set, the columns and index are saved there and loaded from then on, until the catalog file changes."""
+
+    def __init__(self, s):
+        cacheFilename = None
+        if s.cacheFolder:
+            catalogStats = os.stat(s.pointSourceCatalogFilename)
+            cacheFilename = s.cacheFolder + "PointSources_" + os.path.basename(s.pointSourceCatalogFilename) + "_size-" + str(catalogStats.st_size) + "_modified-" + str(int(catalogStats.st_mtime)) + "_indexNSIDE-" + str(catalogIndexNSIDE) + ".npz"
+        columns = Geometry.loadCachedArrays(cacheFilename)
+        if columns is None:
+            catalog = np.atleast_2d(np.loadtxt(s.pointSourceCatalogFilename))
+            pixels = hp.ang2pix(catalogIndexNSIDE, np.pi/2 - catalog[:,1] * 2*np.pi/360, catalog[:,0] * 2*np.pi/360)
+            order = np.argsort(pixels, kind='mergesort') #keeps the sources within each pixel in catalog order
+            columns = {'catalog': catalog[order,:], 'catalogIndices': order, 'pixelStarts': np.searchsorted(pixels[order], np.arange(12*catalogIndexNSIDE**2 + 1))}
+            Geometry.saveCachedArrays(cacheFilename, **columns)
+        self.catalog = columns['catalog'] #sorted by pixel
+        self.catalogIndices = columns['catalogIndices'] #where each row came from in the catalog file
+        self.pixelStarts = columns['pixelStarts'] #the sources in pixel p are rows pixelStarts[p] to pixelStarts[p+1]
+        pixelThetas, pixelPhis = hp.pix2ang(catalogIndexNSIDE, np.arange(12*catalogIndexNSIDE**2))
+        self.pixelRAs, self.pixelDecs = pixelPhis, np.pi/2 - pixelThetas
+        self.brightestFlux = np.max(self.catalog[:,2]) if len(self.catalog) > 0 else 0
+
+    def sourcesInPixels(self, pixels):
+        """Returns the (sorted) rows of all the sources in the given index pixels."""
+        starts, ends = self.pixelStarts[pixels], self.pixelStarts[np.asarray(pixels) + 1]
+        if np.sum(ends - starts) == 0:
+            return np.zeros(0, dtype=int)
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends) if end > start])
+
+    def searchRadius(self, s, beam, pointing, fluxLimit):
+        """Returns the largest angle (in radians) from the pointing center at which the beam (a healpix map in horizontal coordinates) times
+        the brightest flux in the catalog could be above fluxLimit, or -1 if it never is."""
+        beamPixelsAboveLimit = np.flatnonzero(beam * self.brightestFlux > fluxLimit)
+        if len(beamPixelsAboveLimit) == 0:
+            return -1
+        pointingCenter = [np.pi/2 - s.pointingCenters[pointing][0], s.pointingCenters[pointing][1]]
+        return np.max(hp.rotator.angdist(hp.pix2ang(s.beamNSIDE, beamPixelsAboveLimit), pointingCenter)) + hp.max_pixrad(s.beamNSIDE)
+
+    def sourcesAboveBeamWeightedFlux(self, s, PBs, LST, pointing, fluxLimit, searchRadius):
+        """Returns the (sorted) catalog file indices of the sources whose flux times the XX beam squared in PBs is above fluxLimit at the given LST and pointing.
+        Only the sources in index pixels within searchRadius (from searchRadius()) of the pointing center are looked at."""
+        if searchRadius < 0:
+            return np.zeros(0, dtype=int)
+        pointingCenter = [np.pi/2 - s.pointingCenters[pointing][0], s.pointingCenters[pointing][1]]
+        pixelAlts, pixelAzs = Geometry.convertEquatorialToHorizontal(s, self.pixelRAs, self.pixelDecs, LST)
+        nearbyPixels = np.flatnonzero(hp.rotator.angdist([np.pi/2 - pixelAlts, pixelAzs], pointingCenter) <= searchRadius + hp.max_pixrad(catalogIndexNSIDE))
+        rows = self.sourcesInPixels(nearbyPixels)
+        beamWeightedFluxes = Geometry.beamSquaredOfDirections(s, PBs, pointing, LST, self.catalog[rows,0] * 2*np.pi/360, self.catalog[rows,1] * 2*np.pi/360) * self.catalog[rows,2]
+        return np.sort(self.catalogIndices[rows[beamWeightedFluxes > fluxLimit]])
+
+    def catalogRows(self, catalogIndices):
+        """Returns the [source, column] catalog entries of the sources with the given catalog file indices, in the same order."""
+        rowsByCatalogIndex = np.empty(len(self.catalogIndices), dtype=int)
+        rowsByCatalogIndex[self.catalogIndices] = np.arange(len(self.catalogIndices))
+        return self.catalog[rowsByCatalogIndex[np.asarray(catalogIndices, dtype=int)],:]
@@ -3,6 +3,9 @@
 
 import numpy as np
 import healpy as hp
+import os
+import hashlib
+import collections
 from astropy.io import fits
 
 # For James's HEALPIX Beams
@@ -10,6 +13,114 @@ from astropy.io import fits
 #hp.mollview(np.log10(hdulist[1].data.field(0).flatten()),title='Log_10[HERA_DISH_paper_feed_cyl36_150mhz_X_healpix.fits]')
 
 
+#Beam stores that have already been loaded, by their key. Loading them before forking lets many processes share them.
+loadedBeamStores = {}
+
+#Beams (and their hour angle and declination tables) that have recently been interpolated to a frequency, by (store key, frequency), with the most recently used last.
+recentlyUsedBeams = collections.OrderedDict()
+maximumRecentlyUsedBeams = 16 #number of frequencies whose interpolated beams are kept around
+
+def loadBeamFile(s, filename):
+    """Loads a single beam file (with the frequency already filled in) as a healpix map."""
+    if s.FITSbeam:
+        beamhdulist = fits.open(filename)
+        beam = beamhdulist[1].data.field(0).flatten()
+        beamhdulist.close()
+        beam[hp.pix2ang(s.beamNSIDE,np.arange(len(beam)))[0]>np.pi/2] = 0 #remove all response below the horizon
+        beam = beam**.5 #this is a proxy of antenna beams
+        beam = beam / np.max(beam)
+    else:
+        beam = np.load(filename)
+    return beam
+
+class BeamStore:
+    """Holds every beam file as a single read-only [beam, beam frequency, pixel] cube, where each beam is a different combination
+    of antenna polarization, sky polarization, and pointing (combinations that use the same files share a beam).
+
+    The files are only read and processed (horizon cut, square root, and normalization for FITS beams) the first time. If s.cacheFolder
+    is set, the cube is saved there and memory-mapped from then on, until any of the beam files change."""
+
+    def __init__(self, s, key):
+        self.key = key
+        self.beamFreqs = np.asarray(map(float, s.beamFreqList))
+        filenameFormats, self.beamIndices = [], {}
+        for antPol in s.antPolList:
+            for skyPol in s.skyPolList:
+                for pointIndex in range(s.nPointings):
+                    filenameFormat = s.beamFileFormat.replace('[antIndex]',str(0)).replace('[antPol]',antPol).replace('[skyPol]',skyPol).replace('[pointIndex]',str(pointIndex))
+                    if filenameFormat not in filenameFormats:
+                        filenameFormats.append(filenameFormat)
+                    self.beamIndices[(antPol, skyPol, pointIndex)] = filenameFormats.index(filenameFormat)
+        cacheFilename = s.cacheFolder + "Beams_" + key + ".npy" if s.cacheFolder else None
+        if cacheFilename is not None and os.path.exists(cacheFilename):
+            self.cube = np.load(cacheFilename, mmap_mode='r')
+            return
+
+        print "Now converting the beam files into a single beam cube..."
+        for beamIndex, filenameFormat in enumerate(filenameFormats):
+            for freqIndex in range(len(self.beamFreqs)):
+                beam = loadBeamFile(s, beamFilename(s, filenameFormat, freqIndex))
+                if beamIndex == 0 and freqIndex == 0:
+                    shape = (len(filenameFormats), len(self.beamFreqs), len(beam))
+                    if cacheFilename is None:
+                        self.cube = np.empty(shape, dtype=beam.dtype)
+                    else:
+                        if not os.path.exists(s.cacheFolder):
+                            try: os.makedirs(s.cacheFolder)
+                            except OSError: pass #another run just made it
+                        tempFilename = cacheFilename + "." + str(os.getpid()) + ".temp.npy"
+                        self.cube = np.lib.format.open_memmap(tempFilename, mode='w+', dtype=beam.dtype, shape=shape)
+                self.cube[beamIndex, freqIndex, :] = beam
+        if cacheFilename is not None:
+            self.cube.flush()
+            del self.cube
+            os.rename(tempFilename, cacheFilename) #so that simultaneous runs never see a partial cube
+            self.cube = np.load(cacheFilename, mmap_mode='r')
+        else:
+            self.cube.setflags(write=False)
+
+    def interpolationWeights(self, freqs):
+        """Returns the indices of the two beam frequencies closest to each of the given frequencies and the weights that linearly interpolate (or extrapolate) between them."""
+        distances = np.abs(self.beamFreqs[None,:] - np.asarray(freqs, dtype=float)[:,None])
+        freq1Indices = np.argmin(distances, axis=1)
+        distances[np.arange(len(freq1Indices)), freq1Indices] = np.inf
+        freq2Indices = np.argmin(distances, axis=1)
+        fractions = (np.asarray(freqs, dtype=float) - self.beamFreqs[freq1Indices]) / (self.beamFreqs[freq2Indices] - self.beamFreqs[freq1Indices])
+        return freq1Indices, freq2Indices, fractions
+
+    def beamsAtFrequencies(self, antPol, skyPol, pointIndex, freqs):
+        """Returns the [freq, pixel] beams for the given polarizations and pointing, linearly interpolated to all the given frequencies at once."""
+        beams = self.cube[self.beamIndices[(antPol, skyPol, pointIndex)]]
+        freq1Indices, freq2Indices, fractions = self.interpolationWeights(freqs)
+        return beams[freq1Indices] * (1 - fractions)[:,None].astype(beams.dtype) + beams[freq2Indices] * fractions[:,None].astype(beams.dtype) #in the precision of the beam files
+
+def beamFilename(s, filenameFormat, freqIndex):
+    """Fills in the frequency of a beam filename."""
+    if s.FITSbeam:
+        return filenameFormat.replace('[freq]','{0:d}'.format(int(s.beamFreqList[freqIndex])))
+    return filenameFormat.replace('[freq]',"{:1.6f}".format(float(s.beamFreqList[freqIndex])))
+
+def loadBeamStore(s):
+    """Returns the BeamStore for the beam files in s, only making it once per process. The key depends on the sizes and modification times
+    of all the beam files, so that a changed file makes a new cube."""
+    fileStats = []
+    for antPol in s.antPolList:
+        for skyPol in s.skyPolList:
+            for pointIndex in range(s.nPointings):
+                filenameFormat = s.beamFileFormat.replace('[antIndex]',str(0)).replace('[antPol]',antPol).replace('[skyPol]',skyPol).replace('[pointIndex]',str(pointIndex))
+                for freqIndex in range(len(s.beamFreqList)):
+                    filename = beamFilename(s, filenameFormat, freqIndex)
+                    fileStats.append((filename, os.path.getsize(filename), int(os.path.getmtime(filename))))
+    key = hashlib.md5(repr((s.FITSbeam, s.beamNSIDE, s.beamFileFormat, s.antPolList, s.skyPolList, s.nPointings, s.beamFreqList, fileStats))).hexdigest()
+    if key not in loadedBeamStores:
+        loadedBeamStores[key] = BeamStore(s, key)
+    return loadedBeamStores[key]
+
+def beamSquaredAtFrequencies(s, antPol, skyPol, pointIndex, freqs):
+    """Returns the [freq, pixel] beams squared (like PrimaryBeams.beamSquared) at all the given frequencies at once."""
+    beams = loadBeamStore(s).beamsAtFrequencies(antPol, skyPol, pointIndex, freqs)
+    return beams * beams.conj()
+
 #When constructed, this class loads in information about the primary beams, using a specifications object
 class PrimaryBeams:
 
@@ -21,63 +132,46 @@ class PrimaryBeams:
             self.freq = s.freq
         if not s.antennasHaveIdenticalBeams:
             print "\nWARNING: ALL PRIMARY BEAMS BEING LOADED AS IDENTICAL TO ANTENNA 0\n"
-        self.allBeams = {}
-        for antPol in s.antPolList:
-            for skyPol in s.skyPolList:
-                for antIndex in range((s.nAntennas-1)*(not s.antennasHaveIdenticalBeams) + 1): 
-                    #either range(1) or range(nAntennas)
+        store = loadBeamStore(s)
+        if (store.key, self.freq) in recentlyUsedBeams:
+            self.allBeams, self.beamTables = recentlyUsedBeams.pop((store.key, self.freq))
+        else:
+            self.allBeams = {}
+            self.beamTables = {} #filled in as needed by Geometry.beamSquaredTable, by pointing
+            for antPol in s.antPolList:
+                for skyPol in s.skyPolList:
                     for pointIndex in range(s.nPointings):
-                        #find two closest values
-                        allFrequencies = np.asarray(map(float,s.beamFreqList))
-                        freq1Index = np.abs(allFrequencies - self.freq).argmin()
-                        freq1 = allFrequencies[freq1Index]
-                        allFrequencies[freq1Index] = 1e10
-                        freq2Index = np.abs(allFrequencies - self.freq).argmin()
-                        freq2 = allFrequencies[freq2Index]
-                        
-                        filename = s.beamFileFormat.replace('[antIndex]',str(0)).replace('[antPol]',antPol).replace('[skyPol]',skyPol).replace('[pointIndex]',str(pointIndex))
-#                        filename = s.beamFileFormat.replace('[antIndex]',str(antIndex)).replace('[antPol]',antPol).replace('[skyPol]',skyPol).replace('[pointIndex]',str(pointIndex))
-                        key = str(antIndex) + ";" + str(antPol) + ";" + str(skyPol) + ";" + str(pointIndex)
-                        if s.FITSbeam:
-                            beam1hdulist = fits.open(filename.replace('[freq]','{0:d}'.format(int(s.beamFreqList[freq1Index]))))
-                            beam1 = beam1hdulist[1].data.field(0).flatten()
-                            beam1hdulist.close()
-                            beam2hdulist = fits.open(filename.replace('[freq]','{0:d}'.format(int(s.beamFreqList[freq2Index]))))
-                            beam2 = beam2hdulist[1].data.field(0).flatten()
-                            beam2hdulist.close()
-                            beam1[hp.pix2ang(s.beamNSIDE,np.arange(len(beam1)))[0]>np.pi/2] = 0 #remove all response below the horizon
-                            beam2[hp.pix2ang(s.beamNSIDE,np.arange(len(beam2)))[0]>np.pi/2] = 0
-                            beam1 = beam1**.5 #this is a proxy of antenna beams
-                            beam2 = beam2**.5
-                            beam1 = beam1 / np.max(beam1)
-                            beam2 = beam2 / np.max(beam2)
-                        else:
-                            beam1 = np.load(filename.replace('[freq]',"{:1.6f}".format(float(s.beamFreqList[freq1Index]))));
-                            beam2 = np.load(filename.replace('[freq]',"{:1.6f}".format(float(s.beamFreqList[freq2Index]))));                                                
-                        #linear interpolation                        
-                        self.allBeams[key] = beam1 * (1 - (self.freq - freq1)/(freq2 - freq1)) + beam2 * ((self.freq - freq1)/(freq2 - freq1))
-        
-        #Beam products useful for Stokes I
-        for antPol in s.antPolList:
-            for skyPol in s.skyPolList:
-                for pointIndex in range(s.nPointings):
-                    keyIn = str(0) + ";" + str(antPol) + ";" + str(skyPol) + ";" + str(pointIndex)
-                    keyOut = str(antPol) + str(antPol) + str(skyPol) + str(skyPol) + str(pointIndex)
-                    self.allBeams[keyOut] = self.allBeams[keyIn] * self.allBeams[keyIn].conj()
+                        #linear interpolation between the two closest frequencies
+                        beam = store.beamsAtFrequencies(antPol, skyPol, pointIndex, [self.freq])[0]
+                        for antIndex in range((s.nAntennas-1)*(not s.antennasHaveIdenticalBeams) + 1):
+                            #either range(1) or range(nAntennas), all using antenna 0's beam
+                            self.allBeams[str(antIndex) + ";" + str(antPol) + ";" + str(skyPol) + ";" + str(pointIndex)] = beam
+
+            #Beam products useful for Stokes I
+            for antPol in s.antPolList:
+                for skyPol in s.skyPolList:
+                    for pointIndex in range(s.nPointings):
+                        keyIn = str(0) + ";" + str(antPol) + ";" + str(skyPol) + ";" + str(pointIndex)
+                        keyOut = str(antPol) + str(antPol) + str(skyPol) + str(skyPol) + str(pointIndex)
+                        self.allBeams[keyOut] = self.allBeams[keyIn] * self.allBeams[keyIn].conj()
+            for beam in self.allBeams.values():
+                beam.setflags(write=False) #these are shared with every other PrimaryBeams object at this frequency
+        recentlyUsedBeams[(store.key, self.freq)] = (self.allBeams, self.beamTables)
+        while len(recentlyUsedBeams) > maximumRecentlyUsedBeams:
+            recentlyUsedBeams.popitem(last=False)
 
     #This function returns beam XX, YY, etc. as a numpy array representing a healpix map
-    def beamSquared(self,antPol,skyPol,point = 0):	
+    def beamSquared(self,antPol,skyPol,point = 0):
         try:
             return self.allBeams[str(antPol) + str(antPol) + str(skyPol) + str(skyPol) + str(point)]
         except:
             print "Error: cannot find beam " + str(antPol) + str(antPol) + str(skyPol) + str(skyPol) + str(point)
-    
-    #This function returns beam XX, YY, YX, etc. as a numpy array representing a healpix map    	
+
+    #This function returns beam XX, YY, YX, etc. as a numpy array representing a healpix map
     def beamProduct(self,ant1,ant2,antPol1,antPol2,skyPol1,skyPol2,point1 = 0, point2 = 0):
         try:
             key1 = str(ant1) + ";" + str(antPol1) + ";" + str(skyPol1) + ";" + str(point1)
             key2 = str(ant1) + ";" + str(antPol1) + ";" + str(skyPol1) + ";" + str(point2)
             return self.allBeams[key1] * self.allBeam[key2].conj()
         except:
-            print "Error: cannot find beam product " + str(ant1) + str(antPol1) + str(skyPol1) + str(point1) + " times " + str(ant1) + str(antPol1) + str(skyPol1) + str(point2) 
-
+            print "Error: cannot find beam product " + str(ant1) + str(antPol1) + str(skyPol1) + str(point1) + " times " + str(ant1) + str(antPol1) + str(skyPol1) + str(point2)
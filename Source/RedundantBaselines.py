@@ -0,0 +1,88 @@
+# SUPPORTING CLASS FOR JOINT MAPMAKING AND POWER SPECTRUM PIPELINE
+# by Josh Dillon
+
+import numpy as np
+import scipy.sparse
+
+class RedundantBaselineGroups:
+    """Maps the antenna pairs of the array onto the baselines in s.baselines, so that visibilities and noise measured by antenna pairs
+    can be reduced to them with inverse variance weights, all at once.
+
+    With s.useOnlyUniqueBaselines, every pair in s.antennaPairDict belongs to the unique baseline it's redundant with. Otherwise,
+    each pair in s.allBaselinePairs is its own group. A pair measures the visibility of its baseline if x1 - x2 = b for antenna
+    positions x, or its complex conjugate if x2 - x1 = b. Redundant measurements with antenna noises n1 and n2 are weighted by
+    1/(n1*n2)^2, so a group's noise is (sum over its pairs of (n1*n2)^-2)^(-1/2), which is just n1*n2 for a group of one.
+
+    Class Members
+    ----------
+    pairs: numpy array
+        [pair, antenna 1/2] antenna indices of every antenna pair that is used.
+    baselineOfPairs: numpy array
+        [pair] index in s.baselines of each pair.
+    groupingOperator: scipy.sparse.csr_matrix
+        [baseline, pair] matrix of ones that sums quantities over the pairs in each group.
+    baselineOfAntennas: numpy array
+        [antenna 1, antenna 2] index in s.baselines of the pair, in either order, or -1 if it isn't used.
+    conjugateOfAntennas: numpy array
+        [antenna 1, antenna 2] whether the pair's visibilities are the complex conjugates of its baseline's.
+    """
+
+    LSTsPerChunk = 256 #number of LSTs whose pair noises are reduced at once
+
+    def __init__(self, s):
+        if s.useOnlyUniqueBaselines:
+            self.pairs = np.asarray(s.antennaPairDict.keys(), dtype=int)
+            self.baselineOfPairs = np.asarray([s.antennaPairDict[tuple(pair)] for pair in self.pairs], dtype=int)
+        else:
+            self.pairs = np.asarray(s.allBaselinePairs, dtype=int)
+            self.baselineOfPairs = np.arange(len(self.pairs))
+        self.nBaselines = s.nBaselines
+        self.groupingOperator = scipy.sparse.csr_matrix((np.ones(len(self.pairs)), (self.baselineOfPairs, np.arange(len(self.pairs)))), shape=(s.nBaselines, len(self.pairs)))
+
+        self.baselineOfAntennas = -np.ones((s.nAntennas, s.nAntennas), dtype=int)
+        self.baselineOfAntennas[self.pairs[:,0], self.pairs[:,1]] = self.baselineOfPairs
+        self.baselineOfAntennas[self.pairs[:,1], self.pairs[:,0]] = self.baselineOfPairs
+        separations = s.antennaPositions[self.pairs[:,0]] - s.antennaPositions[self.pairs[:,1]]
+        baselines = s.baselines[self.baselineOfPairs]
+        separations = separations[:,0:baselines.shape[1]]
+        pairIsConjugated = np.sum((separations + baselines)**2, axis=1) < np.sum((separations - baselines)**2, axis=1)
+        self.conjugateOfAntennas = np.zeros((s.nAntennas, s.nAntennas), dtype=bool)
+        self.conjugateOfAntennas[self.pairs[:,0], self.pairs[:,1]] = pairIsConjugated
+        self.conjugateOfAntennas[self.pairs[:,1], self.pairs[:,0]] = np.logical_not(pairIsConjugated)
+
+    def inverseVariancePerBaseline(self, noisePerAntenna):
+        """Returns the [LST, baseline] sum over each group of the inverse noise variances (n1*n2)^-2 of its pairs, given the [LST, antenna] noise.
+        The pair variances are only formed for a few LSTs at a time, which keeps them in cache."""
+        inverseVariancesPerAntenna = 1.0 / (noisePerAntenna * noisePerAntenna)
+        inverseVariances = np.empty((len(noisePerAntenna), self.nBaselines))
+        for firstLST in range(0, len(noisePerAntenna), self.LSTsPerChunk):
+            LSTs = slice(firstLST, firstLST + self.LSTsPerChunk)
+            pairInverseVariances = inverseVariancesPerAntenna[LSTs, self.pairs[:,0]] * inverseVariancesPerAntenna[LSTs, self.pairs[:,1]]
+            inverseVariances[LSTs] = self.groupingOperator.dot(pairInverseVariances.T).T
+        return inverseVariances
+
+    def noisePerBaseline(self, noisePerAntenna):
+        """Returns the [LST, baseline] noise of the inverse variance weighted average of each group, given the [LST, antenna] noise."""
+        return self.inverseVariancePerBaseline(noisePerAntenna)**(-.5)
+
+    def baselinesOfAntennas(self, antenna1, antenna2):
+        """Returns the baseline index (or -1, for unused pairs or antennas outside the array) and whether to conjugate for each of the given antenna pairs."""
+        nAntennas = len(self.baselineOfAntennas)
+        known = (antenna1 >= 0) * (antenna1 < nAntennas) * (antenna2 >= 0) * (antenna2 < nAntennas)
+        antenna1, antenna2 = np.where(known, antenna1, 0), np.where(known, antenna2, 0)
+        return np.where(known, self.baselineOfAntennas[antenna1, antenna2], -1), known * self.conjugateOfAntennas[antenna1, antenna2]
+
+    def accumulate(self, weightedSums, weightSums, LSTindices, antenna1, antenna2, visibilities, noisePerAntenna):
+        """Adds a chunk of streamed measurements to the raveled [LST, baseline] inverse variance weighted sums of visibilities and of weights.
+        The chunk is first reduced onto the LSTs and baselines it has, so only those entries of the sums are touched. Each measurement has an
+        index into the LSTs of noisePerAntenna (or -1, to skip it), the antennas (0-indexed) that measured it, and its visibility. Measurements
+        of unused pairs are skipped too.
+        Returns how many measurements were added. Dividing the weighted sums by the weight sums then gives the redundantly averaged visibilities."""
+        baselineIndices, conjugate = self.baselinesOfAntennas(antenna1, antenna2)
+        used = np.flatnonzero((LSTindices >= 0) * (baselineIndices >= 0))
+        visibilities = np.where(conjugate[used], np.conj(visibilities[used]), visibilities[used])
+        weights = (noisePerAntenna[LSTindices[used], antenna1[used]] * noisePerAntenna[LSTindices[used], antenna2[used]])**(-2)
+        outputIndices, chunkIndices = np.unique(LSTindices[used] * self.nBaselines + baselineIndices[used], return_inverse=True)
+        weightedSums[outputIndices] += np.bincount(chunkIndices, weights * visibilities.real, minlength=len(outputIndices)) + 1j * np.bincount(chunkIndices, weights * visibilities.imag, minlength=len(outputIndices))
+        weightSums[outputIndices] += np.bincount(chunkIndices, weights, minlength=len(outputIndices))
+        return len(used)
@@ -0,0 +1,147 @@
+# SUPPORTING MODULE FOR JOINT MAPMAKING AND POWER SPECTRUM PIPELINE
+# by Josh Dillon
+
+import numpy as np
+import copy
+import os
+import shutil
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import MatricesForMapmaking as MapMats
+from PSFAccumulator import PSFAccumulator
+
+#Inputs for snapshot workers. These are set before the workers are started, so process workers inherit them when they are forked
+#(and thread workers share them) instead of having the snapshot visibilities, beams, and coordinates pickled and sent to every worker.
+sharedSnapshotInputs = {}
+
+#The arrays in a partial sum that process workers save to files rather than send back to the main process
+partialSumNames = ["coaddedMap", "PSF", "pointSourcePSF"]
+
+def addSnapshotToAccumulator(s, snapshot, snapshotVisibilities, coords, PBs, ps, accumulator):
+    """This function computes a single snapshot's K_PSF * A^t and point source A matrix and queues them up in the accumulator, along with its
+    N^-1 and N^-1 * y from snapshotVisibilities (a MatricesForMapmaking.SnapshotVisibilities)."""
+    NinvTimesy, Ninv = snapshotVisibilities.snapshotSums(snapshot)
+    if accumulator.useRealArithmetic:
+        KAtranspose = MapMats.calculateKAtransposeRealBlocks(s,snapshot,coords,PBs,accumulator.dtype)
+    else:
+        KAtranspose = MapMats.calculateKAtranspose(s,snapshot,coords,PBs)
+    if s.PSFforPointSources and ps.nSources > 0 and accumulator.useRealArithmetic:
+        accumulator.addSnapshot(snapshot, KAtranspose, Ninv, NinvTimesy, MapMats.calculatePSAmatrixRealBlocks(s,snapshot,ps,PBs,accumulator.dtype))
+    elif s.PSFforPointSources and ps.nSources > 0:
+        accumulator.addSnapshot(snapshot, KAtranspose, Ninv, NinvTimesy, MapMats.calculatePSAmatrix(s,snapshot,ps,PBs))
+    else:
+        accumulator.addSnapshot(snapshot, KAtranspose, Ninv, NinvTimesy)
+
+def accumulateSnapshots(s, times, snapshotVisibilities, coords, PBs, ps, accumulator, checkpointFolder):
+    """This function adds every snapshot that the accumulator hasn't already processed, saving checkpoints every s.checkpointEverySnapshots snapshots.
+    If s.snapshotWorkers > 1, the snapshots are split up among parallel workers (see accumulateSnapshotsInParallel)."""
+    snapshotsToProcess = [snapshot for snapshot in times.snapshots if not accumulator.hasProcessed(snapshot)]
+    if s.snapshotWorkers > 1 and len(snapshotsToProcess) > 1:
+        if accumulateSnapshotsInParallel(s, snapshotsToProcess, snapshotVisibilities, coords, PBs, ps, accumulator, checkpointFolder):
+            return
+    for snapshot in snapshotsToProcess:
+        print "Working on snapshot at LST = " + str(round(snapshot.centralLST,4)) + "..."
+        addSnapshotToAccumulator(s, snapshot, snapshotVisibilities, coords, PBs, ps, accumulator)
+        if s.checkpointEverySnapshots > 0 and accumulator.nSnapshotsSinceCheckpoint >= s.checkpointEverySnapshots:
+            accumulator.saveCheckpoint(checkpointFolder)
+
+def accumulateSnapshotsInParallel(s, snapshots, snapshotVisibilities, coords, PBs, ps, accumulator, checkpointFolder):
+    """This function splits the snapshots up among s.snapshotWorkers workers, each of which accumulates partial sums of the
+    map and PSFs over a contiguous subset of them. The partial sums are then combined in a fixed order by reducePartialSums
+    as they come back, so the result doesn't depend on which worker finishes first, and added to the accumulator.
+
+    Workers are processes or threads depending on s.snapshotExecutor. Each worker keeps its own partial PSF in memory
+    and sizes its batches to fit in s.snapshotWorkerMemoryInGB. Process workers save their partial sums to files in the results
+    folder and only send back the filenames, so nothing large is pickled and the main process adds them up memory-mapped, rather
+    than holding every worker's partial PSF at once. If s.checkpointEverySnapshots > 0, snapshots are processed in
+    rounds of that many and a checkpoint is saved after each round. Returns False (without doing anything) if a partial PSF
+    won't fit in a worker's memory, in which case the snapshots should be processed serially."""
+    layout = accumulator.layout
+    memoryPerWorker = s.snapshotWorkerMemoryInGB * 1024.0**3
+    bytesForPartialSums = 8 * layout.nFacetPixels * (layout.nPSFPixels + layout.nSources + 1)
+    bytesPerSnapshot = layout.nPSFPixels * accumulator.columnsPerSnapshot * np.dtype(accumulator.dtype).itemsize
+    if memoryPerWorker < bytesForPartialSums + 2*bytesPerSnapshot:
+        print "\nWARNING: The partial PSF for a snapshot worker needs more than " + str(s.snapshotWorkerMemoryInGB) + " GB. Processing snapshots serially.\n"
+        return False
+
+    workerS = copy.copy(s)
+    workerS.useMemoryMappedPSF = False #only the main accumulator can live in the results folder
+    workerS.snapshotsPerPSFBatch = int(max(min(s.snapshotsPerPSFBatch, (memoryPerWorker - bytesForPartialSums) / 2 / bytesPerSnapshot), 1))
+    partialSumsFolder = s.resultsFolder + "snapshotWorkerPartialSums/" if s.snapshotExecutor != "thread" else None
+    sharedSnapshotInputs.update({'s': workerS, 'snapshots': snapshots, 'snapshotVisibilities': snapshotVisibilities, 'coords': coords, 'PBs': PBs, 'ps': ps, 'layout': layout,
+                                 'partialSumsFolder': partialSumsFolder})
+    print "Splitting " + str(len(snapshots)) + " snapshots among " + str(s.snapshotWorkers) + " " + s.snapshotExecutor + " workers..."
+    if s.snapshotExecutor == "thread":
+        pool = ThreadPool(s.snapshotWorkers)
+    else:
+        pool = mp.Pool(s.snapshotWorkers)
+    try:
+        snapshotsPerRound = s.checkpointEverySnapshots if s.checkpointEverySnapshots > 0 else len(snapshots)
+        for firstSnapshot in range(0, len(snapshots), snapshotsPerRound):
+            snapshotIndices = np.arange(firstSnapshot, min(firstSnapshot + snapshotsPerRound, len(snapshots)))
+            workerSnapshotIndices = [list(indices) for indices in np.array_split(snapshotIndices, s.snapshotWorkers) if len(indices) > 0]
+            if partialSumsFolder is not None and not os.path.exists(partialSumsFolder):
+                os.mkdir(partialSumsFolder)
+            coaddedMap, PSF, pointSourcePSF, PSFisUpperTriangleOnly, processedSnapshotLSTs = reducePartialSums(pool.imap(accumulateSnapshotsInWorker, workerSnapshotIndices), accumulator.PSFrowsPerBlock)
+            accumulator.addAccumulators(coaddedMap, PSF, pointSourcePSF, PSFisUpperTriangleOnly, processedSnapshotLSTs = processedSnapshotLSTs)
+            del coaddedMap, PSF, pointSourcePSF
+            if partialSumsFolder is not None:
+                shutil.rmtree(partialSumsFolder)
+            if s.checkpointEverySnapshots > 0:
+                accumulator.saveCheckpoint(checkpointFolder)
+    finally:
+        pool.close()
+        pool.join()
+        sharedSnapshotInputs.clear()
+        if partialSumsFolder is not None and os.path.exists(partialSumsFolder):
+            shutil.rmtree(partialSumsFolder)
+    return True
+
+def accumulateSnapshotsInWorker(snapshotIndices):
+    """This function runs in a snapshot worker. It accumulates the un-normalized map and PSFs over the given snapshots (indices
+    into sharedSnapshotInputs['snapshots']) and returns them as a partial sum. If sharedSnapshotInputs['partialSumsFolder'] is set,
+    the map and PSFs are saved there and their filenames are returned in their place."""
+    inputs = sharedSnapshotInputs
+    accumulator = PSFAccumulator(inputs['s'], inputs['layout'])
+    for snapshotIndex in snapshotIndices:
+        snapshot = inputs['snapshots'][snapshotIndex]
+        print "Working on snapshot at LST = " + str(round(snapshot.centralLST,4)) + "..."
+        addSnapshotToAccumulator(inputs['s'], snapshot, inputs['snapshotVisibilities'], inputs['coords'], inputs['PBs'], inputs['ps'], accumulator)
+    accumulator.flush()
+    partialSum = [accumulator.coaddedMap, accumulator.PSF, accumulator.pointSourcePSF]
+    if inputs['partialSumsFolder'] is not None:
+        for i, name in enumerate(partialSumNames):
+            filename = inputs['partialSumsFolder'] + name + "_" + str(snapshotIndices[0]) + ".npy"
+            np.save(filename, partialSum[i])
+            partialSum[i] = filename
+    return partialSum + [accumulator.PSFisUpperTriangleOnly, accumulator.processedSnapshotLSTs]
+
+def openPartialSum(partialSum):
+    """This function memory-maps (for writing) the map and PSFs of a partial sum that a worker saved to files, or returns them as they are."""
+    return [np.load(array, mmap_mode='r+') if isinstance(array, str) else array for array in partialSum[0:3]] + list(partialSum[3:])
+
+def addPartialSums(partialSum1, partialSum2, PSFrowsPerBlock):
+    """This function adds the second partial sum to the first in place, one block of PSF rows at a time, and returns it."""
+    coaddedMap1, PSF1, pointSourcePSF1, upperTriangleOnly1, LSTs1 = partialSum1
+    coaddedMap2, PSF2, pointSourcePSF2, upperTriangleOnly2, LSTs2 = partialSum2
+    coaddedMap1 += coaddedMap2
+    for firstRow in range(0, len(PSF1), PSFrowsPerBlock):
+        PSF1[firstRow : firstRow + PSFrowsPerBlock] += PSF2[firstRow : firstRow + PSFrowsPerBlock]
+    pointSourcePSF1 += pointSourcePSF2
+    return [coaddedMap1, PSF1, pointSourcePSF1, upperTriangleOnly1 or upperTriangleOnly2, LSTs1 + LSTs2]
+
+def reducePartialSums(partialSums, PSFrowsPerBlock):
+    """This function adds up partial sums (as returned by accumulateSnapshotsInWorker, in order) as they arrive, as a binary tree that always
+    pairs neighbors in the same order, so that the floating point result is deterministic. Each subtree is added up as soon as both of its
+    halves have arrived, so only one partial sum per level of the tree is ever kept."""
+    waiting = [] #[level in the tree, partial sum] of subtrees still waiting for their right neighbor
+    for partialSum in partialSums:
+        level, partialSum = 0, openPartialSum(partialSum)
+        while len(waiting) > 0 and waiting[-1][0] == level:
+            partialSum = addPartialSums(waiting.pop()[1], partialSum, PSFrowsPerBlock)
+            level += 1
+        waiting.append((level, partialSum))
+    partialSum = waiting.pop()[1]
+    while len(waiting) > 0:
+        partialSum = addPartialSums(waiting.pop()[1], partialSum, PSFrowsPerBlock)
+    return partialSum
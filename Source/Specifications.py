@@ -7,6 +7,8 @@ import math
 import ephem
 import cPickle as pickle
 import scipy.constants as const
+import FringeKernel
+import VisibilityStore
 
 #This class takes the location of the configuration file and loads relevant specs as attributes to the object
 class Specifications:
@@ -19,6 +21,9 @@ class Specifications:
         
         #PIPELINE SETTINGS
         self.frequencyRange = map(float, config.get('Pipeline Settings','frequencyRange').split())
+        self.maxConcurrentFrequencies = config.getint('Pipeline Settings','maxConcurrentFrequencies')
+        self.pipelineMemoryInGB = config.getfloat('Pipeline Settings','pipelineMemoryInGB')
+        self.frequencyJobRetries = config.getint('Pipeline Settings','frequencyJobRetries')
 
         #ANTENNA AND INSTRUMENT SETTINGS
         self.frequencyList = np.loadtxt(config.get('Array Settings','frequencyListFile').replace('[MainDirectory]',self.mainDirectory))
@@ -46,13 +51,22 @@ class Specifications:
         self.FITSbeam = config.getboolean('Array Settings', 'FITSbeam')        
         self.beamFileFormat = config.get('Array Settings','beamFileFormat').replace('[MainDirectory]',self.mainDirectory)
         self.beamNSIDE = config.getint('Array Settings','beamNSIDE')    
+        self.beamTableOversampling = config.getint('Array Settings','beamTableOversampling')
         
         #OBSERVATION SETTINGS
         self.LSTsFilename = config.get('Input Data Settings','LSTsFilename').replace('[MainDirectory]',self.mainDirectory)
         self.pointings = np.loadtxt(config.get('Input Data Settings','PointingListFilename').replace('[MainDirectory]',self.mainDirectory)).astype(int)
         self.pointingCenters = pickle.load(open(config.get('Input Data Settings','PointingCenterDictionaryFilename').replace('[MainDirectory]',self.mainDirectory),'r'))
         self.noisePerAntennaPath = config.get('Input Data Settings','noisePerAntennaPath').replace('[MainDirectory]',self.mainDirectory)
-        self.noisePerAntenna = np.load(self.noisePerAntennaPath.replace('[freq]',"{:.3f}".format(self.freq))) #[LST index, antenna index]
+
+        #VISIBILITY DATA SETTINGS
+        self.uvfitsFilename = config.get('Input Data Settings','uvfitsFilename').replace('[MainDirectory]',self.mainDirectory)
+        self.uvfitsPolarization = config.get('Input Data Settings','uvfitsPolarization')
+        self.visibilityLoadingMemoryInGB = config.getfloat('Input Data Settings','visibilityLoadingMemoryInGB')
+        self.nightlyUvfitsFilenames = config.get('Input Data Settings','nightlyUvfitsFilenames').replace('[MainDirectory]',self.mainDirectory).split()
+        self.nightlyNoisePerAntennaPath = config.get('Input Data Settings','nightlyNoisePerAntennaPath').replace('[MainDirectory]',self.mainDirectory)
+        self.visibilityStoreFolder = config.get('Input Data Settings','visibilityStoreFolder').replace('[MainDirectory]',self.mainDirectory)
+        self.visibilityStoreLSTsPerBlock = config.getint('Input Data Settings','visibilityStoreLSTsPerBlock')
 
         #POINT SOURCE CATALOG SETTINGS
         self.pointSourceCatalogFilename = config.get('Input Data Settings','pointSourceCatalogFilename').replace('[MainDirectory]',self.mainDirectory)
@@ -65,6 +79,10 @@ class Specifications:
         self.simulateVisibilitiesWithPointSources = config.getboolean('Input Data Settings','simulateVisibilitiesWithPointSources')
         self.GSMlocation = config.get('Input Data Settings','GSMlocation').replace('[MainDirectory]',self.mainDirectory)
         self.GSMNSIDE = config.getint('Input Data Settings','GSMNSIDE')
+        self.simulationBeamThreshold = config.getfloat('Input Data Settings','simulationBeamThreshold')
+        self.simulationMemoryInGB = config.getfloat('Input Data Settings','simulationMemoryInGB')
+        self.visibilitySimulator = config.get('Input Data Settings','visibilitySimulator')
+        self.mmodeLmax = config.getint('Input Data Settings','mmodeLmax')
         
         #FACET SETTINGS
         self.facetRA = config.getfloat('Mapmaking Specifications','facetRA')
@@ -77,6 +95,12 @@ class Specifications:
         self.mapNSIDE = config.getint('Mapmaking Specifications', 'mapNSIDE')
         self.PSFextensionBeyondFacetFactor = config.getfloat('Mapmaking Specifications', 'PSFextensionBeyondFacetFactor')    
         self.integrationsPerSnapshot = config.getint('Mapmaking Specifications', 'integrationsPerSnapshot')
+        self.snapshotsPerPSFBatch = config.getint('Mapmaking Specifications', 'snapshotsPerPSFBatch')
+        self.PSFarithmetic = config.get('Mapmaking Specifications', 'PSFarithmetic')
+        self.PSFprecision = config.get('Mapmaking Specifications', 'PSFprecision')
+        self.useMemoryMappedPSF = config.getboolean('Mapmaking Specifications', 'useMemoryMappedPSF')
+        self.PSFmemoryBudgetInGB = config.getfloat('Mapmaking Specifications', 'PSFmemoryBudgetInGB')
+        self.snapshotGeometryMemoryInGB = config.getfloat('Mapmaking Specifications', 'snapshotGeometryMemoryInGB')
         self.PSFforPointSources = config.getboolean('Mapmaking Specifications','PSFforPointSources')
         self.useAdaptiveHEALPixForPSF = config.getboolean('Mapmaking Specifications','useAdaptiveHEALPixForPSF')
         self.adaptiveHEALPixMinNSIDE = config.getint('Mapmaking Specifications', 'adaptiveHEALPixMinNSIDE')
@@ -84,9 +108,19 @@ class Specifications:
         self.adaptiveHEALPixBeamPowerScaling = config.getfloat('Mapmaking Specifications', 'adaptiveHEALPixBeamPowerScaling')
         self.makeFacetSameAsAdaptivePSF = config.getboolean('Mapmaking Specifications', 'makeFacetSameAsAdaptivePSF')
         
+        #CHECKPOINT SETTINGS
+        self.checkpointEverySnapshots = config.getint('Mapmaking Specifications','checkpointEverySnapshots')
+        self.resumeFromCheckpoint = config.getboolean('Mapmaking Specifications','resumeFromCheckpoint')
+        
+        #PARALLEL SNAPSHOT SETTINGS
+        self.snapshotWorkers = config.getint('Mapmaking Specifications','snapshotWorkers')
+        self.snapshotExecutor = config.get('Mapmaking Specifications','snapshotExecutor')
+        self.snapshotWorkerMemoryInGB = config.getfloat('Mapmaking Specifications','snapshotWorkerMemoryInGB')
+        
         #OUTPUT SETTINGS
         self.resultsFolderFormat = config.get('Mapmaking Specifications','resultsFolder').replace('[MainDirectory]',self.mainDirectory)    
         self.resultsFolder = config.get('Mapmaking Specifications','resultsFolder').replace('[MainDirectory]',self.mainDirectory) + "{:.3f}".format(self.freq) + "/"        
+        self.cacheFolder = config.get('Mapmaking Specifications','cacheFolder').replace('[MainDirectory]',self.mainDirectory)
         
         self.CalculateBasicParameters()
     
@@ -108,7 +142,8 @@ class Specifications:
         self.mapPixels = 12 * self.mapNSIDE**2
         self.facetDecinRad = self.facetDec * math.pi/180.0
         self.facetRAinRad = self.facetRA * math.pi/180.0
-        self.noisePerAntenna = np.load(self.noisePerAntennaPath.replace('[freq]',"{:.3f}".format(self.freq))) #[LST index, antenna index]
+        self.noisePerAntenna = VisibilityStore.loadNoisePerAntenna(self) #[LST index, antenna index]
+        self.baselineAntennaPairs = FringeKernel.baselineAntennaPairs(self) #[baseline index, antenna 1/2] or None if baselines can't be built from antenna positions
         
         
 if __name__ == "__main__":
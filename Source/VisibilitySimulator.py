@@ -5,9 +5,13 @@ import numpy as np
 import healpy as hp
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
+import scipy.sparse
 import ephem
 import Geometry
-from GlobalSkyModel import GlobalSkyModel
+import FringeKernel
+import scipy.constants as const
+from GlobalSkyModel import GlobalSkyModel, loadGSMComponents, GSMComponentWeights
+from PrimaryBeams import beamSquaredAtFrequencies
 
 def VisibilitySimulator(s,PBs,ps,times,coords):
     print "Now simulating visibilities (assuming XX beams only)..."
@@ -15,28 +19,117 @@ def VisibilitySimulator(s,PBs,ps,times,coords):
         s.GSMNSIDE = s.mapNSIDE
     coordsGSM = Geometry.Coordinates(s,useAnotherResolution = s.GSMNSIDE)
     visibilities = np.zeros([len(times.LSTs),len(s.baselines)],dtype=complex)
-    
+
     #TODO: this ignores polarization and differing primary beams
     if s.simulateVisibilitiesWithGSM:
         GSM = GlobalSkyModel(s.freq, s.GSMlocation, s.GSMNSIDE)
-        interpoltedGSMRotated = hp.get_interp_val(GSM.hpMap,-coordsGSM.galCoords.b.radian+np.pi/2, np.asarray(coordsGSM.galCoords.l.radian))        
-        
-        #loop over times and baselines to calculate visibilities
-        for t in range(len(times.LSTs)):
-            pixelAlts, pixelAzs = Geometry.convertEquatorialToHorizontal(s,coordsGSM.pixelRAs,coordsGSM.pixelDecs,times.LSTs[t])
-            rHatVectors = Geometry.convertAltAzToCartesian(pixelAlts,pixelAzs)
-            primaryBeam = hp.get_interp_val(PBs.beamSquared("X","x",s.pointings[t]), np.pi/2-pixelAlts, pixelAzs)
-            for b in range(len(s.baselines)):
-                exponent = np.exp(-1j*s.k*np.dot(rHatVectors,s.baselines[b]))
-                visibilities[t,b] += np.sum(interpoltedGSMRotated * primaryBeam * exponent) * 4*np.pi / len(GSM.hpMap) / s.convertJyToKFactor
+        interpoltedGSMRotated = Geometry.galacticResamplingMatrix(s, s.GSMNSIDE, coordsGSM.pixelRAs, coordsGSM.pixelDecs).dot(GSM.hpMap)
+        visibilities += simulateVisibilitiesOfPointLikeSky(s, PBs, times, coordsGSM.pixelRAs, coordsGSM.pixelDecs, interpoltedGSMRotated * 4*np.pi / len(GSM.hpMap) / s.convertJyToKFactor)
 
     if s.simulateVisibilitiesWithPointSources and ps.nSources > 0:
-        for t in range(len(times.LSTs)):
-            psAlts, psAzs = Geometry.convertEquatorialToHorizontal(s,ps.RAs,ps.decs,times.LSTs[t])
-            rHatVectors = Geometry.convertAltAzToCartesian(psAlts,psAzs)
-            primaryBeam = hp.get_interp_val(PBs.beamSquared("X","x",s.pointings[t]), np.pi/2-psAlts, psAzs)
-            for b in range(len(s.baselines)):
-                exponent = np.exp(-1j*s.k*np.dot(rHatVectors,s.baselines[b]))
-                visibilities[t,b] += np.sum(ps.scaledFluxes * primaryBeam * exponent) 
-				
-    return visibilities
\ No newline at end of file
+        visibilities += simulateVisibilitiesOfPointLikeSky(s, PBs, times, ps.RAs, ps.decs, ps.scaledFluxes)
+
+    return visibilities
+
+def VisibilityCubeSimulator(s, freqs, times, ps = None):
+    """This function returns the [freq, LST, baseline] visibilities of the GSM and/or point sources (as set in s) at all of the given
+    frequencies (in MHz) at once, in the same units as VisibilitySimulator.
+
+    Everything that doesn't depend on frequency is only done once: the GSM coordinates, the interpolation of the GSM components onto
+    them, the alt/az of every direction at every LST, the beam interpolation weights, and rHat.x (or rHat.b). Only the beam amplitudes,
+    sky weights, and complex exponentials are evaluated at each frequency. The point source catalog ps is needed if s.simulateVisibilitiesWithPointSources."""
+    freqs = np.asarray(freqs, dtype=float)
+    print "Now simulating visibilities at " + str(len(freqs)) + " frequencies (assuming XX beams only)..."
+    if s.GSMNSIDE < s.mapNSIDE:
+        s.GSMNSIDE = s.mapNSIDE
+    beamMaps = dict([(pointing, beamSquaredAtFrequencies(s, "X", "x", pointing, freqs)) for pointing in np.unique(s.pointings[0:len(times.LSTs)])])
+    if s.beamTableOversampling > 0:
+        beamMaps = dict([(pointing, Geometry.HourAngleBeamTable(s, beamMaps[pointing])) for pointing in beamMaps])
+    convertJyToKFactors = (const.c)**2 / (2 * const.k * (freqs*1e6)**2 * 1e26)
+    visibilities = np.zeros([len(freqs),len(times.LSTs),len(s.baselines)],dtype=complex)
+
+    #TODO: this ignores polarization and differing primary beams
+    if s.simulateVisibilitiesWithGSM:
+        coordsGSM = Geometry.Coordinates(s,useAnotherResolution = s.GSMNSIDE)
+        resampling = Geometry.galacticResamplingMatrix(s, s.GSMNSIDE, coordsGSM.pixelRAs, coordsGSM.pixelDecs)
+        interpolatedComponents = np.asarray([resampling.dot(componentMap) for componentMap in loadGSMComponents(s.GSMlocation, s.GSMNSIDE)[0]])
+        interpolatedGSMs = np.dot(GSMComponentWeights(freqs, s.GSMlocation), interpolatedComponents)
+        visibilities += simulateVisibilityCubeOfPointLikeSky(s, freqs, beamMaps, times, coordsGSM.pixelRAs, coordsGSM.pixelDecs, interpolatedGSMs * 4*np.pi / coordsGSM.mapPixels / convertJyToKFactors[:,None])
+
+    if s.simulateVisibilitiesWithPointSources and ps is not None and ps.nSources > 0:
+        visibilities += simulateVisibilityCubeOfPointLikeSky(s, freqs, beamMaps, times, ps.RAs, ps.decs, ps.scaledFluxesAtFrequencies(s, freqs))
+
+    return visibilities
+
+def simulateVisibilitiesOfPointLikeSky(s, PBs, times, RAs, decs, skyWeights):
+    """This function returns the [LST, baseline] visibilities of a sky made up of point-like sources (or pixels) at the given RAs and decs
+    with the given weights (fluxes, or temperatures times pixel areas), seen through the XX primary beam at s.freq."""
+    if s.beamTableOversampling > 0:
+        beamMaps = dict([(pointing, Geometry.beamSquaredTable(s, PBs, pointing)) for pointing in np.unique(s.pointings[0:len(times.LSTs)])])
+    else:
+        beamMaps = dict([(pointing, PBs.beamSquared("X","x",pointing)[None,:]) for pointing in np.unique(s.pointings[0:len(times.LSTs)])])
+    return simulateVisibilityCubeOfPointLikeSky(s, [s.freq], beamMaps, times, RAs, decs, np.atleast_2d(skyWeights))[0]
+
+def simulateVisibilityCubeOfPointLikeSky(s, freqs, beamMaps, times, RAs, decs, skyWeights):
+    """This function returns the [freq, LST, baseline] visibilities of a sky made up of point-like sources (or pixels) at the given RAs
+    and decs with the given [freq, direction] weights, seen through the XX primary beams in beamMaps (a dictionary by pointing of [freq, pixel]
+    HEALPix maps or, if s.beamTableOversampling > 0, of Geometry.HourAngleBeamTables, which skip the alt/az of directions the beam doesn't see).
+
+    At each LST, only the directions where the beam is above s.simulationBeamThreshold times its peak at some frequency are included.
+    Directions more than a beam pixel below the horizon are culled by their hour angles before their altitudes or beams are even evaluated,
+    which matters for large point source catalogs. Blocks of LSTs are then done at once
+    as the product of a sparse block-diagonal matrix of beam-weighted sky weights (one row per LST) with the stacked fringes of all
+    their directions. Blocks (and, if needed, groups of baselines) are sized so that the fringes take up at most s.simulationMemoryInGB.
+    Small blocks that fit in cache are usually fastest. The geometry of each block is shared by all frequencies."""
+    visibilities = np.zeros([len(freqs),len(times.LSTs),len(s.baselines)],dtype=complex)
+    maxFringeElements = max(int(s.simulationMemoryInGB * 1024.0**3 / 16), 1)
+    horizonMargin = 2 * hp.nside2resol(s.beamNSIDE) #directions just below the horizon can still pick up interpolated beam
+    ks = 2*np.pi * np.asarray(freqs)*1e6 / const.c
+    evenlySpacedFreqs = len(freqs) > 2 and np.allclose(np.diff(ks), ks[1] - ks[0], rtol=1e-9, atol=0) #then each frequency's phase factors are the last one's times a fixed step
+    blockLSTs, blockWeights, blockRHatVectors = [], [], []
+    risingHalfWidths = Geometry.hourAngleHalfWidthsAboveAltitude(s, decs, -horizonMargin)
+    for t in range(len(times.LSTs)):
+        hourAngles = np.mod(np.pi/12.0*times.LSTs[t] - RAs + np.pi, 2*np.pi) - np.pi
+        nearSky = np.flatnonzero(np.abs(hourAngles) < risingHalfWidths)
+        if s.beamTableOversampling > 0:
+            primaryBeams = beamMaps[s.pointings[t]].beamsAt(hourAngles[nearSky], decs[nearSky]) #[freq, direction]
+        else:
+            alts, azs = Geometry.convertEquatorialToHorizontal(s, RAs[nearSky], decs[nearSky], times.LSTs[t])
+            pixels, pixelWeights = hp.get_interp_weights(s.beamNSIDE, np.pi/2-alts, azs)
+            primaryBeams = np.sum(beamMaps[s.pointings[t]][:,pixels] * pixelWeights, axis=1) #[freq, direction]
+        included = np.any(np.abs(primaryBeams) > s.simulationBeamThreshold * np.max(np.abs(primaryBeams), axis=1)[:,None], axis=0) if len(nearSky) > 0 else np.zeros(0, dtype=bool)
+        if s.beamTableOversampling > 0:
+            alts, azs = Geometry.convertEquatorialToHorizontal(s, RAs[nearSky[included]], decs[nearSky[included]], times.LSTs[t])
+        else:
+            alts, azs = alts[included], azs[included]
+        blockLSTs.append(t)
+        blockWeights.append(skyWeights[:,nearSky[included]] * primaryBeams[:,included])
+        blockRHatVectors.append(Geometry.convertAltAzToCartesian(alts, azs))
+        if t+1 == len(times.LSTs) or sum([weights.shape[1] for weights in blockWeights]) * s.nBaselines >= maxFringeElements:
+            rHatVectors = np.concatenate(blockRHatVectors)
+            projections = FringeKernel.antennaProjections(s, rHatVectors) if s.baselineAntennaPairs is not None else np.dot(rHatVectors, np.transpose(s.baselines))
+            phaseFactors = np.exp(-1j * ks[0] * projections)
+            if evenlySpacedFreqs: phaseStep = np.exp(-1j * (ks[1] - ks[0]) * projections)
+            for f in range(len(freqs)):
+                if f > 0 and evenlySpacedFreqs:
+                    phaseFactors *= phaseStep
+                elif f > 0:
+                    phaseFactors = np.exp(-1j * ks[f] * projections)
+                visibilities[f,blockLSTs,:] = simulateBlockOfVisibilities(s, [weights[f] for weights in blockWeights], phaseFactors, maxFringeElements)
+            blockLSTs, blockWeights, blockRHatVectors = [], [], []
+    return visibilities
+
+def simulateBlockOfVisibilities(s, blockWeights, phaseFactors, maxFringeElements):
+    """This function returns the visibilities for a block of LSTs, given the beam-weighted sky weights at each LST and the phase factors
+    e^(-i*|k|*rHat.x) for every antenna (or e^(-i*|k|*rHat.b) for every baseline, if the baselines can't be built from the antennas) of all their stacked directions."""
+    nDirections = np.asarray(map(len, blockWeights))
+    weightsMatrix = scipy.sparse.csr_matrix((np.concatenate(blockWeights), np.arange(np.sum(nDirections)), np.append(0, np.cumsum(nDirections))), shape=(len(blockWeights), np.sum(nDirections)))
+    blockVisibilities = np.zeros((len(blockWeights), s.nBaselines), dtype=complex)
+    baselinesPerGroup = int(max(min(maxFringeElements / max(np.sum(nDirections),1), s.nBaselines), 1))
+    for firstBaseline in range(0, s.nBaselines, baselinesPerGroup):
+        baselineIndices = slice(firstBaseline, min(firstBaseline + baselinesPerGroup, s.nBaselines))
+        if s.baselineAntennaPairs is not None:
+            blockVisibilities[:,baselineIndices] = weightsMatrix.dot(FringeKernel.fringesFromPhaseFactors(s, phaseFactors, baselineIndices))
+        else:
+            blockVisibilities[:,baselineIndices] = weightsMatrix.dot(phaseFactors[:,baselineIndices])
+    return blockVisibilities
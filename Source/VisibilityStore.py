@@ -0,0 +1,113 @@
+# SUPPORTING CLASS FOR JOINT MAPMAKING AND POWER SPECTRUM PIPELINE
+# by Josh Dillon
+
+import numpy as np
+import os
+
+#Visibility stores that have already been opened, by folder. Opening them before forking lets many processes share them.
+loadedVisibilityStores = {}
+
+class VisibilityStore:
+    """Holds the visibilities, their inverse noise variances, and the antenna noise of a whole observation on disk as memory-mapped
+    [freq, LST, baseline] and [freq, LST, antenna] arrays (made by LoadVisibilities.buildVisibilityStore), so that a Mapmaker run only reads
+    the LSTs of the frequency it needs.
+
+    At each frequency, the LSTs are stored in blocks of LSTsPerBlock consecutive LSTs (in the order of the LST file), each of which is
+    contiguous on disk. The index holds the frequencies, the LSTs, and the block size. Reads go block by block, so that the
+    I/O for a facet scales with the time it spends near the pointing center rather than with the length of the observation.
+
+    Parameters
+    ---------------
+    folder: str
+        Folder containing index.npz, visibilities.npy, inverseVariances.npy, and noisePerAntenna.npy.
+
+    Class Members
+    ----------
+    freqs: numpy array
+        Frequencies (in MHz) of the store.
+    LSTs: numpy array
+        LSTs (in hours) of the store, in the order of the LST file.
+    nBlocks: int
+        Number of blocks of LSTs at each frequency.
+    visibilities: numpy memmap
+        [freq, LST, baseline] visibilities (in Jy).
+    inverseVariances: numpy memmap
+        [freq, LST, baseline] inverse noise variances of the visibilities (0 where there's no data).
+    noisePerAntenna: numpy memmap
+        [freq, LST, antenna] noise on each antenna.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        index = np.load(folder + "index.npz")
+        self.freqs, self.LSTs, self.LSTsPerBlock = index['freqs'], index['LSTs'], int(index['LSTsPerBlock'])
+        self.nBlocks = int(np.ceil(len(self.LSTs) / float(self.LSTsPerBlock)))
+        self.visibilities = np.load(folder + "visibilities.npy", mmap_mode='r')
+        self.inverseVariances = np.load(folder + "inverseVariances.npy", mmap_mode='r')
+        self.noisePerAntenna = np.load(folder + "noisePerAntenna.npy", mmap_mode='r')
+
+    def frequencyIndex(self, freq):
+        """Returns the index of freq (in MHz) in the store, which has to be there to within the precision of the noise filenames (1 kHz)."""
+        freqIndex = np.argmin(np.abs(self.freqs - freq))
+        if np.abs(self.freqs[freqIndex] - freq) > .0005:
+            raise ValueError("The visibility store in " + self.folder + " has no data at " + str(freq) + " MHz.")
+        return freqIndex
+
+    def readLSTs(self, data, freq, LSTindices):
+        """Returns data[freq, LSTindices] (e.g. of self.visibilities or self.noisePerAntenna) for the given indices into self.LSTs, in the order
+        given, reading each block that has any of them once and with a single contiguous read."""
+        LSTindices = np.asarray(LSTindices, dtype=int)
+        freqData = data[self.frequencyIndex(freq)]
+        selected = np.empty((len(LSTindices),) + freqData.shape[1:], dtype=freqData.dtype)
+        blocks = LSTindices // self.LSTsPerBlock
+        order = np.argsort(blocks, kind='mergesort')
+        for indicesInBlock in np.split(order, np.flatnonzero(np.diff(blocks[order])) + 1):
+            if len(indicesInBlock) == 0:
+                continue
+            firstLST = blocks[indicesInBlock[0]] * self.LSTsPerBlock
+            block = np.array(freqData[firstLST : firstLST + self.LSTsPerBlock])
+            selected[indicesInBlock] = block[LSTindices[indicesInBlock] - firstLST]
+        return selected
+
+    def blocksRead(self, LSTindices):
+        """Returns how many blocks (out of all of them) readLSTs reads for the given indices into self.LSTs."""
+        return len(np.unique(np.asarray(LSTindices, dtype=int) // self.LSTsPerBlock))
+
+def writeVisibilityStore(folder, freqs, LSTs, LSTsPerBlock, nBaselines, nAntennas, dataAtFrequency):
+    """This function writes a visibility store to folder and returns it, opened. dataAtFrequency(freq) has to return the [LST, baseline]
+    visibilities, the [LST, antenna] noise, and the [LST, baseline] inverse noise variances of the visibilities at that frequency, in the order of LSTs. Only one frequency is in memory at a time, and the
+    files are written under temporary names and then renamed, so that simultaneous runs never see a partial store."""
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    suffix = "." + str(os.getpid()) + ".temp"
+    visibilities = np.lib.format.open_memmap(folder + "visibilities.npy" + suffix + ".npy", mode='w+', dtype=np.complex128, shape=(len(freqs), len(LSTs), nBaselines))
+    noisePerAntenna = np.lib.format.open_memmap(folder + "noisePerAntenna.npy" + suffix + ".npy", mode='w+', dtype=np.float64, shape=(len(freqs), len(LSTs), nAntennas))
+    inverseVariances = np.lib.format.open_memmap(folder + "inverseVariances.npy" + suffix + ".npy", mode='w+', dtype=np.float64, shape=(len(freqs), len(LSTs), nBaselines))
+    for freqIndex, freq in enumerate(freqs):
+        print "Now writing the visibilities and noise at " + str(freq) + " MHz to the visibility store..."
+        visibilities[freqIndex], noisePerAntenna[freqIndex], inverseVariances[freqIndex] = dataAtFrequency(freq)
+    visibilities.flush()
+    noisePerAntenna.flush()
+    inverseVariances.flush()
+    del visibilities, noisePerAntenna, inverseVariances
+    np.savez(folder + "index.npz" + suffix + ".npz", freqs=np.asarray(freqs, dtype=float), LSTs=np.asarray(LSTs, dtype=float), LSTsPerBlock=LSTsPerBlock)
+    os.rename(folder + "visibilities.npy" + suffix + ".npy", folder + "visibilities.npy")
+    os.rename(folder + "noisePerAntenna.npy" + suffix + ".npy", folder + "noisePerAntenna.npy")
+    os.rename(folder + "inverseVariances.npy" + suffix + ".npy", folder + "inverseVariances.npy")
+    os.rename(folder + "index.npz" + suffix + ".npz", folder + "index.npz")
+    loadedVisibilityStores.pop(folder, None)
+    return loadVisibilityStore(folder)
+
+def loadVisibilityStore(folder):
+    """This function returns the VisibilityStore in folder, only opening it once per process."""
+    if folder not in loadedVisibilityStores:
+        loadedVisibilityStores[folder] = VisibilityStore(folder)
+    return loadedVisibilityStores[folder]
+
+def loadNoisePerAntenna(s):
+    """This function returns the [LST index, antenna index] noise at s.freq for all the LSTs in the LST file: memory-mapped from the visibility
+    store if there is one, or else loaded from the AntennaNoise file for that frequency."""
+    if s.visibilityStoreFolder:
+        store = loadVisibilityStore(s.visibilityStoreFolder)
+        return store.noisePerAntenna[store.frequencyIndex(s.freq)]
+    return np.load(s.noisePerAntennaPath.replace('[freq]',"{:.3f}".format(s.freq)))